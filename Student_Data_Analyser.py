@@ -4,139 +4,1964 @@
 # Analyses student data extracted from the Student Database
 
 
-import custtools.admintools as ad
-import custtools.databasetools as db
-import custtools.datetools as da
-import custtools.filetools as ft
-import numpy as np
-import pandas as pd
+import argparse
+import concurrent.futures
+import contextlib
+import csv
+import functools
+import hashlib
+import importlib
+import importlib.util
+import io
+import json
+import os
 import re
+import shutil
 import sys
+import tempfile
+import textwrap
+import threading
+import time
+import tracemalloc
+import urllib.parse
 
 
-def calculate_percent(source_dict):
-    """Calculate the percentage value of each key.
+def import_lazy(name):
+    """Return a module that is only imported when it is first used.
     
-    Calcualtes the % value of each key value within the whole dictionary.
-    Adds all of the key values together to get the total and then divides each
-    key value by this total to get its % of the whole. Returns the results
-    in a dictionary that has its keys copied from the source_dict and its
-    values as the repsective percentages.
+    Args:
+        name (str): Name of the module.
+        
+    Returns:
+        module (module): The module, imported on first attribute access.
+        
+    Raises:
+        ModuleNotFoundError: If the module is not installed.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError('No module named {!r}'.format(name),
+                                  name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+# Third-party modules, and the HTTP server used by run_server, are only
+# imported when they are first used, so that the menu and help are shown
+# without waiting for them to load
+ad = import_lazy('custtools.admintools')
+ft = import_lazy('custtools.filetools')
+np = import_lazy('numpy')
+pd = import_lazy('pandas')
+simple_server = import_lazy('wsgiref.simple_server')
+
+# Analyses in menu order. Each has the name used in batch mode, its menu
+# title, help text, the data files it needs, the columns it reads from each
+# file and the name of the function that runs it. A function in another
+# module is given as 'module:function' and the module is only imported when
+# the analysis is run, so new analyses can be added here without changing the
+# menus. Only the listed columns are parsed into the cache for parallel batch
+# runs (every column of its files if an analysis has no 'columns'). Analyses
+# with 'batch' False are not run by name in batch mode, and those with
+# 'default' False are only run in batch mode when asked for.
+ANALYSES = [
+    {'name': 'age', 'title': 'Age Data', 'function': 'process_age_data',
+     'files': ['Student Data File'],
+     'columns': {'Student Data File': ['StudentPK', 'DateOfBirth',
+                                       'StartDate']},
+     'help': 'Average age of the students and the percentage and number of '
+             'students in each age band. Ages can be calculated as at today '
+             'or as at the enrolment start date.'},
+    {'name': 'location', 'title': 'Location Data',
+     'function': 'process_location_data', 'files': ['Student Data File'],
+     'columns': {'Student Data File': ['StudentPK', 'AddressCity',
+                                       'AddressCountry']},
+     'help': 'Percentage and number of students in each city.'},
+    {'name': 'ethnicity', 'title': 'Ethnicity Data',
+     'function': 'process_ethnicity_data', 'files': ['Student Data File'],
+     'columns': {'Student Data File': ['StudentPK', 'Ethnicity']},
+     'help': 'Percentage and number of students identifying each '
+             'ethnicity. Each Pacific Island nation is reported as Pacific '
+             'Island.'},
+    {'name': 'employment', 'title': 'Employment Data',
+     'function': 'process_employment_data', 'files': ['Student Data File'],
+     'columns': {'Student Data File': ['StudentPK', 'Employment']},
+     'help': 'Percentage and number of students in each employment '
+             'category.'},
+    {'name': 'reason', 'title': 'Study Reason Data',
+     'function': 'process_study_reason_data',
+     'files': ['Student Data File'],
+     'columns': {'Student Data File': ['StudentPK', 'ReasonForStudy']},
+     'help': 'Percentage and number of students identifying each study '
+             'reason category.'},
+    {'name': 'heard', 'title': 'How Heard Data',
+     'function': 'process_how_heard_data', 'files': ['Student Data File'],
+     'columns': {'Student Data File': ['StudentPK', 'HowHeard']},
+     'help': 'Percentage and number of students identifying each how heard '
+             'category.'},
+    {'name': 'length', 'title': 'Average Length of Study',
+     'function': 'process_study_length',
+     'files': ['Enrolments File', 'Graduates File'],
+     'columns': {'Enrolments File': ['EnrolmentPK', 'CourseFK', 'StartDate',
+                                     'Status'],
+                 'Graduates File': ['GraduatePK', 'EnrolmentPK',
+                                    'GraduationDate']},
+     'help': 'Count, mean, min, max and percentiles of the days of study of '
+             'graduates for each course type, e.g. ON in XXX-ON-XXX.'},
+    {'name': 'all_samples', 'title': 'All Samples Report',
+     'function': 'process_all_samples',
+     'files': ['Student Data File (All Students)', 'Graduates File'],
+     'columns': {'Student Data File': ['StudentPK', 'EnrolmentPK', 'Status',
+                                       'DateOfBirth', 'StartDate',
+                                       'AddressCity', 'AddressCountry',
+                                       'Ethnicity', 'Employment',
+                                       'ReasonForStudy', 'HowHeard'],
+                 'Graduates File': ['EnrolmentPK']},
+     'batch': False,
+     'help': 'Runs the Age, Location, Ethnicity, Employment, Study Reason '
+             'and How Heard analyses for every sample from a single All '
+             'Students Student Data File.'},
+    {'name': 'cube', 'title': 'Cross-tab Report',
+     'function': 'process_cube_data', 'files': ['Student Data File'],
+     'columns': {'Student Data File': ['StudentPK', 'DateOfBirth',
+                                       'StartDate', 'Ethnicity',
+                                       'AddressCity', 'AddressCountry',
+                                       'Employment', 'ReasonForStudy',
+                                       'HowHeard', 'CourseFK', 'Status']},
+     'default': False,
+     'help': 'Number and percentage of students with each combination of '
+             'values of the chosen dimensions, e.g. ethnicity by age band '
+             'by city, optionally filtered on the value of any dimension.'}]
+
+# Type of each known column in the data files. Columns not listed are loaded
+# as text.
+COLUMN_TYPES = {'StudentPK': 'int', 'StudentFK': 'int', 'EnrolmentPK': 'int',
+                'GraduatePK': 'int', 'TutorFK': 'int',
+                'DateOfBirth': 'date', 'StartDate': 'date',
+                'ExpiryDate': 'date', 'GraduationDate': 'date',
+                'Gender': 'category', 'AddressCity': 'category',
+                'AddressCountry': 'category', 'Ethnicity': 'category',
+                'CourseFK': 'category', 'Status': 'category',
+                'Employment': 'category', 'ReasonForStudy': 'category',
+                'HowHeard': 'category', 'Tag': 'category'}
+
+# Column headings of the Enrolments and Graduates Files
+ENROLMENT_HEADINGS = ['EnrolmentPK', 'StudentFK', 'CourseFK', 'TutorFK',
+                      'StartDate', 'ExpiryDate', 'Status', 'Tag']
+GRADUATE_HEADINGS = ['GraduatePK', 'EnrolmentPK', 'GraduationDate',
+                     'CertificateNumber']
+
+# Ethnicity groups and the file listing the ethnicities in each group. Each
+# ethnicity listed is reported as its group, e.g. each Pacific Island nation
+# as 'Pacific Island'. Other groups, e.g. 'Asian': 'asian_ethnicities.txt',
+# can be added in the same format.
+ETHNICITY_GROUPS = {'Pacific Island': 'pacific_island_nations.txt'}
+
+# Description of each categorical analysis of the Student Data File: the
+# column counted, its heading and file label, the value reported for blank
+# values (students with a blank value are not counted if None), any other
+# column values a student must have to be counted, and whether values are
+# reported as their group in ETHNICITY_GROUPS. The analyses run for a sample
+# are compiled into one plan by compile_plan, so the file is read and
+# duplicate students removed once for all of them.
+CATEGORICAL_SPECS = {
+    'location': {'column': 'AddressCity', 'heading': 'City',
+                 'label': 'Cities', 'blank': None,
+                 'filters': {'AddressCountry': 'New Zealand'}},
+    'ethnicity': {'column': 'Ethnicity', 'heading': 'Ethnicity',
+                  'label': 'Ethnicities', 'blank': None, 'grouped': True},
+    'employment': {'column': 'Employment', 'heading': 'Employment',
+                   'label': 'Employment', 'blank': 'Unknown'},
+    'reason': {'column': 'ReasonForStudy', 'heading': 'Study Reason',
+               'label': 'Study_Reason', 'blank': 'Unknown'},
+    'heard': {'column': 'HowHeard', 'heading': 'How Heard',
+              'label': 'How_Heard', 'blank': 'Unknown'}}
+
+# Dimensions of the cross-tab cube and the Student Data columns that each is
+# worked out from. Dimensions are named after the analysis that reports on
+# them on its own.
+CUBE_DIMENSIONS = {'age': ['DateOfBirth', 'StartDate'],
+                   'ethnicity': ['Ethnicity'],
+                   'location': ['AddressCity', 'AddressCountry'],
+                   'employment': ['Employment'],
+                   'reason': ['ReasonForStudy'],
+                   'heard': ['HowHeard'],
+                   'course': ['CourseFK'],
+                   'status': ['Status']}
+
+# Course type code in the middle of a course code, e.g. ON in XXX-ON-XXX
+COURSE_TYPE_PATTERN = re.compile(r'^.+?-([A-Z]{2})-.+$')
+
+# Length of study percentiles to report for each course type, and the width
+# in days of the histogram bins used to find them. Percentiles are exact when
+# the width is 1 day and are otherwise within half a bin of the exact value.
+LENGTH_PERCENTILES = [10, 25, 50, 75, 90]
+LENGTH_BIN_DAYS = 1
+
+# Optional limits on the items listed by the analyses without fixed
+# categories (e.g. cities). When TOP_ITEMS is set only that many items are
+# listed, and when MIN_PERCENT is set only items with at least that percentage
+# of students are listed. The remaining items are combined into an 'Other (n
+# categories)' item. Every item is listed when both are None.
+TOP_ITEMS = None
+MIN_PERCENT = None
+
+# Format that results are saved in. 'csv' saves each result to its own csv
+# file. 'xlsx' saves every result of a run to one workbook with a sheet for
+# each analysis and sample (requires openpyxl), and 'parquet' saves them to
+# one directory of Parquet files (requires pyarrow). Results are written by a
+# background thread so that the analyses do not wait for them to be saved.
+OUTPUT_FORMAT = 'csv'
+OUTPUT_FORMATS = ['csv', 'xlsx', 'parquet']
+
+# Optional streaming of the Student Data File. When enabled the file is read
+# in chunks sized to keep memory use to about STREAM_MEMORY_MB, for files that
+# are too large to load at once.
+USE_STREAMING = False
+STREAM_MEMORY_MB = 256
+
+# Optional incremental analysis. When enabled the results of each analysis
+# are saved with a record of the rows counted, and later runs only process the
+# rows that are new or have changed since then.
+USE_INCREMENTAL = False
+STATE_DIR = '.sda_state'
+# Increase when the saved results format changes so that old ones are not used
+STATE_VERSION = 1
+
+# Optional profiling of each analysis. When enabled the time, rows and peak
+# memory of each stage of an analysis are saved to json and csv files.
+PROFILE = False
+PROFILE_STAGES = ['load', 'project', 'dedupe', 'clean', 'transform',
+                  'aggregate', 'render', 'save']
+
+# Samples that the data can be taken from
+SAMPLES = ('All', 'Active', 'Expired', 'Maori', 'Pasifika', 'Graduated',
+           'Withdrawn', 'Other')
+
+# Optional cache of parsed data files. When enabled the parsed columns of each
+# data file are saved in a cache directory next to the file and later runs
+# load them from there instead of parsing the csv file again.
+USE_CACHE = False
+CACHE_DIR = '.sda_cache'
+CACHE_LIMIT_MB = 1024
+# Increase when the cache format changes so that old entries are not used
+CACHE_VERSION = 3
+
+# The results of each analysis can be kept in a result cache, so that the
+# same analysis of the same data is not calculated again. Results are kept in
+# RESULT_DIR next to the data file and are keyed by the contents of the data
+# files and the settings of the analysis. The least recently used results are
+# removed when they take up more than RESULT_LIMIT_MB, and results not used
+# for RESULT_MAX_DAYS days are removed.
+USE_RESULT_CACHE = False
+RESULT_DIR = '.sda_results'
+RESULT_LIMIT_MB = 64
+RESULT_MAX_DAYS = 30
+# Increase when the results change so that old results are not used
+RESULT_VERSION = 2
+
+# Address the analysis server listens on (see run_server) and how often it
+# checks the data files for changes, in seconds
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8765
+SERVER_POLL_SECONDS = 2
+
+
+def add_date_warnings(session, source, columns, warnings):
+    """Add a warning for each column of source that had invalid dates.
+    
+    Args:
+        session (dict): Data loaded in the current session, by source.
+        source (str): Name of the data file, e.g. 'Student Data File'.
+        columns (list): Date columns used by the analysis.
+        warnings (list): Warnings for the analysis, to be added to.
+        
+    Returns:
+        added (bool): Whether any warnings were added.
+    """
+    invalid_dates = session.get(source, {}).get('Invalid Dates', {})
+    added = False
+    for column in columns:
+        if column not in invalid_dates:
+            continue
+        invalid = invalid_dates[column]
+        examples = ', '.join('row {} ({})'.format(row, value) for row, value
+                             in zip(invalid['Rows'], invalid['Values']))
+        warnings.append('{} {} values in {} are not valid DD/MM/YYYY dates '
+                        'and were ignored, e.g. {}\n'.format(
+                        invalid['Count'], column, source, examples))
+        added = True
+    return added
+
+
+def build_cube(data, reference, ethnicity_groups, age_band_edges):
+    """Return the number of students with each combination of values.
+    
+    Each student is counted once, in a single grouped count over every
+    dimension in CUBE_DIMENSIONS. The values of each dimension are cleaned
+    as for the analysis of that dimension on its own, and students without
+    a value for a dimension are counted as 'Unknown'. Reports on any of the
+    dimensions can then be rolled up from the cube with rollup_cube.
+    
+    Args:
+        data (DataFrame): Student data with one row for each student and the
+        columns listed in CUBE_DIMENSIONS.
+        reference (str): 'Today' or 'Enrolment', the date to calculate ages
+        at.
+        ethnicity_groups (dict): Group of each grouped ethnicity, as returned
+        by get_ethnicity_groups.
+        age_band_edges (list): Lower age of each age band in ascending order.
+        
+    Returns:
+        cube (Series): Count of students for each combination of dimension
+        values, indexed by dimension.
+    """
+    ages = clean_age_data(data, reference)
+    age_bands = pd.Series(convert_ages(ages, age_band_edges,
+                                       generate_age_bands(age_band_edges)),
+                          index=ages.index)
+    values = {'age': age_bands,
+              'course': get_course_types(data['CourseFK']),
+              'status': data['Status']}
+    for name, spec in CATEGORICAL_SPECS.items():
+        values[name] = clean_category_data(data, spec, ethnicity_groups)
+    dimensions = pd.DataFrame({x: get_cube_values(values[x], data.index,
+                                                  sort=x != 'age')
+                               for x in CUBE_DIMENSIONS})
+    return dimensions.groupby(list(CUBE_DIMENSIONS), observed=True).size()
+
+
+def build_distribution(counts, categories=None, top=None, min_percent=None):
+    """Return the count and percentage of each item from item counts.
+    
+    Items are sorted by count (descending), and items with the same count
+    by item, unless categories is supplied.
+    
+    If top or min_percent is given (and categories is not) only the items
+    selected by select_top_items are listed, and the remaining items are
+    combined into a final 'Other (n categories)' item.
+    
+    Args:
+        counts (Series): Count of each item.
+        categories (list): Optional list of categories to report on, in the
+        order they are to be returned.
+        top (int): Optional maximum number of items to list.
+        min_percent (float): Optional minimum percentage of an item to be
+        listed.
+        
+    Returns:
+        distribution (DataFrame): Item, Percent and Count columns. The number
+        of distinct items counted is held in the 'Items' attribute, and the
+        number of them combined into the Other item in 'Other Items'.
+        total (int): Total number of items counted.
+    """
+    other = pd.Series([], dtype=np.int64)
+    if categories is not None:
+        counts = counts.reindex(categories, fill_value=0).astype(np.int64)
+        total = int(counts.to_numpy().sum())
+    else:
+        # Remove unused categories of categorical values and sort the rest
+        # by value rather than by category order
+        counts = counts[counts > 0].astype(np.int64)
+        if isinstance(counts.index, pd.CategoricalIndex):
+            counts.index = counts.index.astype(object)
+        total = int(counts.to_numpy().sum())
+        if top is not None or min_percent is not None:
+            counts, other = select_top_items(counts, total, top, min_percent)
+        counts = counts.sort_index(kind='stable').sort_values(
+                ascending=False, kind='stable')
+    items = counts.index.to_numpy(dtype=object)
+    item_counts = counts.to_numpy()
+    if len(other):
+        items = np.append(items, 'Other ({} categories)'.format(len(other)))
+        item_counts = np.append(item_counts, other.to_numpy().sum())
+    if total:
+        percents = np.round(item_counts / total * 100, 2)
+    else:
+        percents = np.zeros(len(item_counts))
+    distribution = pd.DataFrame({'Item': items, 'Percent': percents,
+                                 'Count': item_counts})
+    distribution.attrs['Items'] = len(counts) + len(other)
+    distribution.attrs['Other Items'] = len(other)
+    return distribution, total
+
+
+def build_key_index(values):
+    """Return an index of the rows holding each value of a key column.
+    
+    Rows are sorted by key, keeping the file order of the rows of each key,
+    so that the first row of a key is the row kept by drop_duplicates.
+    
+    Args:
+        values (Series): Key value of each row, e.g. StudentPK.
+        
+    Returns:
+        index (dict): Keys (each key, in ascending order), Order (rows with
+        a key, sorted by key), Starts (position in Order of the first row
+        of each key, followed by the length of Order) and Missing (first
+        row without a key, or -1).
+    """
+    missing = pd.Series(values).isna().to_numpy()
+    keys = pd.Series(values).to_numpy(dtype=np.int64, na_value=0)
+    order = np.flatnonzero(~missing)
+    order = order[np.argsort(keys[order], kind='stable')]
+    sorted_keys = keys[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    starts = np.flatnonzero(first)
+    return {'Keys': sorted_keys[starts], 'Order': order,
+            'Starts': np.append(starts, len(order)),
+            'Missing': int(missing.argmax()) if missing.any() else -1}
+
+
+def build_length_sketch(types, days, bin_days=LENGTH_BIN_DAYS):
+    """Return a length of study summary for each course type.
+    
+    The summary holds the count, sum, minimum and maximum of the days and a
+    histogram of the days in bins of bin_days days. Summaries can be combined
+    with merge_length_sketches and do not need the days themselves to give
+    percentiles. Missing days are ignored.
+    
+    Args:
+        types (Series): Course type of each graduate.
+        days (Series): Length of study in days of each graduate, with the
+        same index as types.
+        bin_days (int): Width of each histogram bin in days.
+        
+    Returns:
+        sketch (dict): Bin Days and the summary for each course type in
+        Types.
+    """
+    valid = days.notna().to_numpy()
+    data = pd.DataFrame({'Type': np.asarray(types)[valid],
+                         'Days': np.asarray(days)[valid].astype(np.int64)})
+    data['Bin'] = data['Days'] // bin_days
+    totals = data.groupby('Type')['Days'].agg(['count', 'sum', 'min', 'max'])
+    bins = data.groupby(['Type', 'Bin']).size()
+    sketch = {'Bin Days': bin_days, 'Types': {}}
+    for course_type, row in totals.iterrows():
+        sketch['Types'][course_type] = {'Count': int(row['count']),
+                                        'Sum': int(row['sum']),
+                                        'Min': int(row['min']),
+                                        'Max': int(row['max']),
+                                        'Bins': bins.loc[course_type]}
+    return sketch
+
+
+def build_sample_distributions(counts, categories=None, top=None,
+                               min_percent=None):
+    """Return the distribution of the counted values of each sample.
+    
+    Args:
+        counts (Series): Count of each value of each sample, as returned by
+        count_sample_values, or None if no values were counted.
+        categories (list): Optional list of categories to report on, in the
+        order they are to be returned.
+        top (int): Optional maximum number of items to list for each sample.
+        min_percent (float): Optional minimum percentage of an item to be
+        listed.
+        
+    Returns:
+        distributions (dict): Distribution and total for each sample in
+        SAMPLES, as returned by calculate_distribution, by sample.
+    """
+    if counts is None:
+        found = set()
+    else:
+        found = set(counts.index.get_level_values('Sample'))
+    distributions = {}
+    for sample in SAMPLES:
+        if sample in found:
+            sample_counts = counts.xs(sample, level='Sample')
+        else:
+            sample_counts = pd.Series([], dtype=np.int64)
+        distributions[sample] = build_distribution(sample_counts, categories,
+                                                   top, min_percent)
+    return distributions
+
+
+def cache_batch_files(tasks):
+    """Parse each data file used by a batch job into the cache.
+    
+    Each file is parsed once, however many tasks use it. Only the columns
+    read by the analyses of the tasks (see get_analysis_columns) are parsed,
+    or every column of the files of an analysis whose columns are not known.
+    
+    Args:
+        tasks (list): Description, session and function of each analysis.
+    """
+    headings = {'Student Data File': None,
+                'Enrolments File': ENROLMENT_HEADINGS,
+                'Graduates File': GRADUATE_HEADINGS}
+    names = {x['function'].split(':')[-1]: x['name'] for x in ANALYSES}
+    # Columns read from each file, by source and file
+    columns = {}
+    for _, session, function in tasks:
+        name = names.get(function.__name__)
+        if name is None:
+            continue
+        analysis_columns = get_analysis_columns(name)
+        for source in headings:
+            if source not in session:
+                continue
+            if headings[source] is None:
+                headings[source] = ft.load_headings('data_headings.txt')
+            if analysis_columns is None:
+                required = headings[source]
+            else:
+                required = analysis_columns.get(source, [])
+            key = (source, session[source]['File'])
+            file_columns = columns.setdefault(key, [])
+            file_columns.extend(x for x in required if x not in
+                                file_columns)
+    for (source, file_name), file_columns in columns.items():
+        if not file_columns:
+            continue
+        print('\nParsing {} into the cache.'.format(file_name))
+        load_columns(file_name, headings[source], file_columns,
+                     use_cache=True)
+
+
+def calculate_ages(birth_dates, reference_dates=None):
+    """Return the age in whole years at each reference date.
+    
+    Calculates every age in a single vectorized pass. If no reference dates
+    are supplied the age is calculated as at today.
+    
+    Args:
+        birth_dates (Series): Dates of birth as datetime64 values.
+        reference_dates (Series): Optional dates to calculate the age at,
+        e.g. the enrolment StartDate. Must have the same index as birth_dates.
+        
+    Returns:
+        ages (Series): Age in whole years for each date of birth.
+    """
+    if reference_dates is None:
+        today = pd.Timestamp.today()
+        ref_year = today.year
+        ref_day = today.month * 100 + today.day
+    else:
+        ref_year = reference_dates.dt.year
+        ref_day = reference_dates.dt.month * 100 + reference_dates.dt.day
+    birth_day = birth_dates.dt.month * 100 + birth_dates.dt.day
+    # Subtract a year if the birthday has not yet been reached
+    ages = ref_year - birth_dates.dt.year - (ref_day < birth_day).astype(int)
+    return ages
+
+
+def calculate_days(start_dates, end_dates):
+    """Return the number of days between each pair of dates.
+    
+    Args:
+        start_dates (Series): Start dates as datetime64 values.
+        end_dates (Series): End dates as datetime64 values, with the same
+        index as start_dates.
+        
+    Returns:
+        days (Series): Number of days from each start date to its end date.
+    """
+    return (end_dates - start_dates).dt.days
+
+
+def calculate_distribution(values, categories=None):
+    """Return the count and percentage of each item in values.
+    
+    Counts every item in a single vectorized pass and returns the results in
+    one DataFrame sorted by count (descending). If categories is supplied the
+    results are returned in the order of categories instead, with a count of
+    0 for any category that does not appear in values.
+    
+    Args:
+        values (Series): Values to be counted.
+        categories (list): Optional list of categories to report on, in the
+        order they are to be returned.
+        
+    Returns:
+        distribution (DataFrame): Item, Percent and Count columns.
+        total (int): Total number of items counted.
+    """
+    counts = pd.Series(values).value_counts(sort=False)
+    return build_distribution(counts, categories)
+
+
+def clean_age_data(data, reference):
+    """Return the age of each student that has a Date of Birth.
+    
+    Students without a Date of Birth (or without a StartDate if ages are
+    calculated at enrolment) are removed.
+    
+    Args:
+        data (DataFrame): Student data with DateOfBirth and StartDate columns.
+        reference (str): 'Today' or 'Enrolment', the date to calculate ages
+        at.
+        
+    Returns:
+        ages (Series): Age of each remaining student.
+    """
+    dob_col = 'DateOfBirth'
+    start_col = 'StartDate'
+    if reference == 'Enrolment':
+        data = data.dropna(subset=[dob_col, start_col])
+        return calculate_ages(data[dob_col], data[start_col])
+    data = data.dropna(subset=[dob_col])
+    return calculate_ages(data[dob_col])
+
+
+def clean_category_data(data, spec, ethnicity_groups=None):
+    """Return the values of a categorical analysis for each counted student.
+    
+    Students without the values required by the filters of the spec are
+    removed, as are students with a blank value if the spec has no blank
+    value. The values are kept as categories, so only the distinct values
+    are converted.
+    
+    Args:
+        data (DataFrame): Student data with the columns used by spec.
+        spec (dict): Analysis from CATEGORICAL_SPECS.
+        ethnicity_groups (dict): Group of each grouped ethnicity, as returned
+        by get_ethnicity_groups. Only used if spec is grouped.
+        
+    Returns:
+        values (Series): Categorical value of each remaining student.
+    """
+    values = data[spec['column']]
+    keep = None
+    filters = dict(spec.get('filters', {}))
+    if spec['blank'] is None:
+        filters[spec['column']] = None
+    for column, value in filters.items():
+        if value is None:
+            matches = data[column] != ''
+        else:
+            matches = data[column] == value
+        keep = matches if keep is None else keep & matches
+    if keep is not None:
+        values = values[keep]
+    values = values.astype('category')
+    groups = (ethnicity_groups or {}) if spec.get('grouped') else {}
+    lookup = [spec['blank'] if x == '' else groups.get(x, x) for x in
+              values.cat.categories] + [np.nan]
+    return map_categories(values, lookup)
+
+
+def clean_values(session, clean, data):
+    """Return the values of data cleaned by clean, profiled as a stage.
+    
+    Args:
+        session (dict): Data loaded in the current session, by source.
+        clean (function): Takes a DataFrame and returns the cleaned values.
+        data (DataFrame): Data to be cleaned.
+        
+    Returns:
+        values (Series): Cleaned values.
+    """
+    with profile_stage(session, 'clean', len(data)) as stage:
+        values = clean(data)
+        stage['Rows Out'] = len(values)
+    return values
+
+
+def close_writer(session):
+    """Shut down the background writer thread of a session, if it has one.
+    
+    Writes already submitted are finished first.
+    
+    Args:
+        session (dict): Data loaded in the current session, by source.
+    """
+    writer = session.pop('Writer', None)
+    if writer is not None:
+        writer.shutdown(wait=True)
+
+
+def compact_int_columns(data):
+    """Store each integer column of data in the smallest integer type.
+    
+    Integer keys are parsed as 64 bit nullable integers. Most keys fit in 32
+    bits or fewer, which halves the memory they use or better.
+    
+    Args:
+        data (DataFrame): Parsed data, changed in place.
+    """
+    for column in data.columns:
+        values = data[column]
+        if not pd.api.types.is_integer_dtype(values.dtype) or not len(
+                values):
+            continue
+        low = values.min()
+        high = values.max()
+        if pd.isna(low):
+            low = high = 0
+        for int_type in ('Int8', 'Int16', 'Int32'):
+            info = np.iinfo(int_type.lower())
+            if info.min <= low and high <= info.max:
+                data[column] = values.astype(int_type)
+                break
+
+
+def compile_plan(session, names):
+    """Return the plan for counting the values of categorical analyses.
+    
+    Each analysis in CATEGORICAL_SPECS is compiled into the columns it
+    reads and a function that cleans its values, for count_student_values.
+    
+    Args:
+        session (dict): Data loaded in the current session, by source.
+        names (list): Names of the analyses in CATEGORICAL_SPECS.
+        
+    Returns:
+        plan (dict): Columns, Clean function, Settings and whether the items
+        listed are limited (Limit) for each analysis, by name.
+    """
+    plan = {}
+    for name in names:
+        spec = CATEGORICAL_SPECS[name]
+        entry = {'Columns': get_analysis_columns(name)['Student Data File'],
+                 'Limit': True}
+        if spec.get('grouped'):
+            ethnicity_groups = get_ethnicity_groups(session)
+            entry['Settings'] = {'Ethnicity Groups': ethnicity_groups}
+        else:
+            ethnicity_groups = None
+        entry['Clean'] = functools.partial(clean_category_data, spec=spec,
+                                           ethnicity_groups=ethnicity_groups)
+        plan[name] = entry
+    return plan
+
+
+def confirm_session_files(session, source, required_files):
+    """Ask the user to confirm the required files are in place.
+    
+    Confirmation is skipped for batch sessions, which are given their files.
+    
+    Args:
+        session (dict): Data loaded in the current session, by source.
+        source (str): Name of the analysis requiring the files.
+        required_files (list): Names of the required files.
+    """
+    if not session.get('Batch'):
+        ad.confirm_files(source, required_files)
+
+
+def convert_ages(ages, age_band_edges, age_bands):
+    """Convert ages to the age band that each corresponds to.
+    
+    Finds the band for every age in a single vectorized pass using the lower
+    age of each band. Ages below the first band, e.g. from a Date of Birth
+    in the future, are not in any band and are left missing, so that they
+    are not counted.
+    
+    Args:
+        ages (Series): Age values.
+        age_band_edges (list): Lower age of each age band in ascending order,
+        e.g. [0, 18, 25, ...]. The final band has no upper limit.
+        age_bands (list): Name of each age band, in the same order as
+        age_band_edges.
+    
+    Returns:
+        converted_ages (Categorical): Age band for each age, missing for ages
+        below the first band.
+    """
+    # Code -1 is a missing value
+    positions = np.searchsorted(np.asarray(age_band_edges),
+                                np.asarray(ages), side='right') - 1
+    converted_ages = pd.Categorical.from_codes(positions,
+                                               categories=age_bands)
+    return converted_ages
+
+
+def count_incremental_values(session, name, entry, frames):
+    """Return the counts of an analysis updated from its saved counts.
+    
+    The counts are saved with the value counted for each student, and only
+    students that are new or whose data has changed since the counts were
+    saved are cleaned and counted again.
+    
+    Args:
+        session (dict): Data loaded in the current session, by source.
+        name (str): Name of the analysis, e.g. 'location'.
+        entry (dict): Columns, Clean function and Settings of the analysis.
+        frames (iterable): DataFrames holding the entry columns of the
+        current students, each student appearing once only.
+        
+    Returns:
+        counts (Series): Count of each item.
+    """
+    sid_col = 'StudentPK'
+    clean = entry['Clean']
+    state_name = get_state_file(session['Student Data File']['File'], name,
+                                session.get('Sample'))
+    with profile_stage(session, 'load'):
+        state = load_state(state_name, entry['Columns'], entry.get('Settings'),
+                           session.get('Rebuild', False))
+    items = state['Items']
+    with profile_stage(session, 'transform'):
+        state, removed, added = merge_incremental_rows(state, frames,
+                sid_col, lambda frame: {'Codes': encode_values(
+                clean_values(session, clean, frame), frame.index, items)})
+    with profile_stage(session, 'aggregate', len(added['Codes'])):
+        counts = np.zeros(len(items), dtype=np.int64)
+        counts[:len(state['Counts'])] = state['Counts']
+        counts -= np.bincount(removed['Codes'][removed['Codes'] >= 0],
+                              minlength=len(items))
+        counts += np.bincount(added['Codes'][added['Codes'] >= 0],
+                              minlength=len(items))
+        state['Counts'] = counts
+    with profile_stage(session, 'save'):
+        save_state(state_name, state)
+    return pd.Series(counts, index=pd.Index(items))
+
+
+def count_sample_values(samples, values, counts=None):
+    """Return the count of each value of each sample.
+    
+    Args:
+        samples (Series): Sample that each value belongs to.
+        values (Series): Values to be counted, with the same index as samples.
+        counts (Series): Optional counts of earlier values to be added to.
+        
+    Returns:
+        counts (Series): Count of each value, indexed by Sample and Item.
+    """
+    new_counts = pd.DataFrame({'Sample': samples, 'Item': values}).groupby(
+            ['Sample', 'Item'], observed=True, sort=False).size()
+    if counts is None:
+        return new_counts
+    return pd.concat([counts, new_counts]).groupby(level=['Sample', 'Item'],
+            observed=True, sort=False).sum()
+
+
+def count_student_values(session, plan):
+    """Return the distribution of cleaned Student Data values of analyses.
+    
+    The Student Data File is read and duplicate Student ID Numbers removed
+    (keeping the first row for each student) once for every analysis in the
+    plan, then the Clean function of each analysis is applied to get the
+    values to be counted. If the session is streaming the file is read in
+    chunks and the counts of each chunk are combined, giving the same result
+    as loading the whole file.
+    
+    If the session is incremental each analysis is updated from its own
+    saved counts (see count_incremental_values). When also streaming, the
+    file is read once for each analysis.
+    
+    Unless the analysis has Categories, the items listed are limited by the
+    Top Items and Min Percent of the session if its Limit is set (see
+    build_distribution).
+    
+    If the session uses the result cache, analyses whose distribution is in
+    the cache are not counted again, and the file is only read for the rest.
+    
+    Args:
+        session (dict): Data loaded in the current session, by source.
+        plan (dict): Columns (including StudentPK), Clean function (takes a
+        DataFrame of student data and returns the values to be counted),
+        and optionally Categories (to report on, in order), Settings (that
+        Clean depends on, saved counts made with different settings are not
+        used) and Limit of each analysis, by name.
+        
+    Returns:
+        distributions (dict): Distribution (Item, Percent and Count
+        columns) and total number of items counted of each analysis, by
+        name.
+    """
+    sid_col = 'StudentPK'
+    top = session.get('Top Items', TOP_ITEMS)
+    min_percent = session.get('Min Percent', MIN_PERCENT)
+    stream = session.get('Stream', USE_STREAMING)
+    # Take the distributions in the result cache and count the rest
+    entries = {}
+    cached = {}
+    if session.get('Result Cache', USE_RESULT_CACHE):
+        if 'Student Data Headings' not in session:
+            session['Student Data Headings'] = ft.load_headings(
+                    'data_headings.txt')
+        for name, entry in plan.items():
+            parameters = {'Columns': entry['Columns'],
+                          'Settings': entry.get('Settings'),
+                          'Categories': entry.get('Categories'),
+                          'Spec': CATEGORICAL_SPECS.get(name),
+                          'Headings': session['Student Data Headings'],
+                          'Column Types': COLUMN_TYPES}
+            if entry.get('Limit'):
+                parameters.update({'Top Items': top,
+                                   'Min Percent': min_percent})
+            entries[name] = get_result_entry(session, name,
+                    ['Student Data File'], parameters)
+            result = load_cached_result(session, entries[name])
+            if result is not None:
+                distribution = pd.DataFrame({
+                        'Item': np.array(result['Item'], dtype=object),
+                        'Percent': np.array(result['Percent'], dtype=float),
+                        'Count': np.array(result['Count'], dtype=np.int64)})
+                distribution.attrs.update(result['Attrs'])
+                cached[name] = (distribution, result['Total'])
+        plan = {x: y for x, y in plan.items() if x not in cached}
+        if not plan:
+            return cached
+    # Columns of every analysis, read in a single pass
+    columns = list(dict.fromkeys(x for entry in plan.values() for x in
+                                 entry['Columns']))
+    if not stream:
+        data = get_student_data(session, columns)
+        with profile_stage(session, 'dedupe', len(data)) as stage:
+            index = get_key_index(session, 'Student Data File',
+                                  session['Student Data Headings'], sid_col)
+            data = data.take(get_first_rows(index))
+            stage['Rows Out'] = len(data)
+    if not session.get('Incremental', USE_INCREMENTAL):
+        counts = {x: pd.Series([], dtype=np.int64) for x in plan}
+        frames = stream_student_data(session, columns) if stream else [data]
+        for frame in frames:
+            for name, entry in plan.items():
+                values = clean_values(session, entry['Clean'], frame)
+                with profile_stage(session, 'aggregate', len(values)):
+                    frame_counts = pd.Series(values).value_counts(sort=False)
+                    counts[name] = counts[name].add(frame_counts,
+                                                    fill_value=0)
+    else:
+        counts = {}
+        for name, entry in plan.items():
+            if stream:
+                frames = stream_student_data(session, entry['Columns'])
+            else:
+                frames = [data[entry['Columns']]]
+            counts[name] = count_incremental_values(session, name, entry,
+                                                    frames)
+    distributions = {}
+    for name, entry in plan.items():
+        with profile_stage(session, 'aggregate') as stage:
+            if entry.get('Limit'):
+                distributions[name] = build_distribution(counts[name],
+                        entry.get('Categories'), top, min_percent)
+            else:
+                distributions[name] = build_distribution(counts[name],
+                        entry.get('Categories'))
+            stage['Rows Out'] = len(distributions[name][0])
+        if name in entries:
+            distribution, total = distributions[name]
+            save_cached_result(session, entries[name], {
+                    'Item': [x.item() if isinstance(x, np.generic) else x
+                             for x in distribution['Item']],
+                    'Percent': distribution['Percent'].tolist(),
+                    'Count': distribution['Count'].tolist(),
+                    'Attrs': distribution.attrs, 'Total': total},
+                    {'Student Data File': entry['Columns']})
+    return dict(cached, **distributions)
+
+
+def encode_values(values, index, items):
+    """Return the position in items of the value for each row.
+    
+    Values that are not already in items are added to the end of items.
+    
+    Args:
+        values (Series): Value for each row that has one, indexed by row.
+        index (Index): Index of every row.
+        items (list): Items found so far, to be added to.
+        
+    Returns:
+        codes (array): Position in items of the value of each row in index,
+        or -1 for rows without a value.
+    """
+    values = pd.Series(values)
+    value_codes = pd.Index(items).get_indexer(values)
+    if (value_codes < 0).any():
+        items.extend(pd.unique(values[value_codes < 0]).tolist())
+        value_codes = pd.Index(items).get_indexer(values)
+    codes = np.full(len(index), -1, dtype=np.int64)
+    codes[index.get_indexer(values.index)] = value_codes
+    return codes
+
+
+def evict_cache(cache_root, limit_mb, keep=None, max_days=None):
+    """Remove the least recently used cache entries until under the limit.
+    
+    Args:
+        cache_root (str): Cache directory holding the cache entries.
+        limit_mb (int): Maximum size of the cache in megabytes.
+        keep (str): Optional cache entry directory that is not to be removed.
+        max_days (float): Optional age in days of the entries to be removed
+        however large the cache is.
+    """
+    entries = []
+    total = 0
+    for name in os.listdir(cache_root):
+        path = os.path.join(cache_root, name)
+        if not os.path.isdir(path):
+            continue
+        size = sum(os.path.getsize(os.path.join(path, x))
+                   for x in os.listdir(path))
+        entries.append((os.path.getmtime(path), size, path))
+        total += size
+    oldest = time.time() - max_days * 86400 if max_days is not None else None
+    # Remove the oldest entries first
+    for last_used, size, path in sorted(entries):
+        expired = oldest is not None and last_used < oldest
+        if total <= limit_mb * 1024 * 1024 and not expired:
+            break
+        if path == keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def filter_new_keys(keys, seen):
+    """Return which rows have a key not seen before, marking them as seen.
+    
+    Keys already seen, e.g. in earlier chunks of a file, are held in a bitmap
+    indexed by key. Only the first row without a key is treated as new.
+    
+    Args:
+        keys (Series): Key of each row, each key appearing once only.
+        seen (dict): Bitmap of the keys seen, and whether a row without a key
+        (Missing) has been seen, to be updated.
+        
+    Returns:
+        new (array): Whether each row has a key not seen before.
+    """
+    missing = keys.isna().to_numpy()
+    ids = keys.to_numpy(dtype=np.int64, na_value=0)
+    if len(ids) and ids.max() >= len(seen['Bitmap']):
+        size = max(ids.max() + 1, 2 * len(seen['Bitmap']))
+        seen['Bitmap'] = np.concatenate([seen['Bitmap'], np.zeros(
+                size - len(seen['Bitmap']), dtype=bool)])
+    new = ~missing & ~seen['Bitmap'][ids]
+    seen['Bitmap'][ids[new]] = True
+    if missing.any():
+        if not seen['Missing']:
+            new[np.flatnonzero(missing)[0]] = True
+        seen['Missing'] = True
+    return new
+
+
+def find_key_rows(index, keys):
+    """Return the first row of each key, as found in a key index.
+    
+    Args:
+        index (dict): Key index, as returned by build_key_index.
+        keys (Series): Keys to be found.
+        
+    Returns:
+        rows (array): First row of each key, or -1 for keys that are
+        missing or not in the index.
+    """
+    keys = pd.Series(keys)
+    if not len(index['Keys']):
+        return np.full(len(keys), -1, dtype=np.int64)
+    missing = keys.isna().to_numpy()
+    keys = keys.to_numpy(dtype=np.int64, na_value=0)
+    # Keys after the last key of the index are compared with the last key
+    positions = np.minimum(np.searchsorted(index['Keys'], keys),
+                           len(index['Keys']) - 1)
+    found = (index['Keys'][positions] == keys) & ~missing
+    return np.where(found, index['Order'][index['Starts'][positions]], -1)
+
+
+def flush_results(session):
+    """Wait until the results saved by an analysis have been written.
+    
+    Results kept to be written to a single file (xlsx and parquet formats)
+    are written first, except for batch analyses, whose results are written
+    together by run_batch once every analysis has finished.
+    
+    Args:
+        session (dict): Data loaded in the current session, by source.
+    """
+    f_name = None
+    if not session.get('Batch') and session.get('Results'):
+        f_name = get_output_name(session, 'Results_{}'.format(
+                ft.generate_time_string()))
+        output_format = session.get('Output Format', OUTPUT_FORMAT)
+        if output_format == 'xlsx':
+            f_name += '.xlsx'
+        submit_write(session, write_results, session.pop('Results'), f_name,
+                     output_format)
+    # Wait for every write, then raise the first error from writing the
+    # results after reporting any others
+    errors = []
+    for write in session.pop('Writes', []):
+        try:
+            write.result()
+        except Exception as e:
+            errors.append(e)
+    for e in errors[1:]:
+        print('\nResults could not be saved: {}'.format(e))
+    if errors:
+        raise errors[0]
+    if f_name:
+        print('\nResults saved to {}'.format(f_name))
+
+
+def generate_age_bands(age_band_edges):
+    """Return the name of each age band.
+    
+    Args:
+        age_band_edges (list): Lower age of each age band in ascending order.
+        
+    Returns:
+        age_bands (list): Age band names, e.g. ['0-17', '18-24', ..., '65+'].
+    """
+    age_bands = []
+    for lower, upper in zip(age_band_edges, age_band_edges[1:]):
+        age_bands.append('{}-{}'.format(lower, upper - 1))
+    age_bands.append('{}+'.format(age_band_edges[-1]))
+    return age_bands
+
+
+def get_age_reference():
+    """Return user input for the date that ages are calculated at.
+    
+    Returns:
+        reference (str): 'Today' or 'Enrolment'.
+    """
+    repeat = True
+    high = 2
+    while repeat:
+        print('\nPlease enter the number for the date to calculate ages at:\n')
+        print('1: Today')
+        print('2: Enrolment Start Date')
+        try:
+            action = int(input('\nPlease enter the number for your '
+                               'selection --> '))
+        except ValueError:
+            print('Please enter a number between 1 and {}.'.format(high))
+        else:
+            if action < 1 or action > high:
+                print('\nPlease select from the available options (1 - {})'
+                      .format(high))
+            elif action == 1:
+                return 'Today'
+            elif action == 2:
+                return 'Enrolment'
+
+
+def get_analysis_columns(name):
+    """Return the columns that an analysis reads from each data file.
+    
+    Args:
+        name (str): Name of the analysis in ANALYSES.
+        
+    Returns:
+        columns (dict): Columns read, by source, or None if the analysis
+        does not list them.
+    """
+    analyses = {x['name']: x for x in ANALYSES}
+    return analyses[name].get('columns')
+
+
+def get_analysis_function(function_name):
+    """Return the function that runs an analysis.
+    
+    Args:
+        function_name (str): Name of a function in this module, or
+        'module:function' for a function in another module, which is
+        imported if it has not been already.
+        
+    Returns:
+        function (function): Function that runs the analysis for a session.
+    """
+    if ':' in function_name:
+        module_name, function_name = function_name.split(':')
+        return getattr(importlib.import_module(module_name), function_name)
+    return globals()[function_name]
+
+
+def get_batch_analyses():
+    """Return the analyses that can be run in batch mode.
+    
+    Returns:
+        analyses (dict): Analysis from ANALYSES, by analysis name.
+    """
+    return {x['name']: x for x in ANALYSES if x.get('batch', True)}
+
+
+def get_batch_tasks(job):
+    """Return each analysis to be run for a batch job.
+    
+    Tasks for the same sample share a session, so that each data file is
+    only loaded once when the tasks are run in turn. When the job has more
+    than one worker the All Samples report is split into a task for each
+    analysis so that the analyses can be run in parallel.
+    
+    Args:
+        job (dict): Batch job as returned by load_batch_job.
+        
+    Returns:
+        tasks (list): Description, session and function of each analysis.
+        failures (int): Number of analyses that cannot be run.
+    """
+    analyses = get_batch_analyses()
+    sources = [('Student Data File', 'student_data'),
+               ('Enrolments File', 'enrolments'),
+               ('Graduates File', 'graduates')]
+    settings = {'Batch': True, 'Output Dir': job['output_dir'],
+                'Age Reference': job['age_reference'],
+                'Use Cache': job['cache'], 'Stream': job['stream'],
+                'Stream Memory': job['stream_memory'],
+                'Incremental': job['incremental'] or job['rebuild'],
+                'Rebuild': job['rebuild'], 'Profile': job['profile'],
+                'Result Cache': job['result_cache'],
+                'Top Items': job['top'], 'Min Percent': job['min_percent'],
+                'Cube Dimensions': job['cube_dimensions'],
+                'Cube Filters': job['cube_filters'],
+                'Output Format': job['output_format']}
+    tasks = []
+    failures = 0
+    unknown = [x for x in job['analyses'] if x not in analyses]
+    for name in unknown:
+        print('\nUnknown analysis {} skipped.'.format(name))
+    failures += len(unknown)
+    names = [x for x in job['analyses'] if x in analyses]
+    if 'cube' in names and not job['cube_dimensions']:
+        print('\nSkipping cube analysis. Missing: cube dimensions')
+        failures += len(job['samples'])
+        names.remove('cube')
+    if job.get('all_samples'):
+        files = job['all_samples']
+        all_names = [x for x in names if x not in ('length', 'cube')]
+        if not files.get('student_data'):
+            print('\nSkipping All Samples report. Missing: Student Data '
+                  'File')
+            failures += len(all_names)
+            all_names = []
+        if job.get('workers', 1) > 1:
+            groups = [[x] for x in all_names]
+        else:
+            groups = [all_names] if all_names else []
+        for group in groups:
+            session = dict(settings, Analyses=group)
+            for source, key in sources:
+                if files.get(key):
+                    session[source] = {'File': files[key],
+                                       'Fingerprint': None, 'Data': None}
+            tasks.append(('{} for all samples'.format(', '.join(group)),
+                          session, process_all_samples))
+    if job.get('length_sketches'):
+        session = dict(settings, **{'Length Sketches':
+                                    job['length_sketches']})
+        tasks.append(('Length of study summaries', session,
+                      process_length_sketches))
+    for sample_job in job['samples']:
+        sample = sample_job['sample']
+        if sample not in SAMPLES:
+            print('\nUnknown sample {} skipped.'.format(sample))
+            failures += len(names)
+            continue
+        session = dict(settings, Sample=sample)
+        for source, key in sources:
+            if sample_job.get(key):
+                session[source] = {'File': sample_job[key],
+                                   'Fingerprint': None, 'Data': None}
+        # Analyses run in turn on a shared session are counted together
+        if job.get('workers', 1) == 1:
+            session['Analyses'] = []
+        for name in names:
+            missing = [x for x in analyses[name]['files'] if x not in
+                       session]
+            if missing:
+                print('\nSkipping {} analysis for {} sample. Missing: {}'
+                      .format(name, sample, ', '.join(missing)))
+                failures += 1
+                continue
+            tasks.append(('{} analysis for {} sample'.format(name, sample),
+                          session, get_analysis_function(
+                          analyses[name]['function'])))
+            if 'Analyses' in session:
+                session['Analyses'].append(name)
+    return tasks, failures
+
+
+def get_cache_entry_dir(file_name, headings):
+    """Return the cache directory for the current contents of a data file.
+    
+    Cache entries are keyed by a hash of the file contents and of the file
+    schema (headings and column types), so any change to either uses a new
+    entry. Entries for earlier versions of the file are removed.
+    
+    Args:
+        file_name (str): Name of the data file.
+        headings (list): Column headings for the file.
+        
+    Returns:
+        entry_dir (str): Cache entry directory for the file.
+    """
+    cache_root = os.path.join(os.path.dirname(os.path.abspath(file_name)),
+                              CACHE_DIR)
+    os.makedirs(cache_root, exist_ok=True)
+    base_name = os.path.basename(file_name)
+    file_hash = get_file_hash(file_name, cache_root)
+    schema = json.dumps([CACHE_VERSION, list(headings),
+                         sorted(COLUMN_TYPES.items())])
+    schema_hash = hashlib.sha256(schema.encode('utf-8')).hexdigest()
+    entry_name = '{}-{}-{}'.format(base_name, file_hash[:16], schema_hash[:8])
+    # Remove stale entries for the same file
+    stale = re.compile(re.escape(base_name) + '-[0-9a-f]{16}-[0-9a-f]{8}$')
+    for name in os.listdir(cache_root):
+        if name != entry_name and stale.match(name):
+            shutil.rmtree(os.path.join(cache_root, name), ignore_errors=True)
+    entry_dir = os.path.join(cache_root, entry_name)
+    os.makedirs(entry_dir, exist_ok=True)
+    # Mark entry as used for the eviction policy
+    os.utime(entry_dir)
+    return entry_dir
+
+
+def get_category_distribution(session, name, warnings):
+    """Return the distribution of the values of a categorical analysis.
+    
+    The analysis is counted together with the other categorical analyses to
+    be run for the session (its Analyses) in a single plan. The
+    distributions of the other analyses are kept in the session until they
+    are run. Another analysis that cannot be compiled because a file it
+    needs is missing or unreadable is added to warnings and left to fail
+    when it is run.
+    
+    Args:
+        session (dict): Data loaded in the current session, by source.
+        name (str): Name of the analysis in CATEGORICAL_SPECS.
+        warnings (list): Warnings for the analysis, to be added to.
+        
+    Returns:
+        distribution (DataFrame): Item, Percent and Count columns.
+        total (int): Total number of items counted.
+    """
+    distributions = session.setdefault('Distributions', {})
+    if name not in distributions:
+        plan = compile_plan(session, [name])
+        for other in session.get('Analyses', []):
+            if other in CATEGORICAL_SPECS and other not in plan:
+                try:
+                    plan.update(compile_plan(session, [other]))
+                except OSError as error:
+                    warnings.append('The {} analysis could not be counted '
+                                    'with this analysis and is counted when '
+                                    'it is run: {}\n'.format(other, error))
+        distributions.update(count_student_values(session, plan))
+    return distributions.pop(name)
+
+
+def get_chunk_rows(file_name, memory_mb):
+    """Return the number of rows to read in each chunk of a csv file.
+    
+    The number of rows is estimated from the average length of the first
+    lines of the file, allowing several times the size of each line for the
+    parsed data.
+    
+    Args:
+        file_name (str): Name of the csv file.
+        memory_mb (int): Memory to be used for each chunk in megabytes.
+        
+    Returns:
+        chunk_rows (int): Number of rows in each chunk.
+    """
+    with open(file_name, 'rb') as f:
+        sample = f.read(64 * 1024)
+    line_bytes = len(sample) / max(sample.count(b'\n'), 1)
+    chunk_rows = int(memory_mb * 1024 * 1024 / (line_bytes * 8))
+    return max(chunk_rows, 1000)
+
+
+def get_course_types(course_codes):
+    """Return the course type of each course code.
+    
+    The course type is the two letter code in the middle of the course code,
+    e.g. 'ON' for XXX-ON-XXX. The pattern is only matched once for each
+    distinct course code rather than for every enrolment.
+    
+    Args:
+        course_codes (Series): Code for the course of each enrolment.
+        
+    Returns:
+        course_types (Series): Categorical two letter course type code, or ''
+        if the course code does not contain one.
+    """
+    codes = course_codes.astype('category')
+    types = codes.cat.categories.to_series().astype(str).str.extract(
+            COURSE_TYPE_PATTERN, expand=False).fillna('')
+    # Last item is used for missing course codes
+    lookup = np.append(types.to_numpy(dtype=object), '')
+    return map_categories(codes, lookup)
+
+
+def get_csv_fname(source):
+    """Return the name of a csv file to be loaded.
+    
+    Asks the user for the name of the file. If no name is entered the Open
+    file dialog is displayed.
+    
+    Args:
+        source (str): Name of the file being requested, e.g. 'Student Data
+        File'.
+        
+    Returns:
+        file_name (str): Name of the csv file.
+    """
+    repeat = True
+    while repeat:
+        file_name = input('\nEnter the name of the {} or press enter to '
+                          'select the file --> '.format(source))
+        if file_name == '':
+            from tkinter import Tk, filedialog
+            root = Tk()
+            root.withdraw()
+            file_name = filedialog.askopenfilename(title=source, filetypes=
+                    [('CSV files', '*.csv'), ('All files', '*.*')])
+            root.destroy()
+        elif not file_name.endswith('.csv'):
+            file_name = file_name + '.csv'
+        if os.path.isfile(file_name):
+            return file_name
+        print('\nFile {} could not be found. Please try again.'.format(
+                file_name))
+
+
+def get_csv_read_options(file_name, headings, columns):
+    """Return the read_csv options for loading columns of a data file.
+    
+    Each column is given the type listed for it in COLUMN_TYPES. Date columns
+    are read as text, to be converted with parse_dates. If the first row of
+    the file contains the headings it is skipped.
+    
+    Args:
+        file_name (str): Name of the csv file.
+        headings (list): Column headings for the file.
+        columns (list): Columns to be loaded.
+        
+    Returns:
+        options (dict): Keyword arguments for read_csv.
+        date_cols (list): Date columns to be converted after reading.
+    """
+    with open(file_name, newline='') as f:
+        first_row = next(csv.reader(f), [])
+    skip_rows = 1 if first_row == list(headings) else 0
+    dtypes = {}
+    na_values = {}
+    date_cols = []
+    for column in columns:
+        col_type = COLUMN_TYPES.get(column, 'text')
+        if col_type == 'int':
+            dtypes[column] = 'Int64'
+            na_values[column] = ['']
+        elif col_type == 'date':
+            dtypes[column] = str
+            date_cols.append(column)
+        elif col_type == 'category':
+            dtypes[column] = 'category'
+        else:
+            dtypes[column] = str
+    options = {'header': None, 'names': headings, 'usecols': columns,
+               'dtype': dtypes, 'na_values': na_values,
+               'keep_default_na': False, 'skiprows': skip_rows}
+    return options, date_cols
+
+
+def get_cube(session, reference):
+    """Return the cross-tab cube for the Student Data File of a session.
+    
+    The cube is built once and kept in the session with any roll-ups of it.
+    It is built again if the Student Data File, the date ages are calculated
+    at, the age bands or the ethnicity groups change. If the session is
+    streaming the file is read in chunks and the cubes of each chunk are
+    merged, giving the same cube as loading the whole file.
+    
+    Args:
+        session (dict): Data loaded in the current session, by source.
+        reference (str): 'Today' or 'Enrolment', the date to calculate ages
+        at.
+        
+    Returns:
+        cube (dict): Counts of the cube, as returned by build_cube, and the
+        Rollups made from it.
+    """
+    sid_col = 'StudentPK'
+    source = 'Student Data File'
+    columns = get_analysis_columns('cube')[source]
+    stream = session.get('Stream', USE_STREAMING)
+    if stream:
+        if source not in session:
+            session[source] = {'File': get_csv_fname(source),
+                               'Fingerprint': None, 'Data': None}
+    else:
+        data = get_student_data(session, columns)
+    ethnicity_groups = get_ethnicity_groups(session)
+    age_band_edges = load_age_band_edges()
+    key = [session[source]['File'],
+           get_file_fingerprint(session[source]['File']), reference,
+           age_band_edges, ethnicity_groups]
+    if reference == 'Today':
+        key.append(str(pd.Timestamp.today().date()))
+    cube = session.get('Cube')
+    if cube is not None and cube['Key'] == key:
+        return cube
+    if stream:
+        counts = None
+        for chunk in stream_student_data(session, columns):
+            with profile_stage(session, 'aggregate', len(chunk)) as stage:
+                chunk_counts = build_cube(chunk, reference, ethnicity_groups,
+                                          age_band_edges)
+                if counts is None:
+                    counts = chunk_counts
+                else:
+                    counts = merge_cubes([counts, chunk_counts],
+                                         age_band_edges)
+                stage['Rows Out'] = len(counts)
+    else:
+        with profile_stage(session, 'dedupe', len(data)) as stage:
+            index = get_key_index(session, source,
+                                  session['Student Data Headings'], sid_col)
+            data = data.take(get_first_rows(index))
+            stage['Rows Out'] = len(data)
+        with profile_stage(session, 'aggregate', len(data)) as stage:
+            counts = build_cube(data, reference, ethnicity_groups,
+                                age_band_edges)
+            stage['Rows Out'] = len(counts)
+    cube = {'Key': key, 'Counts': counts, 'Rollups': {}}
+    session['Cube'] = cube
+    return cube
+
+
+def get_cube_dimensions():
+    """Return user input for the dimensions of a cross-tab report.
+    
+    Returns:
+        dimensions (list): Dimensions from CUBE_DIMENSIONS, in the order
+        entered.
+    """
+    while True:
+        print('\nAvailable dimensions: {}'.format(', '.join(CUBE_DIMENSIONS)))
+        dimensions = input('\nEnter the dimensions to report on, separated '
+                           'by spaces --> ').split()
+        if dimensions and all(x in CUBE_DIMENSIONS for x in dimensions):
+            return list(dict.fromkeys(dimensions))
+        print('\nPlease enter one or more of the available dimensions.')
+
+
+def get_cube_filters():
+    """Return user input for the values to filter a cross-tab report on.
+    
+    Returns:
+        filters (dict): Value to filter on, by dimension.
+    """
+    while True:
+        entered = input('\nEnter any filters as dimension=value separated by '
+                        'commas (e.g. course=PT), or press enter for '
+                        'none --> ')
+        try:
+            return parse_cube_filters([x for x in entered.split(',')
+                                       if x.strip()])
+        except ValueError as e:
+            print('\n{}'.format(e))
+
+
+def get_cube_values(values, index, sort=True):
+    """Return the values of a cube dimension for every student.
     
     Args:
-        source_dict (dict): Dictionary that has int for each key value.
+        values (Series): Cleaned values for the students that have one.
+        index (Index): Index of every student.
+        sort (bool): Whether to sort the values, rather than keep the order
+        of their categories (e.g. age bands).
         
     Returns:
-        percentage_dict (dict): Dictionary holding the % of each key value.
-        total (int): Total number of students in sample.
+        cube_values (Series): Categorical value for every student, with
+        missing and empty values set to 'Unknown' and placed last.
     """
-    # Create a copy of the source_dict with each key value set to 0
-    percent_dict = ad.copy_dict_reset(source_dict)
-    # Get the total of all key values
-    total = total_dict_values(source_dict)
-    # Get percentage for each key value
-    for key, value in source_dict.items():
-        if ad.check_is_int(value):
-            percent_dict[key] = round(((value/total)*100), 2)
-    return percent_dict, total
+    values = values.astype('category').reindex(index)
+    categories = values.cat.categories.to_numpy(dtype=object)
+    lookup = np.append(np.where(categories == '', 'Unknown', categories),
+                       'Unknown')
+    values = map_categories(values, lookup)
+    categories = [x for x in values.cat.categories if x != 'Unknown']
+    if sort:
+        categories = sorted(categories)
+    if len(categories) < len(values.cat.categories):
+        categories.append('Unknown')
+    return values.cat.reorder_categories(categories)
+
+
+def get_ethnicity_groups(session):
+    """Return the group of each ethnicity listed in ETHNICITY_GROUPS.
     
+    The group files are compiled into a lookup table once per session. The
+    table is compiled again if any of the files has changed on disk.
+    
+    Args:
+        session (dict): Data loaded in the current session.
+        
+    Returns:
+        ethnicity_groups (dict): Group of each grouped ethnicity.
+    """
+    fingerprint = [(f_name, get_file_fingerprint(f_name)) for f_name in
+                   ETHNICITY_GROUPS.values()]
+    compiled = session.get('Ethnicity Groups')
+    if compiled is None or compiled['Fingerprint'] != fingerprint:
+        ethnicity_groups = {}
+        for group, f_name in ETHNICITY_GROUPS.items():
+            for ethnicity in ft.load_headings(f_name):
+                # An ethnicity listed for more than one group is kept in the
+                # first group
+                ethnicity_groups.setdefault(ethnicity, group)
+        compiled = {'Fingerprint': fingerprint,
+                    'Lookup': ethnicity_groups}
+        session['Ethnicity Groups'] = compiled
+    return compiled['Lookup']
+
 
-def combine_lists(percent_list, count_list):
-    """Combine Percent and Count lists into a single list.
+def get_file_fingerprint(file_name):
+    """Return a value that changes whenever a file is changed on disk.
     
     Args:
-        percent_list (list): Item and percent columns.
-        count_list (list): Item and count columns.
+        file_name (str): Name of the file.
         
     Returns:
-        combined (list): List with Item, Percent and Count columns.
+        fingerprint (tuple): Size and modification time of the file.
     """
-    combined = []
-    num_items = len(percent_list) # For calculating % complete
-    n = 0
-    for item in percent_list:
-        # Display progress
-        n += 1
-        progress = round((n/num_items) * 100)
-        print("\rProgress: {}{}".format(progress, '%'), end="", flush=True)
-        combined_item = []
-        combined_item.append(item[0]) # Add item name
-        combined_item.append(item[1]) # Add item percentage
-        # Find item in count_list
-        for count_item in count_list:
-            if count_item[0] == item[0]:
-                # Add item count
-                combined_item.append(count_item[1])
-                break
-        combined.append(combined_item)
-    return combined        
+    file_stat = os.stat(file_name)
+    return (file_stat.st_size, file_stat.st_mtime_ns)
+
+
+def get_file_hash(file_name, cache_root):
+    """Return a hash of the contents of a file.
+    
+    The hash is stored in the cache index with the size and modification
+    time of the file, so the file is only read again when it has changed.
+    
+    Args:
+        file_name (str): Name of the file.
+        cache_root (str): Cache directory holding the cache index.
+        
+    Returns:
+        file_hash (str): SHA-256 hash of the file contents.
+    """
+    index_name = os.path.join(cache_root, 'index.json')
+    try:
+        with open(index_name) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+    key = os.path.abspath(file_name)
+    fingerprint = list(get_file_fingerprint(file_name))
+    if key in index and index[key]['Fingerprint'] == fingerprint:
+        return index[key]['Hash']
+    file_hash = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            file_hash.update(block)
+    index[key] = {'Fingerprint': fingerprint, 'Hash': file_hash.hexdigest()}
+    write_json_atomic(index, index_name)
+    return index[key]['Hash']
 
 
-def convert_ages(ages, age_bands, age_band_values):
-    """Convert a list of ages to a list of age band values.
+def get_first_rows(index):
+    """Return the first row of each key of a key index, in file order.
     
-    Takes each age item in a list and appends it to a new list as an age band
-    value that it correspnds to.
+    These are the rows kept by drop_duplicates(keep='first'), including the
+    first row without a key.
     
     Args:
-        ages (list): List of age values.
-        age_bands (list): List of age bands as strings. Age bands must be
-        discrete e.g. 0-17, 18-24,...
-        age_band_values (list): List of age band values to be used. The final
-        age (which is followed by a '+', e.g. 65+ is ignored). 
+        index (dict): Key index, as returned by build_key_index.
+        
+    Returns:
+        rows (array): First row of each key, in ascending order.
+    """
+    rows = index['Order'][index['Starts'][:-1]]
+    if index['Missing'] >= 0:
+        rows = np.append(rows, index['Missing'])
+    return np.sort(rows)
+
+
+def get_graduate_enrolments(session):
+    """Return the enrolment details of each graduate for the session.
     
+    The enrolment of each graduate is found from the EnrolmentPK index of
+    the Enrolments File rather than by joining the files.
+    
+    Args:
+        session (dict): Data loaded in the current session, by source.
+        
     Returns:
-        converted_ages (list): List of converted age band values.
+        graduates (DataFrame): GraduatePK, EnrolmentPK, CourseFK, StartDate
+        and GraduationDate of each graduate whose enrolment is in the
+        Enrolments File.
     """
-    # Get the number of age bands
-    num_bands = int(len(age_band_values)/2)
-    # Get position of final 
-    final_band = len(age_bands) - 1
-    converted_ages = []
-    # Find the band for each age value and add to list
-    for age in ages: 
-        band = 0
-        lower = 0
-        upper = 1
-        while band < num_bands:
-            # Check if age is in current age band range
-            if age >= age_band_values[lower] and age <= age_band_values[upper]:
-                converted_ages.append(age_bands[band])
-                #print('Age {} is in age band {}'.format(age, age_bands[band]))
-                break
-            else:
-                # Check for next age band
-                band += 1
-                # Increase lower limit by 2 to check next age band
-                lower += 2
-                # Increase upper limit by 2 to check next age band
-                upper += 2
-        # Check if age is higher than upper limit of last band range
-        if band == num_bands:
-            converted_ages.append(age_bands[final_band])
-            #print('Age {} is in age band {}'.format(age,
-                  #age_bands[final_band]))
-    return converted_ages   
+    gradpk_col = 'GraduatePK'
+    enrolpk_col = 'EnrolmentPK'
+    course_col = 'CourseFK'
+    start_col = 'StartDate'
+    grad_date_col = 'GraduationDate'
+    columns = get_analysis_columns('length')
+    enrolment_df = get_session_data(session, 'Enrolments File',
+                                    ENROLMENT_HEADINGS,
+                                    columns['Enrolments File'])
+    grads_df = get_session_data(session, 'Graduates File', GRADUATE_HEADINGS,
+                                columns['Graduates File'])
+    # Look up the enrolment of each graduate by EnrolmentPK
+    with profile_stage(session, 'transform', len(grads_df)) as stage:
+        index = get_key_index(session, 'Enrolments File', ENROLMENT_HEADINGS,
+                              enrolpk_col)
+        rows = find_key_rows(index, grads_df[enrolpk_col])
+        grads_df = grads_df[rows >= 0]
+        enrolment_df = enrolment_df.take(rows[rows >= 0])
+        graduates = pd.concat([
+                grads_df[[gradpk_col]],
+                grads_df[[enrolpk_col]].astype(np.int64),
+                enrolment_df[[course_col, start_col]].set_axis(
+                        grads_df.index),
+                grads_df[[grad_date_col]]], axis=1)
+        stage['Rows Out'] = len(graduates)
+    return graduates
+
+
+def get_key_index(session, source, headings, column):
+    """Return the key index of a column of a data file in the session.
+    
+    The index is built once for each version of the file and kept in the
+    session. If the session uses the cache, the index is also saved in the
+    cache entry of the file and later runs load it from there.
+    
+    Args:
+        session (dict): Data loaded in the current session, by source.
+        source (str): Name of the data file, e.g. 'Student Data File'.
+        headings (list): Column headings for the file.
+        column (str): Key column, which must already be loaded.
+        
+    Returns:
+        index (dict): Key index of the column, as returned by
+        build_key_index.
+    """
+    entry = session[source]
+    indexes = entry.setdefault('Indexes', {})
+    if column in indexes:
+        return indexes[column]
+    entry_dir = None
+    index = None
+    if session.get('Use Cache', USE_CACHE):
+        entry_dir = get_cache_entry_dir(entry['File'], headings)
+        index = load_key_index(entry_dir, column)
+    if index is None:
+        index = build_key_index(entry['Data'][column])
+        if entry_dir is not None:
+            save_key_index(entry_dir, column, index)
+    indexes[column] = index
+    return index
+
+
+def get_key_rows(index, key):
+    """Return every row of a key, in file order, as found in a key index.
+    
+    Args:
+        index (dict): Key index, as returned by build_key_index.
+        key (int): Key to be found.
+        
+    Returns:
+        rows (array): Rows of the key, empty if it is not in the index.
+    """
+    position = np.searchsorted(index['Keys'], key)
+    if position == len(index['Keys']) or index['Keys'][position] != key:
+        return np.array([], dtype=np.int64)
+    return index['Order'][index['Starts'][position]:
+                          index['Starts'][position + 1]]
 
 
-def get_course_type(course_code):
-    """Returns course type.
+def get_length_sketch(session):
+    """Return the length of study summary of the graduates of the session.
     
-    Returns the course type that is the two letter code in the middle of the
-    course code.
+    If the session is incremental, only graduates that are new or whose data
+    has changed since the last run have their course type and length of
+    study found again.
     
     Args:
-        course_code (str): Code for the course.
+        session (dict): Data loaded in the current session, by source.
         
     Returns:
-        type (str): Two letter course type code.
+        sketch (dict): Length of study summary, as returned by
+        build_length_sketch.
+        negative (int): Number of graduates with a GraduationDate before
+        their StartDate.
     """
-    if re.search('.+-ON-.+', course_code):
-        return 'ON'
-    elif re.search('.+-PT-.+', course_code):
-        return 'PT'
+    gradpk_col = 'GraduatePK'
+    course_col = 'CourseFK'
+    start_col = 'StartDate'
+    grad_date_col = 'GraduationDate'
+    type_col = 'Type'
+    length_col = 'LengthOfStudy'
+    # Get the enrolment of each graduate
+    updated_grads = get_graduate_enrolments(session)
+    grad_headings = list(updated_grads.columns)
+    if session.get('Incremental', USE_INCREMENTAL):
+        # Only find the course type and length of study of new or changed
+        # graduates. Each graduation is keyed by its GraduatePK, or by its
+        # row if the GraduatePK is missing or repeated, so that every
+        # graduation is counted as in a full run.
+        grad_keys = updated_grads[gradpk_col]
+        untracked = (grad_keys.isna() | grad_keys.duplicated(keep=False))
+        updated_grads[gradpk_col] = np.where(untracked.to_numpy(),
+                -1 - np.arange(len(updated_grads)),
+                grad_keys.to_numpy(dtype=np.int64, na_value=0))
+        state_name = get_state_file(session['Enrolments File']['File'],
+                                    'length', session.get('Sample'))
+        with profile_stage(session, 'load'):
+            state = load_state(state_name, grad_headings,
+                               rebuild=session.get('Rebuild', False))
+        types = state['Items']
+        with profile_stage(session, 'transform', len(updated_grads)):
+            # merge_incremental_rows reports the new and removed rows
+            state, _, _ = merge_incremental_rows(state,
+                    [updated_grads], gradpk_col, lambda frame: {
+                    'Types': encode_values(get_course_types(frame[course_col]),
+                                           frame.index, types),
+                    'Days': calculate_days(frame[start_col],
+                                           frame[grad_date_col]).to_numpy(
+                                           dtype=float, na_value=np.nan)})
+        with profile_stage(session, 'save'):
+            save_state(state_name, state)
+        updated_grads = pd.DataFrame({
+                type_col: np.asarray(types, dtype=object)[state['Types']],
+                length_col: state['Days']})
     else:
-        return ''
+        with profile_stage(session, 'transform', len(updated_grads)):
+            # Add column for course type and populate
+            updated_grads[type_col] = get_course_types(
+                    updated_grads[course_col])
+            # Add column for length of study (in days) and populate
+            updated_grads[length_col] = calculate_days(
+                    updated_grads[start_col], updated_grads[grad_date_col])
+    # Count graduations before the start date
+    negative = int((updated_grads[length_col] < 0).sum())
+    # Summarise length of study data by course Type
+    with profile_stage(session, 'aggregate', len(updated_grads)) as stage:
+        sketch = build_length_sketch(updated_grads[type_col],
+                                     updated_grads[length_col])
+        stage['Rows Out'] = len(sketch['Types'])
+    return sketch, negative
+
+
+def get_length_statistics(sketch, percentiles=LENGTH_PERCENTILES):
+    """Return length of study statistics for each course type.
+    
+    Percentiles are interpolated between ranks in the same way as
+    numpy.percentile. Each rank is taken as the middle of its histogram bin,
+    so the Error column gives the largest difference in days between a
+    percentile and its exact value.
+    
+    Args:
+        sketch (dict): Length of study summary from build_length_sketch.
+        percentiles (list): Percentiles to report, e.g. [25, 50, 75].
+        
+    Returns:
+        stats (DataFrame): Count, Mean, Min, percentiles, Max and Error for
+        each course type.
+        
+    Raises:
+        ValueError: If a percentile is not between 0 and 100.
+    """
+    if not all(0 <= x <= 100 for x in percentiles):
+        raise ValueError('Percentiles must be between 0 and 100, not {}'
+                         .format(', '.join(str(x) for x in percentiles)))
+    bin_days = sketch['Bin Days']
+    rows = {}
+    for course_type, summary in sorted(sketch['Types'].items()):
+        bins = summary['Bins'].sort_index()
+        ends = bins.to_numpy().cumsum()
+        # Value of each bin is the middle day of the bin
+        values = bins.index.to_numpy() * bin_days + (bin_days - 1) / 2
+        ranks = np.asarray(percentiles) / 100 * (summary['Count'] - 1)
+        lower = values[np.searchsorted(ends, np.floor(ranks), side='right')]
+        upper = values[np.searchsorted(ends, np.ceil(ranks), side='right')]
+        row = {'Count': summary['Count'],
+               'Mean': summary['Sum'] / summary['Count'],
+               'Min': summary['Min']}
+        for percentile, low, high, rank in zip(percentiles, lower, upper,
+                                               ranks):
+            row['P{}'.format(percentile)] = low + (high - low) * (
+                    rank - np.floor(rank))
+        row['Max'] = summary['Max']
+        row['Error'] = (bin_days - 1) / 2
+        rows[course_type] = row
+    stats = pd.DataFrame.from_dict(rows, orient='index')
+    stats.index.name = 'Type'
+    return stats
+
+
+def get_output_name(session, f_name):
+    """Return the name to save an output file to.
+    
+    Args:
+        session (dict): Data loaded in the current session, by source.
+        f_name (str): Name of the output file.
+        
+    Returns:
+        output_name (str): f_name within the session output directory, if
+        one has been set.
+    """
+    return os.path.join(session.get('Output Dir', ''), f_name)
+
+
+def get_ranked_items(distribution):
+    """Return the item and percentage of each ranked item in a distribution.
+    
+    The Other item added by build_distribution, if any, is not included.
+    
+    Args:
+        distribution (DataFrame): Item, Percent and Count columns, as returned
+        by build_distribution.
+        
+    Returns:
+        ranked_items (list): List of tuples of each item and its percentage.
+    """
+    ranked = len(distribution)
+    if distribution.attrs.get('Other Items'):
+        ranked -= 1
+    return list(zip(distribution['Item'][:ranked],
+                    distribution['Percent'][:ranked]))
+
+
+def get_result_entry(session, name, sources, parameters):
+    """Return the result cache entry for an analysis of the session data.
+    
+    Entries are keyed by a hash of the contents of the data files and of the
+    parameters, so a change to either uses a new entry.
+    
+    Args:
+        session (dict): Data loaded in the current session, by source.
+        name (str): Name of the analysis, e.g. 'location'.
+        sources (list): Data files the result is calculated from, e.g.
+        ['Student Data File'].
+        parameters (dict): Settings the result depends on.
+        
+    Returns:
+        entry_dir (str): Result cache entry directory, or None if the session
+        does not use the result cache.
+    """
+    if not session.get('Result Cache', USE_RESULT_CACHE):
+        return None
+    for source in sources:
+        if source not in session:
+            session[source] = {'File': get_csv_fname(source),
+                               'Fingerprint': None, 'Data': None}
+    files = [session[x]['File'] for x in sources]
+    result_root = os.path.join(os.path.dirname(os.path.abspath(files[0])),
+                               RESULT_DIR)
+    os.makedirs(result_root, exist_ok=True)
+    # Use the hash found before a parallel batch run, unless the file has
+    # changed since
+    file_hashes = []
+    for source, file_name in zip(sources, files):
+        fingerprint, file_hash = session[source].get('Hash', (None, None))
+        if fingerprint != get_file_fingerprint(file_name):
+            file_hash = get_file_hash(file_name, result_root)
+        file_hashes.append(file_hash)
+    key = json.dumps([RESULT_VERSION, name, file_hashes, parameters],
+                     sort_keys=True, default=str)
+    return os.path.join(result_root, '{}-{}'.format(name, hashlib.sha256(
+            key.encode('utf-8')).hexdigest()[:24]))
 
 
 def get_sample():
@@ -176,6 +2001,317 @@ def get_sample():
                 return 'Other'
 
 
+def get_sample_flags(data, ethnicity_groups, graduate_enrolments=None):
+    """Return whether each enrolment belongs to each sample.
+    
+    Membership is derived from the Status and Ethnicity of each enrolment.
+    Enrolments in the Graduates File are also treated as Graduated.
+    
+    Args:
+        data (DataFrame): Student data with EnrolmentPK, Status and Ethnicity
+        columns.
+        ethnicity_groups (dict): Group of each grouped ethnicity, as returned
+        by get_ethnicity_groups.
+        graduate_enrolments (Series): Optional EnrolmentPK of each graduate.
+        
+    Returns:
+        flags (DataFrame): Boolean column for each sample in SAMPLES.
+    """
+    status = data['Status']
+    ethnicity = data['Ethnicity']
+    graduated = status == 'Graduated'
+    if graduate_enrolments is not None:
+        graduated = graduated | data['EnrolmentPK'].isin(
+                graduate_enrolments.dropna())
+    flags = pd.DataFrame(index=data.index)
+    flags['All'] = True
+    flags['Active'] = status == 'Active'
+    flags['Expired'] = status == 'Expired'
+    flags['Maori'] = ethnicity == 'Maori'
+    island_nations = [x for x in ethnicity_groups if
+                      ethnicity_groups[x] == 'Pacific Island']
+    flags['Pasifika'] = ethnicity.isin(island_nations + ['Pacific Island'])
+    flags['Graduated'] = graduated
+    flags['Withdrawn'] = status == 'Withdrawn'
+    flags['Other'] = ~(flags['Active'] | flags['Expired'] |
+                       flags['Graduated'] | flags['Withdrawn'])
+    return flags[list(SAMPLES)]
+
+
+def get_sample_rows(data, flags, sid_col):
+    """Return the rows of data for every sample in one DataFrame.
+    
+    Each row is repeated for every sample it belongs to and a Sample column
+    is added. Duplicate Student ID Numbers are removed within each sample,
+    keeping the first row for each student, as for a single sample file.
+    
+    Args:
+        data (DataFrame): Student data.
+        flags (DataFrame): Boolean column for each sample.
+        sid_col (str): Student ID Number column.
+        
+    Returns:
+        sample_df (DataFrame): Rows of data for every sample.
+    """
+    positions = []
+    codes = []
+    for code, sample in enumerate(flags.columns):
+        sample_positions = np.flatnonzero(flags[sample].to_numpy())
+        positions.append(sample_positions)
+        codes.append(np.full(len(sample_positions), code, dtype=np.int8))
+    positions = np.concatenate(positions)
+    sample_df = data.iloc[positions].reset_index(drop=True)
+    sample_df['Sample'] = pd.Categorical.from_codes(np.concatenate(codes),
+                                                    categories=flags.columns)
+    sample_df.drop_duplicates(subset=['Sample', sid_col], keep='first',
+                              inplace=True)
+    return sample_df
+
+
+def get_server_fingerprint(server):
+    """Return a value that changes whenever the data of the server changes.
+    
+    Args:
+        server (dict): Files and settings of the analysis server.
+        
+    Returns:
+        fingerprint (list): Name and fingerprint of each file used, None if
+        the file is not present, and today's date if ages are calculated at
+        today.
+    """
+    files = list(server['Files'].values())
+    if 'Student Data File' in server['Files']:
+        files += list(ETHNICITY_GROUPS.values()) + ['age_bands.txt']
+    fingerprint = [(x, get_file_fingerprint(x) if os.path.isfile(x) else
+                    None) for x in files]
+    # Ages at today change each day
+    if server['Age Reference'] == 'Today':
+        fingerprint.append(time.strftime('%Y-%m-%d'))
+    return fingerprint
+
+
+def get_server_response(server, path, query):
+    """Return the answer of the analysis server to a query.
+    
+    Queries are answered from the snapshot of the data held by the server,
+    which is read once so that each query uses a single snapshot even if
+    the data is reloaded while it is answered.
+    
+    Args:
+        server (dict): Files, settings and Snapshot of the analysis server.
+        path (str): Path of the query, e.g. '/distribution'.
+        query (dict): Value of each query string parameter, by name.
+        
+    Returns:
+        status (str): HTTP status of the response, e.g. '200 OK'.
+        body (dict): Response to be returned as JSON.
+    """
+    snapshot = server['Snapshot']
+    distributions = snapshot['Distributions']
+    if path == '/status':
+        return '200 OK', {'files': server['Files'],
+                          'loaded': snapshot['Loaded'],
+                          'analyses': list(distributions),
+                          'length': snapshot['Length Sketch'] is not None}
+    if path not in ('/distribution', '/threshold', '/length', '/student'):
+        return '404 Not Found', {'error': 'Unknown query {}'.format(path)}
+    try:
+        if path == '/student':
+            student = query.get('id', '')
+            if not student.isdigit():
+                raise ValueError('Student ID Number must be a number, not '
+                                 '{}'.format(student))
+            return '200 OK', get_student_records(snapshot['Session'],
+                                                 int(student))
+        if path == '/length':
+            if snapshot['Length Sketch'] is None:
+                raise ValueError('No Enrolments and Graduates Files loaded')
+            percentiles = LENGTH_PERCENTILES
+            if query.get('percentiles'):
+                try:
+                    percentiles = [int(x) if x.strip().isdigit() else
+                                   float(x) for x in
+                                   query['percentiles'].split(',')]
+                except ValueError:
+                    raise ValueError('Percentiles must be numbers, not {}'
+                                     .format(query['percentiles']))
+                if not all(0 <= x <= 100 for x in percentiles):
+                    raise ValueError('Percentiles must be between 0 and '
+                                     '100, not {}'.format(
+                                     query['percentiles']))
+            stats = get_length_statistics(snapshot['Length Sketch'],
+                                          percentiles)
+            return '200 OK', {'statistics': json.loads(
+                    stats.reset_index().to_json(orient='records'))}
+        name = query.get('analysis')
+        if not distributions:
+            raise ValueError('No Student Data File loaded')
+        if name not in distributions:
+            raise ValueError('Unknown analysis {}, available analyses are '
+                             '{}'.format(name, ', '.join(distributions)))
+        distribution, total = distributions[name]
+        if path == '/threshold':
+            threshold = float(query.get('threshold', 1))
+            above = query.get('above', 'true').lower() != 'false'
+            items = get_threshold_items(get_ranked_items(distribution),
+                                        threshold, above)
+            return '200 OK', {'analysis': name, 'total': total,
+                              'threshold': threshold, 'above': above,
+                              'items': [{'Item': x, 'Percent': float(y)} for
+                                        x, y in items]}
+        # Limit the items listed, other than the fixed age bands
+        top = server['Top Items']
+        if query.get('top'):
+            top = int(query['top'])
+        min_percent = server['Min Percent']
+        if query.get('min_percent'):
+            min_percent = float(query['min_percent'])
+        if name != 'age' and (top is not None or min_percent is not None):
+            distribution, total = build_distribution(pd.Series(
+                    distribution['Count'].to_numpy(),
+                    index=distribution['Item']), top=top,
+                    min_percent=min_percent)
+        return '200 OK', {'analysis': name, 'total': total,
+                          'items': distribution.attrs['Items'],
+                          'distribution': json.loads(distribution.to_json(
+                          orient='records'))}
+    except ValueError as e:
+        return '400 Bad Request', {'error': str(e)}
+
+
+def get_session_data(session, source, headings, columns):
+    """Return the requested columns for source, loading them if required.
+    
+    The file for each source is requested from the user once per session and
+    the parsed columns are kept in the session. Only columns that have not
+    already been loaded are read from the file. All columns are loaded again
+    if the file has changed on disk since it was last loaded.
+    
+    Args:
+        session (dict): Data loaded in the current session, by source.
+        source (str): Name of the file being requested, e.g. 'Student Data
+        File'.
+        headings (list): Column headings for the file.
+        columns (list): Columns required by the analysis.
+        
+    Returns:
+        data (DataFrame): Requested columns from the file.
+    """
+    if source not in session:
+        session[source] = {'File': get_csv_fname(source), 'Fingerprint': None,
+                           'Data': None}
+    entry = session[source]
+    fingerprint = get_file_fingerprint(entry['File'])
+    if entry['Fingerprint'] != fingerprint:
+        if entry['Fingerprint'] is not None:
+            print('\n{} has changed and will be reloaded.'.format(
+                    entry['File']))
+        entry['Data'] = None
+        entry['Invalid Dates'] = {}
+        entry['Indexes'] = {}
+        entry['Fingerprint'] = fingerprint
+    # Load any columns that are not yet in the session
+    use_cache = session.get('Use Cache', USE_CACHE)
+    with profile_stage(session, 'load') as stage:
+        if entry['Data'] is None:
+            entry['Data'] = load_columns(entry['File'], headings, columns,
+                                         use_cache)
+            entry['Invalid Dates'].update(
+                    entry['Data'].attrs['Invalid Dates'])
+        else:
+            missing = [x for x in columns if x not in entry['Data'].columns]
+            if missing:
+                new_data = load_columns(entry['File'], headings, missing,
+                                        use_cache)
+                entry['Invalid Dates'].update(
+                        new_data.attrs['Invalid Dates'])
+                entry['Data'] = pd.concat([entry['Data'], new_data], axis=1)
+        stage['Rows Out'] = len(entry['Data'])
+    with profile_stage(session, 'project', len(entry['Data'])) as stage:
+        data = entry['Data'][columns]
+        stage['Rows Out'] = len(data)
+    return data
+
+
+def get_state_file(file_name, name, sample=None):
+    """Return the name of the file holding the saved results of an analysis.
+    
+    Saved results are kept in a directory next to the data file they were
+    calculated from, separately for each sample.
+    
+    Args:
+        file_name (str): Name of the data file.
+        name (str): Name of the analysis, e.g. 'location'.
+        sample (str): Optional sample the data file is from, e.g. 'Active'.
+        
+    Returns:
+        state_name (str): Name of the saved results file.
+    """
+    state_dir = os.path.join(os.path.dirname(os.path.abspath(file_name)),
+                             STATE_DIR)
+    parts = [os.path.basename(file_name), sample, name]
+    return os.path.join(state_dir, '{}.npz'.format('_'.join(
+            x for x in parts if x)))
+
+
+def get_student_data(session, columns):
+    """Return the requested Student Data File columns for the session.
+    
+    Args:
+        session (dict): Data loaded in the current session, by source.
+        columns (list): Columns required by the analysis.
+        
+    Returns:
+        student_df (DataFrame): Requested columns of the student data.
+    """
+    if 'Student Data Headings' not in session:
+        session['Student Data Headings'] = ft.load_headings(
+                'data_headings.txt')
+    return get_session_data(session, 'Student Data File',
+                            session['Student Data Headings'], columns)
+
+
+def get_student_records(session, student):
+    """Return every record of a student in the data files of the session.
+    
+    Records are found from the key indexes of the files rather than by
+    searching the files. Each file must already be loaded with every column
+    and indexed, as by load_server_snapshot.
+    
+    Args:
+        session (dict): Data loaded in the current session, by source.
+        student (int): Student ID Number (StudentPK).
+        
+    Returns:
+        records (dict): Student Data rows (by StudentPK), enrolments (by
+        StudentFK) and graduates (by the EnrolmentPK of each of these) of the
+        student, for each file loaded.
+    """
+    records = {'student': student}
+    sources = [('students', 'Student Data File', 'StudentPK'),
+               ('enrolments', 'Enrolments File', 'StudentFK'),
+               ('graduates', 'Graduates File', 'EnrolmentPK')]
+    enrolments = []
+    for name, source, column in sources:
+        if source not in session:
+            continue
+        index = session[source]['Indexes'][column]
+        if column == 'EnrolmentPK':
+            keys = pd.unique(pd.Series(enrolments, dtype=np.int64))
+            rows = np.sort(np.concatenate([np.array([], dtype=np.int64)] +
+                    [get_key_rows(index, x) for x in keys]))
+        else:
+            rows = get_key_rows(index, student)
+        data = session[source]['Data'].take(rows)
+        if 'EnrolmentPK' in data.columns:
+            enrolments.extend(data['EnrolmentPK'].dropna().tolist())
+        records[name] = json.loads(data.to_json(orient='records',
+                                                date_format='iso'))
+    if not any(records.get(x) for x in ('students', 'enrolments')):
+        raise ValueError('Unknown student {}'.format(student))
+    return records
+
+
 def get_threshold_items(data, threshold, above=True):
     """Return a list of keys and values that have value above a threshold.
     
@@ -236,36 +2372,53 @@ def get_threshold_items_old(data, threshold, above=True):
     return threshold_dict
 
 
-def help_age_data():
-    """Print Age Data help information"""
-    # To be written
-
-
-def help_employment_data():
-    """Print Employment Data help information"""
-    # To be written
-
-
-def help_ethnicity_data():
-    """Print Ethnicity Data help information"""
-    # To be written
-
-
-def help_heard_data():
-    """Print How Heard Data help information"""
-    # To be written
+def hash_batch_files(tasks):
+    """Hash each data file used by a batch job before it is run in parallel.
+    
+    The hash of each file is kept in the sessions of the tasks using it, so
+    that workers do not update the hash index of the cache at the same time.
+    
+    Args:
+        tasks (list): Description, session and function of each analysis.
+    """
+    hashes = {}
+    for _, session, _ in tasks:
+        if session.get('Use Cache', USE_CACHE):
+            cache_dir = CACHE_DIR
+        elif session.get('Result Cache', USE_RESULT_CACHE):
+            cache_dir = RESULT_DIR
+        else:
+            continue
+        for source in ('Student Data File', 'Enrolments File',
+                       'Graduates File'):
+            if source not in session:
+                continue
+            file_name = session[source]['File']
+            if file_name not in hashes:
+                cache_root = os.path.join(os.path.dirname(os.path.abspath(
+                        file_name)), cache_dir)
+                os.makedirs(cache_root, exist_ok=True)
+                hashes[file_name] = (get_file_fingerprint(file_name),
+                                     get_file_hash(file_name, cache_root))
+            session[source]['Hash'] = hashes[file_name]
 
 
-def help_location_data():
-    """Print Location Data help information"""
-    # To be written
+def help_analysis(analysis):
+    """Print the help information for an analysis.
+    
+    Args:
+        analysis (dict): Analysis from ANALYSES.
+    """
+    print('\n{}\n'.format(analysis['title']))
+    print(textwrap.fill(analysis['help'], 79))
+    print('\nData files: {}'.format(', '.join(analysis['files'])))
 
 
 def help_menu():
     """Display the requested help information."""
     repeat = True
     low = 1
-    high = 7
+    high = len(ANALYSES) + 1
     while repeat:
         try_again = False
         help_menu_message()
@@ -280,75 +2433,420 @@ def help_menu():
                 print('\nPlease select from the available options ({} - {})'
                       .format(low, high))
                 try_again = True
-            elif action == low:
-                help_age_data()
-            elif action == 2:
-                help_location_data()
-            elif action == 3:
-                help_ethnicity_data()
-            elif action == 4:
-                help_employment_data()
-            elif action == 5:
-                help_reason_study_data()
-            elif action == 6:
-                help_heard_data()
+            elif action < high:
+                help_analysis(ANALYSES[action - 1])
             elif action == high:
                 repeat = False
         if not try_again:
             repeat = ad.check_repeat_help()
 
 
-def help_menu_message():
-    """Display the help menu options."""
-    print('\nPlease enter the number for the item you would like help on:\n')
-    print('1: Age Data')
-    print('2: Location Data')
-    print('3: Ethnicity Data')
-    print('4: Employment Data')
-    print('5: Reason for Study Data')
-    print('6: How Heard Data')
-    print('7: Exit Help Menu')
-                
-                
-def help_reason_study_data():
-    """Print Reason for Study Data help information"""
-    # To be written
+def help_menu_message():
+    """Display the help menu options."""
+    print('\nPlease enter the number for the item you would like help on:\n')
+    for number, analysis in enumerate(ANALYSES, 1):
+        print('{}: {}'.format(number, analysis['title']))
+    print('{}: Exit Help Menu'.format(len(ANALYSES) + 1))
+
+
+def iter_csv_chunks(file_name, headings, columns, chunk_rows,
+                    invalid_dates):
+    """Yield the requested columns of a csv file in chunks of rows.
+    
+    Each chunk is typed as for load_csv_frame. Invalid dates found in every
+    chunk are added to invalid_dates.
+    
+    Args:
+        file_name (str): Name of the csv file.
+        headings (list): Column headings for the file.
+        columns (list): Columns to be loaded.
+        chunk_rows (int): Number of rows in each chunk.
+        invalid_dates (dict): Invalid dates found so far, by column.
+        
+    Yields:
+        chunk (DataFrame): Requested columns of the next rows of the file.
+    """
+    options, date_cols = get_csv_read_options(file_name, headings, columns)
+    first_line = 1 + options['skiprows']
+    for chunk in pd.read_csv(file_name, chunksize=chunk_rows, **options):
+        for column in date_cols:
+            chunk[column], invalid = parse_dates(chunk[column])
+            if not invalid['Count']:
+                continue
+            found = invalid_dates.setdefault(column, {'Count': 0, 'Rows': [],
+                                                      'Values': []})
+            found['Count'] += invalid['Count']
+            found['Rows'] = (found['Rows'] + [x + first_line for x in
+                             invalid['Rows']])[:10]
+            found['Values'] = (found['Values'] + invalid['Values'])[:10]
+        first_line += len(chunk)
+        chunk = chunk[columns]
+        compact_int_columns(chunk)
+        yield chunk
+
+
+def load_age_band_edges():
+    """Return the lower age of each age band.
+    
+    Loads the age bands from the Age Bands File if it is present, otherwise
+    the default age bands are returned.
+    
+    Returns:
+        age_band_edges (list): Lower age of each age band in ascending order.
+    """
+    f_name = 'age_bands.txt'
+    if not os.path.isfile(f_name):
+        return [0, 18, 25, 35, 45, 55, 65]
+    age_band_edges = sorted(int(x) for x in ft.load_headings(f_name))
+    return age_band_edges
+
+
+def load_batch_job(args):
+    """Return the batch job described by the command line arguments.
+    
+    The job is loaded from the job file if one is given. Any samples and
+    settings given on the command line are added to the job.
+    
+    Args:
+        args (Namespace): Parsed command line arguments.
+        
+    Returns:
+        job (dict): Output directory, analyses, settings and the data files
+        for each sample.
+    """
+    # Analyses such as the cube are only run when they are asked for
+    analyses = [x for x, y in get_batch_analyses().items() if
+                y.get('default', True)]
+    job = {'output_dir': '.', 'analyses': analyses,
+           'age_reference': 'Today', 'cache': False, 'stream': False,
+           'stream_memory': STREAM_MEMORY_MB, 'incremental': False,
+           'rebuild': False, 'profile': False, 'result_cache': False,
+           'top': TOP_ITEMS, 'min_percent': MIN_PERCENT,
+           'cube_dimensions': None, 'cube_filters': {},
+           'output_format': OUTPUT_FORMAT, 'workers': 1, 'samples': []}
+    if args.job:
+        with open(args.job) as f:
+            job.update(json.load(f))
+    if args.all_samples:
+        job['all_samples'] = {'student_data': args.student_data,
+                              'graduates': args.graduates}
+    elif args.sample:
+        job['samples'].append({'sample': args.sample,
+                               'student_data': args.student_data,
+                               'enrolments': args.enrolments,
+                               'graduates': args.graduates})
+    if args.length_sketches:
+        job['length_sketches'] = args.length_sketches
+    for key in ('output_dir', 'output_format', 'analyses', 'age_reference',
+                'top', 'min_percent', 'cube_dimensions', 'workers',
+                'stream_memory'):
+        if getattr(args, key) is not None:
+            job[key] = getattr(args, key)
+    for key in ('cache', 'stream', 'incremental', 'rebuild', 'profile',
+                'result_cache'):
+        if getattr(args, key):
+            job[key] = True
+    if args.cube_filter:
+        job['cube_filters'] = parse_cube_filters(args.cube_filter)
+    # Giving the cube dimensions asks for the cube
+    if job['cube_dimensions'] and 'cube' not in job['analyses']:
+        job['analyses'] = list(job['analyses']) + ['cube']
+    return job
+
+
+def load_cached_columns(entry_dir, columns):
+    """Return those requested columns that are held in a cache entry.
+    
+    Column arrays are memory-mapped rather than read into memory.
+    
+    Args:
+        entry_dir (str): Cache entry directory.
+        columns (list): Columns to be loaded.
+        
+    Returns:
+        data (DataFrame): Requested columns that are in the cache.
+    """
+    try:
+        with open(os.path.join(entry_dir, 'columns.json')) as f:
+            kinds = json.load(f)
+    except (OSError, ValueError):
+        return pd.DataFrame()
+    data = {}
+    for column in columns:
+        if column not in kinds:
+            continue
+        path = os.path.join(entry_dir, column)
+        if kinds[column] in ('category', 'text'):
+            codes = np.load(path + '.codes.npy', mmap_mode='r')
+            with open(path + '.categories.json') as f:
+                categories = json.load(f)
+            values = pd.Categorical.from_codes(codes, categories=categories)
+            if kinds[column] == 'text':
+                values = np.asarray(values, dtype=object)
+        elif kinds[column] == 'int':
+            values = pd.arrays.IntegerArray(
+                    np.load(path + '.values.npy', mmap_mode='r'),
+                    np.load(path + '.mask.npy', mmap_mode='r'))
+        else:
+            values = np.load(path + '.values.npy', mmap_mode='r')
+        data[column] = values
+    data = pd.DataFrame(data)
+    try:
+        with open(os.path.join(entry_dir, 'invalid_dates.json')) as f:
+            invalid_dates = json.load(f)
+    except (OSError, ValueError):
+        invalid_dates = {}
+    data.attrs['Invalid Dates'] = {x: invalid_dates[x] for x in invalid_dates
+                                   if x in data.columns}
+    return data
+
+
+def load_cached_result(session, entry_dir):
+    """Return a result saved in the result cache by save_cached_result.
+    
+    Each lookup is counted as a hit or a miss in the Result Stats of the
+    session. The invalid dates found when the result was calculated are added
+    to the session, so that they are still reported.
+    
+    Args:
+        session (dict): Data loaded in the current session, by source.
+        entry_dir (str): Result cache entry directory, as returned by
+        get_result_entry, or None if the result cache is not used.
+        
+    Returns:
+        result (dict): Saved result, or None if there is no saved result.
+    """
+    if entry_dir is None:
+        return None
+    stats = session.setdefault('Result Stats', {'Hits': 0, 'Misses': 0})
+    try:
+        with open(os.path.join(entry_dir, 'result.json')) as f:
+            result = json.load(f)
+    except (OSError, ValueError):
+        stats['Misses'] += 1
+        return None
+    stats['Hits'] += 1
+    # Mark entry as used for the eviction policy
+    os.utime(entry_dir)
+    for source, invalid_dates in result['Invalid Dates'].items():
+        session[source].setdefault('Invalid Dates', {}).update(invalid_dates)
+    return result
+
+
+def load_columns(file_name, headings, columns, use_cache=False):
+    """Return the requested columns of a data file.
+    
+    If use_cache is True the columns are taken from the cache where possible
+    and any columns parsed from the csv file are added to the cache.
+    
+    Args:
+        file_name (str): Name of the csv file.
+        headings (list): Column headings for the file.
+        columns (list): Columns to be loaded.
+        use_cache (bool): Whether to use the cache of parsed data files.
+        
+    Returns:
+        data (DataFrame): Requested columns from the file.
+    """
+    if not use_cache:
+        return load_csv_frame(file_name, headings, columns)
+    entry_dir = get_cache_entry_dir(file_name, headings)
+    data = load_cached_columns(entry_dir, columns)
+    invalid_dates = data.attrs.get('Invalid Dates', {})
+    missing = [x for x in columns if x not in data.columns]
+    if missing:
+        new_data = load_csv_frame(file_name, headings, missing)
+        save_cached_columns(entry_dir, new_data)
+        evict_cache(os.path.dirname(entry_dir), CACHE_LIMIT_MB, entry_dir)
+        invalid_dates.update(new_data.attrs['Invalid Dates'])
+        if len(data.columns):
+            data = pd.concat([data, new_data], axis=1)
+        else:
+            data = new_data
+    data = data[columns]
+    data.attrs['Invalid Dates'] = invalid_dates
+    return data
+
+
+def load_csv_frame(file_name, headings, columns):
+    """Return the requested columns of a csv file as a typed DataFrame.
+    
+    Only the requested columns are read. Each column is given the type listed
+    for it in COLUMN_TYPES as it is parsed: integer keys are loaded as
+    nullable integers, dates (DD/MM/YYYY) as datetime64 and repetitive text
+    as categories. Empty integer and date fields are loaded as missing values
+    and invalid dates as NaT. Invalid dates are recorded in the 'Invalid
+    Dates' attribute of the returned DataFrame (see parse_dates). Empty text
+    fields are kept as empty strings. If the first row of the file contains
+    the headings it is skipped.
+    
+    Args:
+        file_name (str): Name of the csv file.
+        headings (list): Column headings for the file.
+        columns (list): Columns to be loaded.
+        
+    Returns:
+        data (DataFrame): Requested columns from the file.
+    """
+    options, date_cols = get_csv_read_options(file_name, headings, columns)
+    data = pd.read_csv(file_name, **options)
+    invalid_dates = {}
+    for column in date_cols:
+        data[column], invalid = parse_dates(data[column])
+        if invalid['Count']:
+            # Convert row positions to line numbers in the file
+            invalid['Rows'] = [x + 1 + options['skiprows']
+                               for x in invalid['Rows']]
+            invalid_dates[column] = invalid
+    data = data[columns]
+    compact_int_columns(data)
+    data.attrs['Invalid Dates'] = invalid_dates
+    return data
+
+
+def load_key_index(entry_dir, column):
+    """Return the key index of a column held in a cache entry.
+    
+    Args:
+        entry_dir (str): Cache entry directory.
+        column (str): Key column.
+        
+    Returns:
+        index (dict): Key index, as returned by build_key_index, or None if
+        it is not in the cache entry.
+    """
+    try:
+        with np.load(os.path.join(entry_dir, column + '.index.npz')) as f:
+            index = {x: f[x] for x in ('Keys', 'Order', 'Starts')}
+            index['Missing'] = int(f['Missing'])
+    except (OSError, ValueError, KeyError):
+        return None
+    return index
+
+
+def load_length_sketch(file_name):
+    """Return a length of study summary saved by save_length_sketch.
+    
+    Args:
+        file_name (str): Name of the json file.
+        
+    Returns:
+        sketch (dict): Length of study summary.
+    """
+    with open(file_name) as f:
+        saved = json.load(f)
+    for summary in saved['Types'].values():
+        summary['Bins'] = pd.Series(list(summary['Bins'].values()),
+                                    index=[int(x) for x in summary['Bins']],
+                                    dtype=np.int64)
+    return saved
 
 
-def list_nan(item):
-    """Return NaN if item is empty.
+def load_server_snapshot(server):
+    """Return the data that the analysis server answers queries from.
+    
+    The data files are loaded into a new session, and the distribution of
+    each analysis of the Student Data File and the length of study summary
+    are calculated from them in one pass. Queries then only select from
+    these, so they are answered without reading the data again. Every
+    column of each file is kept, indexed by student, for student queries.
     
     Args:
-        item (str): Item to be checked.
+        server (dict): Files and settings of the analysis server.
         
     Returns:
-        (str): NaN if item is empty, item otherwise.
+        snapshot (dict): Fingerprint of the data it was loaded from, the
+        Distributions (distribution and total of each analysis, by name),
+        the Length Sketch (None without Enrolments and Graduates Files), the
+        Session holding the indexed data files and the time it was Loaded.
     """
-    if item in (None, ''):
-        return np.nan
-    else:
-        return item
+    fingerprint = get_server_fingerprint(server)
+    # Hold every item so that each query can limit the items itself
+    session = {'Batch': True, 'Use Cache': server['Use Cache'],
+               'Top Items': None, 'Min Percent': None}
+    for source, f_name in server['Files'].items():
+        session[source] = {'File': f_name, 'Fingerprint': None, 'Data': None}
+    snapshot = {'Fingerprint': fingerprint, 'Distributions': {},
+                'Length Sketch': None, 'Session': session,
+                'Loaded': time.strftime('%Y-%m-%d %H:%M:%S')}
+    # Load every column of each file and index the records of each student
+    keys = {'Enrolments File': (ENROLMENT_HEADINGS, 'StudentFK'),
+            'Graduates File': (GRADUATE_HEADINGS, 'EnrolmentPK')}
+    if 'Student Data File' in session:
+        session['Student Data Headings'] = ft.load_headings(
+                'data_headings.txt')
+        keys['Student Data File'] = (session['Student Data Headings'],
+                                     'StudentPK')
+    for source, (headings, column) in keys.items():
+        if source in session:
+            get_session_data(session, source, headings, headings)
+            get_key_index(session, source, headings, column)
+    if 'Student Data File' in session:
+        reference = server['Age Reference']
+        plan = compile_plan(session, list(CATEGORICAL_SPECS))
+        plan['age'] = {'Columns': ['StudentPK', 'DateOfBirth', 'StartDate'],
+                       'Clean': lambda data: clean_age_data(data, reference)}
+        distributions = count_student_values(session, plan)
+        # Count the students in each age band
+        age_counts, _ = distributions['age']
+        age_band_edges = load_age_band_edges()
+        age_bands = generate_age_bands(age_band_edges)
+        converted_ages = convert_ages(age_counts['Item'], age_band_edges,
+                                      age_bands)
+        band_counts = age_counts['Count'].groupby(converted_ages,
+                                                  observed=False).sum()
+        distributions['age'] = build_distribution(band_counts, age_bands)
+        snapshot['Distributions'] = distributions
+    if 'Enrolments File' in session and 'Graduates File' in session:
+        snapshot['Length Sketch'] = get_length_sketch(session)[0]
+    return snapshot
 
 
-def list_unknown(item):
-    """Return 'Unknown' if item is empty.
+def load_state(state_name, columns, settings=None, rebuild=False):
+    """Return the saved results of an analysis, or empty results.
+    
+    Saved results are not used if they were calculated from different columns
+    or with different settings, or if a rebuild is requested.
     
     Args:
-        item (str): Item to be checked.
+        state_name (str): Name of the saved results file.
+        columns (list): Columns used by the analysis.
+        settings (dict): Optional settings used by the analysis.
+        rebuild (bool): Whether to ignore any saved results.
         
     Returns:
-        (str): 'Unknown' if item is empty, item otherwise.
+        state (dict): Keys, Hashes and values of each row processed, sorted by
+        key, and the Items, Counts and Settings of the analysis.
     """
-    if item in (None, ''):
-        return 'Unknown'
-    else:
-        return item
+    # Compare settings as they are saved in the file
+    settings = json.loads(json.dumps({'Version': STATE_VERSION,
+                                      'Columns': columns,
+                                      'Settings': settings}))
+    empty = {'Settings': settings, 'Items': [],
+             'Counts': np.zeros(0, dtype=np.int64),
+             'Keys': np.zeros(0, dtype=np.int64),
+             'Hashes': np.zeros(0, dtype=np.uint64)}
+    if rebuild:
+        return empty
+    try:
+        with np.load(state_name) as saved:
+            state = {x: saved[x] for x in saved.files}
+    except (OSError, ValueError):
+        return empty
+    details = json.loads(str(state.pop('Details')))
+    if details['Settings'] != settings:
+        return empty
+    state.update(details)
+    return state
 
 
 def main():
+    # Data loaded during the session, by source, and result cache lookups
+    stats = {'Hits': 0, 'Misses': 0}
+    session = {'Result Stats': stats}
     repeat = True
     low = 1
-    high = 9
+    high = len(ANALYSES) + 3
     while repeat:
         try_again = False
         main_message()
@@ -365,26 +2863,29 @@ def main():
                 try_again = True
             elif action == low:
                 help_menu()
-            elif action == 2:
-                process_age_data()
-            elif action == 3:
-                process_location_data()
-            elif action == 4:
-                process_ethnicity_data()
-            elif action == 5:
-                process_employment_data()
-            elif action == 6:
-                process_study_reason_data()
-            elif action == 7:
-                process_how_heard_data()
-            elif action == 8:
-                process_study_length()
+            elif action < high - 1:
+                # Analyses are numbered from 2, after the Help Menu
+                analysis = ANALYSES[action - 2]
+                get_analysis_function(analysis['function'])(session)
+            elif action == high - 1:
+                # Forget loaded files so that new files are requested
+                close_writer(session)
+                session.clear()
+                session['Result Stats'] = stats
+                print('\nNew data files will be requested by the next '
+                      'analysis.')
             elif action == high:
+                close_writer(session)
+                if USE_RESULT_CACHE:
+                    print_result_stats(stats)
                 print('\nIf you have generated any files, please find them '
                       'saved to disk. Goodbye.')
                 sys.exit()
         if not try_again:
             repeat = ad.check_repeat()
+    close_writer(session)
+    if USE_RESULT_CACHE:
+        print_result_stats(stats)
     print('\nPlease find your files saved to disk. Goodbye.')
 
 
@@ -395,155 +2896,630 @@ def main_message():
     print('Created by Jeff Mitchell, 2018')
     print('\nOptions:')
     print('\n1. Help Menu')
-    print('2. Age Data')
-    print('3. Location Data')
-    print('4. Ethnicity Data')
-    print('5. Employment Data')
-    print('6. Study Reason Data')
-    print('7. How Heard Data')
-    print('8. Average Length of Study')
-    print('9. Exit')
+    for number, analysis in enumerate(ANALYSES, 2):
+        print('{}. {}'.format(number, analysis['title']))
+    print('{}. Load New Data Files'.format(len(ANALYSES) + 2))
+    print('{}. Exit'.format(len(ANALYSES) + 3))
+
+
+def map_categories(values, lookup):
+    """Return categorical values with each category replaced by a new value.
+    
+    Each category is converted once rather than once for every row.
+    Categories that are converted to the same value are combined.
+    
+    Args:
+        values (Series): Categorical values.
+        lookup (array): New value for each category, in the order of the
+        categories, followed by the new value for missing values.
+        
+    Returns:
+        mapped (Series): Categorical new value for every row.
+    """
+    new_codes, categories = pd.factorize(np.asarray(lookup, dtype=object))
+    # Missing values have code -1, which selects the last item of lookup
+    mapped = pd.Categorical.from_codes(
+            new_codes[values.cat.codes.to_numpy()], categories=categories)
+    return pd.Series(mapped, index=values.index, name=values.name)
+
+
+def merge_cubes(cubes, age_band_edges):
+    """Return the cube of the students counted in any of cubes.
+    
+    Args:
+        cubes (list): Cubes of different students, as returned by
+        build_cube.
+        age_band_edges (list): Lower age of each age band in ascending order.
+        
+    Returns:
+        cube (Series): Count of students for each combination of dimension
+        values, as returned by build_cube.
+    """
+    counts = pd.concat([x.rename('Count').reset_index() for x in cubes],
+                       ignore_index=True)
+    counts['age'] = pd.Categorical(counts['age'], categories=(
+            generate_age_bands(age_band_edges) + ['Unknown']))
+    dimensions = [get_cube_values(counts[x], counts.index, sort=x != 'age')
+                  for x in CUBE_DIMENSIONS]
+    return counts['Count'].groupby(dimensions, observed=True).sum().rename(
+            None)
+
+
+def merge_incremental_rows(state, frames, key_col, process):
+    """Return saved rows updated with the current rows of a data file.
+    
+    Each row is identified by its key and a hash of its other columns. Only
+    rows with a new key, or whose hash has changed, are passed to process.
+    Saved rows whose key is no longer present are removed.
+    
+    Args:
+        state (dict): Keys, Hashes and value arrays of the saved rows, sorted
+        by key.
+        frames (iterable): DataFrames holding the current rows, each key
+        appearing once only.
+        key_col (str): Column holding the key of each row.
+        process (function): Takes a DataFrame of new or changed rows and
+        returns a dict of value arrays for the rows.
+        
+    Returns:
+        state (dict): State updated to hold the current rows, sorted by key.
+        removed (dict): Value arrays of the saved rows that were changed or
+        removed.
+        added (dict): Value arrays of the new and changed rows.
+    """
+    keys = state['Keys']
+    seen = np.zeros(len(keys), dtype=bool)
+    replaced = np.zeros(len(keys), dtype=bool)
+    new_keys = []
+    new_hashes = []
+    new_values = []
+    unchanged = 0
+    for frame in frames:
+        frame_keys = frame[key_col].to_numpy(dtype=np.int64, na_value=-1)
+        hashes = pd.util.hash_pandas_object(frame.drop(columns=key_col),
+                                            index=False).to_numpy()
+        # Find the saved row with the same key, if there is one
+        positions = np.minimum(np.searchsorted(keys, frame_keys),
+                               max(len(keys) - 1, 0))
+        found = (keys[positions] == frame_keys if len(keys) else
+                 np.zeros(len(frame_keys), dtype=bool))
+        same = found & (state['Hashes'][positions] == hashes if len(keys)
+                        else found)
+        seen[positions[found]] = True
+        replaced[positions[found & ~same]] = True
+        unchanged += int(same.sum())
+        if (~same).any():
+            new_keys.append(frame_keys[~same])
+            new_hashes.append(hashes[~same])
+            new_values.append(process(frame[~same]))
+    value_names = [x for x in state if x not in
+                   ('Keys', 'Hashes', 'Items', 'Counts', 'Settings')]
+    for values in new_values:
+        value_names.extend(x for x in values if x not in value_names)
+    stale = ~seen | replaced
+    removed = {}
+    added = {}
+    for x in value_names:
+        saved = [values[x] for values in new_values]
+        dtype = saved[0].dtype if saved else state[x].dtype
+        old = state.get(x, np.zeros(len(keys), dtype=dtype))
+        removed[x] = old[stale]
+        added[x] = np.concatenate(saved) if saved else np.zeros(0, dtype)
+        state[x] = np.concatenate([old[~stale], added[x]])
+    state['Keys'] = np.concatenate([keys[~stale]] + new_keys)
+    state['Hashes'] = np.concatenate([state['Hashes'][~stale]] + new_hashes)
+    # Keep the rows sorted by key for the next update
+    order = np.argsort(state['Keys'], kind='stable')
+    for x in ['Keys', 'Hashes'] + value_names:
+        state[x] = state[x][order]
+    print('\nIncremental update: {} new or changed rows, {} removed rows and '
+          '{} unchanged rows.'.format(sum(len(x) for x in new_keys),
+          int((~seen).sum()), unchanged))
+    return state, removed, added
+
+
+def merge_length_sketches(sketches):
+    """Return the combination of length of study summaries.
+    
+    Args:
+        sketches (list): Length of study summaries with the same Bin Days,
+        e.g. from separate chunks, cohorts or runs.
+        
+    Returns:
+        sketch (dict): Summary of all of the graduates in sketches.
+    """
+    bin_days = sketches[0]['Bin Days']
+    if any(x['Bin Days'] != bin_days for x in sketches):
+        raise ValueError('Length of study summaries have different bin '
+                         'widths')
+    merged = {'Bin Days': bin_days, 'Types': {}}
+    for sketch in sketches:
+        for course_type, summary in sketch['Types'].items():
+            if course_type not in merged['Types']:
+                merged['Types'][course_type] = dict(summary)
+                continue
+            total = merged['Types'][course_type]
+            total['Count'] += summary['Count']
+            total['Sum'] += summary['Sum']
+            total['Min'] = min(total['Min'], summary['Min'])
+            total['Max'] = max(total['Max'], summary['Max'])
+            total['Bins'] = total['Bins'].add(summary['Bins'],
+                                              fill_value=0).astype(np.int64)
+    return merged
+
+
+def parse_batch_args(argv):
+    """Return the parsed command line arguments for batch mode.
+    
+    Args:
+        argv (list): Command line arguments.
+        
+    Returns:
+        args (Namespace): Parsed command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Run Student Data Analyser '
+            'analyses without prompts.')
+    parser.add_argument('--job', help='JSON job file listing the samples, '
+                        'their data files and the analyses to run')
+    parser.add_argument('--sample', choices=SAMPLES,
+                        help='Sample source of the data files')
+    parser.add_argument('--all-samples', action='store_true',
+                        help='Report on every sample from an All Students '
+                        'Student Data File')
+    parser.add_argument('--student-data', help='Student Data File')
+    parser.add_argument('--enrolments', help='Enrolments File')
+    parser.add_argument('--graduates', help='Graduates File')
+    parser.add_argument('--analyses', nargs='+',
+                        choices=list(get_batch_analyses()),
+                        help='Analyses to run (default: all)')
+    parser.add_argument('--output-dir', help='Directory to save results to')
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS,
+                        help='Save each result to a csv file, or every result '
+                        'to one xlsx workbook or Parquet directory '
+                        '(default: csv)')
+    parser.add_argument('--age-reference', choices=['Today', 'Enrolment'],
+                        help='Date to calculate ages at (default: Today)')
+    parser.add_argument('--cache', action='store_true',
+                        help='Use the cache of parsed data files')
+    parser.add_argument('--stream', action='store_true',
+                        help='Read the Student Data File in chunks rather '
+                        'than loading it into memory')
+    parser.add_argument('--stream-memory', type=int, metavar='MB',
+                        help='Memory to use for each chunk when streaming '
+                        '(default: {})'.format(STREAM_MEMORY_MB))
+    parser.add_argument('--length-sketches', nargs='+',
+                        help='Combine length of study summaries saved by '
+                        'earlier runs')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only process rows that are new or changed '
+                        'since the last incremental run')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Rebuild the saved incremental results from '
+                        'all rows')
+    parser.add_argument('--profile', action='store_true',
+                        help='Save the time, rows and memory of each stage '
+                        'of each analysis')
+    parser.add_argument('--result-cache', action='store_true',
+                        help='Reuse the results of analyses already run on '
+                        'the same data files and settings')
+    parser.add_argument('--top', type=int,
+                        help='Only list the N items with the largest counts, '
+                        'combining the rest into an Other item')
+    parser.add_argument('--min-percent', type=float,
+                        help='Only list items with at least this percentage, '
+                        'combining the rest into an Other item')
+    parser.add_argument('--cube-dimensions', nargs='+',
+                        choices=list(CUBE_DIMENSIONS),
+                        help='Dimensions of a cross-tab report from the '
+                        'cube, e.g. ethnicity age location')
+    parser.add_argument('--cube-filter', nargs='+',
+                        metavar='DIMENSION=VALUE',
+                        help='Values to filter the cross-tab report on, '
+                        'e.g. course=PT')
+    parser.add_argument('--workers', type=int,
+                        help='Number of analyses to run in parallel '
+                        '(default: 1)')
+    parser.add_argument('--serve', action='store_true',
+                        help='Load the data files once and answer queries '
+                        'over HTTP until stopped')
+    parser.add_argument('--port', type=int,
+                        help='Port of the analysis server (default: {})'
+                        .format(SERVER_PORT))
+    args = parser.parse_args(argv)
+    if args.cube_filter:
+        try:
+            parse_cube_filters(args.cube_filter)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.serve:
+        if not (args.student_data or (args.enrolments and args.graduates)):
+            parser.error('--serve requires --student-data, or --enrolments '
+                         'and --graduates')
+    elif not (args.job or args.sample or args.all_samples or
+              args.length_sketches):
+        parser.error('one of --job, --sample, --all-samples, '
+                     '--length-sketches or --serve is required')
+    return args
+
+
+def parse_cube_filters(items):
+    """Return the filters of a cross-tab report from dimension=value items.
+    
+    Args:
+        items (list): Filters in the form dimension=value.
+        
+    Returns:
+        filters (dict): Value to filter on, by dimension.
+        
+    Raises:
+        ValueError: If an item is not in the form dimension=value with a
+        dimension from CUBE_DIMENSIONS.
+    """
+    filters = {}
+    for item in items:
+        dimension, _, value = item.partition('=')
+        dimension = dimension.strip()
+        if dimension not in CUBE_DIMENSIONS or not _:
+            raise ValueError('Invalid filter {}. Filters must be in the form '
+                             'dimension=value, with dimension one of: {}'
+                             .format(item.strip(), ', '.join(CUBE_DIMENSIONS)))
+        filters[dimension] = value.strip()
+    return filters
+
+
+def parse_dates(values, date_format='%d/%m/%Y'):
+    """Convert a column of date strings to datetime64 values in one pass.
+    
+    Empty values and values that are not valid dates in date_format are
+    converted to NaT. Invalid values are reported together rather than row
+    by row.
+    
+    Args:
+        values (Series): Date strings.
+        date_format (str): Format of the dates.
+        
+    Returns:
+        dates (Series): Converted dates.
+        invalid (dict): Count of the invalid (non-empty) values, and the row
+        positions ('Rows') and values ('Values') of the first 10 of them.
+    """
+    dates = pd.to_datetime(values, format=date_format, errors='coerce')
+    bad = (dates.isna() & (values != '')).to_numpy()
+    positions = np.flatnonzero(bad)
+    invalid = {'Count': len(positions), 'Rows': positions[:10].tolist(),
+               'Values': values.iloc[positions[:10]].tolist()}
+    return dates, invalid
+
+
+def print_result_stats(stats):
+    """Print the number of result cache hits and misses.
+    
+    Args:
+        stats (dict): Number of Hits and Misses of the result cache.
+    """
+    lookups = stats['Hits'] + stats['Misses']
+    print('\nResult cache: {} hits and {} misses ({:.0%} hit rate).'.format(
+          stats['Hits'], stats['Misses'],
+          stats['Hits'] / lookups if lookups else 0))
 
 
-def process_age_data():
+def process_age_data(session):
     """Process Age Data."""
     warnings = ['\nProcessing Age Data Warnings:\n']
     warnings_to_process = False
     print('\nProcessing Age Data.')
     # Confirm the required files are in place
     required_files = ['Student Data File', 'Student Data Headings File']
-    ad.confirm_files('Student Data', required_files)
-    # Load Student data
-    student_data = ft.get_csv_fname_load('Student Data File')
-    # Load headings file
-    data_headings = ft.load_headings('data_headings.txt')
-    # Place data into a DataFrame
-    birth_df = pd.DataFrame(data = student_data, columns = data_headings)
-    # Drop unnecessary columns
-    age_col = 'Age'
-    sid_col = 'StudentPK'
+    confirm_session_files(session, 'Student Data', required_files)
+    # Get from user the date to calculate ages at
+    reference = session.get('Age Reference') or get_age_reference()
+    start_profile(session, 'Age Data')
     dob_col = 'DateOfBirth'
-    headings = [sid_col, dob_col]
-    birth_df =  birth_df[headings]
-    # Remove duplicate Student ID Numbers
-    birth_df.drop_duplicates(sid_col, 'first', True)
-    # Remove students without a Date of Birth
-    # Set empty Date of Birth values to NaN and then drop
-    birth_df[dob_col] = birth_df[dob_col].apply(list_nan)
-    birth_df.dropna(subset=[dob_col], inplace=True)
-    # Convert Date of Birth column to timestamps
-    birth_df[dob_col] = birth_df[dob_col].apply(da.convert_to_datetime, args=
-            ('%d/%m/%Y',))
-    # Convert Date of Birth column to Age and rename column
-    birth_df[dob_col] = birth_df[dob_col].apply(da.calculate_age)
-    birth_df = birth_df.rename(columns = {dob_col:age_col})
-    # Calculate average age
-    average_age = int(birth_df[age_col].mean())
-    # Create a dictionary to hold the number of students in each age group
-    age_bands = ['0-17', '18-24', '25-34', '35-44', '45-54', '55-64', '65+']
-    age_band_values = [0, 17, 18, 24, 25, 34, 35, 44, 45, 54, 55, 64, 65]
-    count_ages_dict = ad.create_dict(age_bands)
-    # Update ages_dict with counts for each age
-    # Get each age value in a list
-    ages = birth_df[age_col].tolist()
-    # Convert ages to age bands
-    converted_ages = convert_ages(ages, age_bands, age_band_values)
-    # print(converted_ages)
-    # Update the ages_dict
-    count_ages_dict = update_dict_counts(count_ages_dict, converted_ages)
-    # print(count_ages_dict)
-    # Create dict to hold the percentages of each age group
-    percent_ages_dict, total = calculate_percent(count_ages_dict)
+    start_col = 'StartDate'
+    # Count the students of each age, for students with a Date of Birth
+    # Ages at today change each day
+    age_settings = {'Reference': reference}
+    if reference == 'Today':
+        age_settings['Date'] = str(pd.Timestamp.today().date())
+    age_counts, total = count_student_values(session, {'age': {
+            'Columns': get_analysis_columns('age')['Student Data File'],
+            'Clean': lambda data: clean_age_data(data, reference),
+            'Settings': age_settings}})['age']
+    # Report any invalid dates
+    if add_date_warnings(session, 'Student Data File', [dob_col, start_col],
+                         warnings):
+        warnings_to_process = True
+    with profile_stage(session, 'transform', len(age_counts)):
+        # Calculate average age
+        average_age = int((age_counts['Item'] * age_counts['Count']).sum() /
+                          total)
+        # Get the age bands
+        age_band_edges = load_age_band_edges()
+        age_bands = generate_age_bands(age_band_edges)
+        # Convert ages to age bands
+        converted_ages = convert_ages(age_counts['Item'], age_band_edges,
+                                      age_bands)
+    # Report any students younger than the first age band
+    below = int(age_counts['Count'][pd.isna(converted_ages)].sum())
+    if below:
+        warnings.append('{} students are younger than the first age band ({}) '
+                        'and are not counted in the age bands.\n'.format(
+                        below, age_bands[0]))
+        warnings_to_process = True
+    with profile_stage(session, 'aggregate', len(age_counts)) as stage:
+        # Count the students in each age band and calculate percentages
+        band_counts = age_counts['Count'].groupby(converted_ages,
+                                                  observed=False).sum()
+        ages_dist, total = build_distribution(band_counts, age_bands)
+        count_ages_dict = dict(zip(ages_dist['Item'],
+                                   ages_dist['Count'].tolist()))
+        percent_ages_dict = dict(zip(ages_dist['Item'],
+                                     ages_dist['Percent'].tolist()))
+        stage['Rows Out'] = len(ages_dist)
+    # Get from user the sample source
+    sample = session.get('Sample') or get_sample()
+    # Display results
+    with profile_stage(session, 'render', len(ages_dist)):
+        print('\nAverage age of {} students (calculated at {}): {}'.format(
+              sample, reference, average_age))
+        print('\nTotal number of {} students in sample: {}'.format(sample,
+              total))
+        print('\nPercentage of {} students by Age Group:\n'.format(sample))
+        print("{:10} {:7}".format('Age Band', 'Percent'))
+        for k, v in percent_ages_dict.items():
+            print("{:10} {:7}%".format(k, v))
+    with profile_stage(session, 'save', len(ages_dist)):
+        # Save percentage results as a single row with a column for each
+        # age band
+        perc_name = save_result(session, '{}_Ages_Percentage'.format(sample),
+                                pd.DataFrame([percent_ages_dict]))
+        # State name of saved file
+        print('\nPercentage results saved to {}'.format(perc_name))
+        # Save group totals results
+        total_name = save_result(session,
+                '{}_Ages_Group_Totals'.format(sample),
+                pd.DataFrame([count_ages_dict]))
+        # State name of saved file
+        print('Group Total results saved to {}'.format(total_name))
+    ft.process_warning_log(warnings, warnings_to_process)
+    save_profile(session)
+    flush_results(session)
+
+
+def process_all_samples(session):
+    """Process Student Data for every sample from an All Students file."""
+    warnings = ['\nProcessing All Samples Warnings:\n']
+    warnings_to_process = False
+    print('\nProcessing All Samples.')
+    # Confirm the required files are in place
+    required_files = ['Student Data File (All Students)',
+                      'Student Data Headings File',
+                      'Pacific Island Nations File', 'Graduates File']
+    confirm_session_files(session, 'All Samples', required_files)
+    # Load ethnicity groups from the Pacific Island Nations File
+    ethnicity_groups = get_ethnicity_groups(session)
+    # Get the analyses to run
+    analyses = session.get('Analyses') or ['age', 'location', 'ethnicity',
+                                           'employment', 'reason', 'heard']
+    if 'age' in analyses:
+        reference = session.get('Age Reference') or get_age_reference()
+    start_profile(session, 'All Samples')
+    sid_col = 'StudentPK'
+    enrolpk_col = 'EnrolmentPK'
+    columns = get_analysis_columns('all_samples')
+    # Get graduates data if available
+    if session.get('Batch') and 'Graduates File' not in session:
+        graduate_enrolments = None
+        warnings.append('No Graduates File given, Graduated sample is based '
+                        'on Status only.\n')
+        warnings_to_process = True
+    else:
+        graduate_enrolments = get_session_data(session, 'Graduates File',
+                GRADUATE_HEADINGS, columns['Graduates File'])[enrolpk_col]
+    if session.get('Stream', USE_STREAMING):
+        # Read the rows of every sample in chunks
+        frames = stream_sample_rows(session, columns['Student Data File'],
+                                    ethnicity_groups, graduate_enrolments)
+    else:
+        # Get Student data for the required columns only
+        student_df = get_student_data(session, columns['Student Data File'])
+        # Find the samples each enrolment belongs to
+        with profile_stage(session, 'transform', len(student_df)) as stage:
+            flags = get_sample_flags(student_df, ethnicity_groups,
+                                     graduate_enrolments)
+            stage['Rows Out'] = len(flags)
+        # Get rows for every sample with duplicate Student ID Numbers removed
+        with profile_stage(session, 'dedupe', len(student_df)) as stage:
+            sample_df = get_sample_rows(student_df, flags, sid_col)
+            stage['Rows Out'] = len(sample_df)
+        frames = [sample_df]
+    if 'age' in analyses:
+        age_band_edges = load_age_band_edges()
+        age_bands = generate_age_bands(age_band_edges)
+    names = [x for x in CATEGORICAL_SPECS if x in analyses]
+    # Count the students, ages and values of each sample in each frame
+    students = pd.Series(0, index=list(SAMPLES))
+    age_totals = pd.DataFrame(0, index=students.index,
+                              columns=['Sum', 'Count'])
+    age_counts = None
+    counts = dict.fromkeys(names)
+    for sample_df in frames:
+        students += sample_df['Sample'].value_counts(sort=False)
+        # Age bands for every sample
+        if 'age' in analyses:
+            ages = clean_values(session, lambda x: clean_age_data(x,
+                                reference), sample_df)
+            with profile_stage(session, 'transform', len(ages)):
+                converted_ages = convert_ages(ages, age_band_edges, age_bands)
+                samples = sample_df.loc[ages.index, 'Sample']
+            with profile_stage(session, 'aggregate', len(ages)):
+                age_totals += ages.groupby(samples, observed=False).agg(
+                        ['sum', 'count']).set_axis(['Sum', 'Count'], axis=1)
+                age_counts = count_sample_values(samples, pd.Series(
+                        converted_ages, index=ages.index), age_counts)
+        # Cleaned values for each categorical analysis
+        for name in names:
+            values = clean_values(session, lambda x: clean_category_data(x,
+                                  CATEGORICAL_SPECS[name], ethnicity_groups),
+                                  sample_df)
+            with profile_stage(session, 'aggregate', len(values)):
+                samples = sample_df.loc[values.index, 'Sample']
+                counts[name] = count_sample_values(samples, values,
+                                                   counts[name])
+    with profile_stage(session, 'render', len(students)):
+        print('\n{:12} {:>10}'.format('Sample', 'Students'))
+        for sample, total in students.items():
+            print('{:12} {:>10}'.format(sample, total))
+    if 'age' in analyses:
+        if add_date_warnings(session, 'Student Data File',
+                             ['DateOfBirth', 'StartDate'], warnings):
+            warnings_to_process = True
+        with profile_stage(session, 'aggregate'):
+            average_ages = age_totals['Sum'] / age_totals['Count']
+            distributions = build_sample_distributions(age_counts,
+                                                       age_bands)
+        for sample, (ages_dist, total) in distributions.items():
+            if not total:
+                continue
+            with profile_stage(session, 'render', len(ages_dist)):
+                print('\nAverage age of {} students (calculated at {}): {}'
+                      .format(sample, reference, int(average_ages[sample])))
+            with profile_stage(session, 'save', len(ages_dist)):
+                # Save each as a single row with a column for each age band
+                save_result(session, '{}_Ages_Percentage'.format(sample),
+                            pd.DataFrame([dict(zip(ages_dist['Item'],
+                            ages_dist['Percent'].tolist()))]))
+                save_result(session, '{}_Ages_Group_Totals'.format(sample),
+                            pd.DataFrame([dict(zip(ages_dist['Item'],
+                            ages_dist['Count'].tolist()))]))
+    for name in names:
+        spec = CATEGORICAL_SPECS[name]
+        heading = spec['heading']
+        with profile_stage(session, 'aggregate'):
+            distributions = build_sample_distributions(counts[name],
+                    top=session.get('Top Items', TOP_ITEMS),
+                    min_percent=session.get('Min Percent', MIN_PERCENT))
+        print('\n{} totals by sample:\n'.format(heading))
+        for sample, (dist, total) in distributions.items():
+            with profile_stage(session, 'render', len(dist)):
+                print('{:12} {:>10} students {:>6} categories'.format(sample,
+                      total, dist.attrs['Items']))
+            if not total:
+                continue
+            with profile_stage(session, 'save', len(dist)):
+                save_result(session, '{}_{}_Combined'.format(sample,
+                            spec['label']), dist.rename(columns={'Item':
+                            heading}))
+    ft.process_warning_log(warnings, warnings_to_process)
+    save_profile(session)
+    flush_results(session)
+
+
+def process_cube_data(session):
+    """Process a cross-tab report from the cube of Student Data."""
+    warnings = ['\nProcessing Cross-tab Report Warnings:\n']
+    warnings_to_process = False
+    print('\nProcessing Cross-tab Report.')
+    # Confirm the required files are in place
+    required_files = ['Student Data File', 'Student Data Headings File',
+                      'Pacific Island Nations File']
+    confirm_session_files(session, 'Student Data', required_files)
+    # Get from user the dimensions, filters and date to calculate ages at
+    dimensions = session.get('Cube Dimensions') or get_cube_dimensions()
+    if session.get('Batch'):
+        filters = session.get('Cube Filters') or {}
+    else:
+        filters = get_cube_filters()
+    reference = session.get('Age Reference') or get_age_reference()
+    start_profile(session, 'Cross-tab Report')
+    # Build the cube, or use the cube already built this session
+    cube = get_cube(session, reference)
+    if add_date_warnings(session, 'Student Data File',
+                         ['DateOfBirth', 'StartDate'], warnings):
+        warnings_to_process = True
+    # Roll the cube up to the requested dimensions
+    rollup_key = (tuple(dimensions), tuple(sorted(filters.items())))
+    with profile_stage(session, 'aggregate', len(cube['Counts'])) as stage:
+        if rollup_key not in cube['Rollups']:
+            cube['Rollups'][rollup_key] = rollup_cube(cube['Counts'],
+                    dimensions, filters)
+        counts = cube['Rollups'][rollup_key]
+        total = int(counts.sum())
+        table = counts.rename('Count').reset_index()
+        table.insert(len(dimensions), 'Percent', np.round(
+                table['Count'] / max(total, 1) * 100, 2))
+        table.columns = [x.capitalize() for x in dimensions] + ['Percent',
+                                                                'Count']
+        stage['Rows Out'] = len(table)
     # Get from user the sample source
-    sample = get_sample()
+    sample = session.get('Sample') or get_sample()
     # Display results
-    print('\nAverage age of {} students: {}'.format(sample, average_age))
-    print('\nTotal number of {} students in sample: {}'.format(sample, total))
-    print('\nPercentage of {} students by Age Group:\n'.format(sample))
-    print("{:10} {:7}".format('Age Band', 'Percent'))
-    for k, v in percent_ages_dict.items():
-        print("{:10} {:7}%".format(k, v))
-    # Save percentage results
-    perc_name = '{}_Ages_Percentage_{}.csv'.format(sample,
-                 ft.generate_time_string())
-    ft.csv_dict_save_single_row(percent_ages_dict, perc_name)
-    # State name of saved file
-    print('\nPercentage results saved to {}'.format(perc_name))
-    # Save group totals results
-    total_name = '{}_Ages_Group_Totals_{}.csv'.format(sample,
-                 ft.generate_time_string())
-    ft.csv_dict_save_single_row(count_ages_dict, total_name)
-    # State name of saved file
-    print('Group Total results saved to {}'.format(total_name))
+    with profile_stage(session, 'render', len(table)):
+        filtered = ', '.join('{}={}'.format(k, v) for k, v in
+                             filters.items())
+        print('\nNumber of {} students by {}{}:\n'.format(sample,
+              ', '.join(dimensions), ' ({})'.format(filtered) if filtered
+              else ''))
+        print(table.to_string(index=False))
+        print('\nTotal number of {} students in sample: {}'.format(sample,
+              total))
+    with profile_stage(session, 'save', len(table)):
+        f_name = save_result(session, '{}_Cube_{}'.format(sample,
+                '_'.join(table.columns[:len(dimensions)])), table)
+        print('\nData saved to {}'.format(f_name))
     ft.process_warning_log(warnings, warnings_to_process)
+    save_profile(session)
+    flush_results(session)
 
 
-def process_employment_data():
+def process_employment_data(session):
     """Process Employment Data."""
     warnings = ['\nProcessing Employment Data Warnings:\n']
     warnings_to_process = False
     print('\nProcessing Employment Data.')
     # Confirm the required files are in place
     required_files = ['Student Data File', 'Student Data Headings File']
-    ad.confirm_files('Student Data', required_files)
-    # Load Student data
-    student_data = ft.get_csv_fname_load('Student Data File')
-    # Load headings file
-    data_headings = ft.load_headings('data_headings.txt')
-    # Place data into a DataFrame
-    employment_df = pd.DataFrame(data = student_data, columns = data_headings)
-    # Drop unnecessary columns
-    sid_col = 'StudentPK'
-    employment_col = 'Employment'
-    headings = [sid_col, employment_col]
-    employment_df = employment_df[headings]
-    # Remove duplicate Student ID Numbers
-    employment_df.drop_duplicates(sid_col, 'first', True)
-    # Convert students without an Employment entry to 'Unknown'
-    employment_df[employment_col] = employment_df[employment_col].apply(
-            list_unknown)
-    # Get a list of unique employment entries
-    unique_emp = employment_df[employment_col].unique()
-    # Create a dictionary to hold count of employment types and populate
-    count_employ_dict = ad.create_dict(unique_emp)
-    # Get each employment type in a list
-    employment = employment_df[employment_col].tolist()
-    count_employ_dict = update_dict_counts(count_employ_dict, employment)
-    # Convert to an ordered list of tuples (allow ordered display and saving)
-    count_employ_list = ad.sort_dict_values(count_employ_dict,'descending')
-    # Create dict to hold the percentages of each employment type
-    percent_employ_dict, total = calculate_percent(count_employ_dict)
-    # Convert to an ordered list of tuples (allow ordered display and saving)
-    percent_employ_list = ad.sort_dict_values(percent_employ_dict,'descending')
+    confirm_session_files(session, 'Student Data', required_files)
+    start_profile(session, 'Employment Data')
+    # Count each employment type (students without an Employment entry as
+    # 'Unknown') and calculate its percentage
+    employ_dist, total = get_category_distribution(session, 'employment',
+                                                   warnings)
+    warnings_to_process = len(warnings) > 1
+    # Convert to an ordered list of tuples (allow ordered display)
+    percent_employ_list = list(zip(employ_dist['Item'],
+                                   employ_dist['Percent']))
     # Get from user the sample source
-    sample = get_sample()
+    sample = session.get('Sample') or get_sample()
     # Display results
-    print('\nPercentage of {} students by Emplyment Type:\n'.format(sample))
-    print("{:20} {:7}".format('Employment', 'Percent'))
-    for x in percent_employ_list:
-        print("{:20} {:7}%".format(x[0], x[1]))
-    # Get a list of tuples with just results over 1%
-    threshold = 1
-    threshold_employ_list = get_threshold_items(percent_employ_list, threshold)
-    print('\nThe Employment Types above the {}% threshold are as follows:\n'
-          .format(threshold))
-    print("{:20} {:7}".format('Employment', 'Percent'))
-    for x in threshold_employ_list:
-        print("{:20} {:7}%".format(x[0], x[1]))
-    print('\nTotal number of {} students in sample: {}\n'.format(sample,
-          total))
-    # Combine Percentage and Count columns
-    combined_lists = combine_lists(percent_employ_list, count_employ_list)
-    print('')
-    print('')
-    # Save % and # data
-    headings = ['Employment', 'Percent', 'Count']
-    f_name = '{}_Employment_Combined_'.format(sample)
-    ft.save_list_csv(combined_lists, headings, f_name)
+    with profile_stage(session, 'render', len(employ_dist)):
+        print('\nPercentage of {} students by Emplyment Type:\n'.format(
+              sample))
+        print("{:20} {:7}".format('Employment', 'Percent'))
+        for x in percent_employ_list:
+            print("{:20} {:7}%".format(x[0], x[1]))
+        # Get a list of tuples with just results over 1%
+        threshold = 1
+        threshold_employ_list = get_threshold_items(
+                get_ranked_items(employ_dist), threshold)
+        print('\nThe Employment Types above the {}% threshold '
+              'are as follows:\n'.format(threshold))
+        print("{:20} {:7}".format('Employment', 'Percent'))
+        for x in threshold_employ_list:
+            print("{:20} {:7}%".format(x[0], x[1]))
+        print('\nTotal number of {} students in sample: {}\n'.format(sample,
+              total))
+    with profile_stage(session, 'save', len(employ_dist)):
+        # Save Item, Percentage and Count columns
+        f_name = save_result(session, '{}_Employment_Combined'.format(
+                sample), employ_dist.rename(columns={'Item': 'Employment'}))
+        print('Data saved to {}'.format(f_name))
     ft.process_warning_log(warnings, warnings_to_process)
+    save_profile(session)
+    flush_results(session)
 
 
-def process_ethnicity_data():
+def process_ethnicity_data(session):
     """Process Ethnicity Data."""
     warnings = ['\nProcessing Ethnicity Data Warnings:\n']
     warnings_to_process = False
@@ -551,334 +3527,524 @@ def process_ethnicity_data():
     # Confirm the required files are in place
     required_files = ['Student Data File', 'Student Data Headings File',
                       'Pacific Island Nations File']
-    ad.confirm_files('Student Data', required_files)
-    # Load Pacific Island Nations File
-    island_nations = ft.load_headings('pacific_island_nations.txt')
-    # Load ethincities data
-    student_data = ft.get_csv_fname_load('Student Data File')
-    # Load headings file
-    data_headings = ft.load_headings('data_headings.txt')
-    # Place data into a DataFrame
-    ethnicities_df = pd.DataFrame(data = student_data, columns = data_headings)
-    # Drop unnecessary columns
-    sid_col = 'StudentPK'
-    eth_col = 'Ethnicity'
-    headings = [sid_col, eth_col]
-    ethnicities_df = ethnicities_df[headings]
-    # Remove duplicate Student ID Numbers
-    ethnicities_df.drop_duplicates(sid_col, 'first', True)
-    # Remove students without an Ethnicity
-    # Set empty Ethnicity values to NaN and then drop
-    ethnicities_df[eth_col] = ethnicities_df[eth_col].apply(list_nan)
-    ethnicities_df.dropna(subset=[eth_col], inplace=True)
-    # Convert all Pacific Island nations to 'Pacific Island'
-    ethnicities_df[eth_col] = ethnicities_df[eth_col].apply(db.convert_pacific,
-                  args=(island_nations,))
-    # print(ethnicities_df)
-    # Get a list of unique ethnicities
-    unique_eth = ethnicities_df[eth_col].unique()
-    # Create a dictionary to hold count of ethnicities and populate
-    count_eths_dict = ad.create_dict(unique_eth)
-    # Get each ethnicity in a list
-    ethnicities = ethnicities_df[eth_col].tolist()
-    count_eths_dict = update_dict_counts(count_eths_dict, ethnicities)
-    # Convert to an ordered list of tuples (allow ordered display and saving)
-    count_eths_list = ad.sort_dict_values(count_eths_dict, 'descending')
-    # Create dict to hold the percentages of each ethnicity
-    percent_eths_dict, total = calculate_percent(count_eths_dict)
-    # Convert to an ordered list of tuples (allow ordered display and saving)
-    percent_eths_list = ad.sort_dict_values(percent_eths_dict, 'descending')
+    confirm_session_files(session, 'Student Data', required_files)
+    start_profile(session, 'Ethnicity Data')
+    # Count each ethnicity and calculate its percentage, removing students
+    # without an Ethnicity and grouping Pacific Island nations
+    eths_dist, total = get_category_distribution(session, 'ethnicity',
+                                                 warnings)
+    warnings_to_process = len(warnings) > 1
+    # Convert to an ordered list of tuples (allow ordered display)
+    percent_eths_list = list(zip(eths_dist['Item'],
+                                 eths_dist['Percent']))
     # Get from user the sample source
-    sample = get_sample()
+    sample = session.get('Sample') or get_sample()
     # Display results
-    print('\nPercentage of {} students by ethnicity:\n'.format(sample))
-    print("{:40} {:7}".format('Ethnicity', 'Percent'))
-    for x in percent_eths_list:
-        print("{:40} {:7}%".format(x[0], x[1]))
-    # Get a list of tuples with just results over 1%
-    threshold = 1
-    threshold_eths_list = get_threshold_items(percent_eths_list, threshold)
-    print('\nThe ethnicities above the {}% threshold are as follows:\n'.format(
-            threshold))
-    print("{:20} {:7}".format('Ethnicity', 'Percent'))
-    for x in threshold_eths_list:
-        print("{:20} {:7}%".format(x[0], x[1]))
-    print('\nTotal number of {} students in sample: {}'.format(sample, total))
-    print('\nTotal number of ethnicities in {} student sample: {}'.format(
-            sample, len(unique_eth)))
-    print('')
-    # Combine Percentage and Count columns
-    combined_lists = combine_lists(percent_eths_list, count_eths_list)
-    print('')
-    print('')
-    # Save % and # data
-    headings = ['Ethnicity', 'Percent', 'Count']
-    f_name = '{}_Ethnicities_Combined_'.format(sample)
-    ft.save_list_csv(combined_lists, headings, f_name)
+    with profile_stage(session, 'render', len(eths_dist)):
+        print('\nPercentage of {} students by ethnicity:\n'.format(sample))
+        print("{:40} {:7}".format('Ethnicity', 'Percent'))
+        for x in percent_eths_list:
+            print("{:40} {:7}%".format(x[0], x[1]))
+        # Get a list of tuples with just results over 1%
+        threshold = 1
+        threshold_eths_list = get_threshold_items(
+                get_ranked_items(eths_dist), threshold)
+        print('\nThe ethnicities above the {}% threshold are as follows:\n'
+              .format(threshold))
+        print("{:20} {:7}".format('Ethnicity', 'Percent'))
+        for x in threshold_eths_list:
+            print("{:20} {:7}%".format(x[0], x[1]))
+        print('\nTotal number of {} students in sample: {}'.format(
+              sample, total))
+        print('\nTotal number of ethnicities in {} student sample: {}'.format(
+                sample, eths_dist.attrs['Items']))
+        print('')
+    with profile_stage(session, 'save', len(eths_dist)):
+        # Save Item, Percentage and Count columns
+        f_name = save_result(session, '{}_Ethnicities_Combined'.format(sample),
+                             eths_dist.rename(columns={'Item': 'Ethnicity'}))
+        print('Data saved to {}'.format(f_name))
     ft.process_warning_log(warnings, warnings_to_process)
+    save_profile(session)
+    flush_results(session)
 
 
-def process_how_heard_data():
+def process_how_heard_data(session):
     """Process How Heard Data."""
     warnings = ['\nProcessing How Heard Data Warnings:\n']
     warnings_to_process = False
     print('\nProcessing How Heard Data.')
     # Confirm the required files are in place
     required_files = ['Student Data File', 'Student Data Headings File']
-    ad.confirm_files('Student Data', required_files)
-    # Load Student data
-    student_data = ft.get_csv_fname_load('Student Data File')
-    # Load headings file
-    data_headings = ft.load_headings('data_headings.txt')
-    # Place data into a DataFrame
-    heard_df = pd.DataFrame(data = student_data, columns = data_headings)
-    # Drop unnecessary columns
-    sid_col = 'StudentPK'
-    heard_col = 'HowHeard'
-    headings = [sid_col, heard_col]
-    heard_df = heard_df[headings]
-    # Remove duplicate Student ID Numbers
-    heard_df.drop_duplicates(sid_col, 'first', True)
-    # Convert students without a How Heard entry to 'Unknown'
-    heard_df[heard_col] = heard_df[heard_col].apply(list_unknown)
-    # Get a list of unique how heard entries
-    unique_heard = heard_df[heard_col].unique()
-    # Create a dictionary to hold count of how heard types and populate
-    count_heard_dict = ad.create_dict(unique_heard)
-    # Get each how heard type in a list
-    heard = heard_df[heard_col].tolist()
-    count_heard_dict = update_dict_counts(count_heard_dict, heard)
-    # Convert to an ordered list of tuples (allow ordered display and saving)
-    count_heard_list = ad.sort_dict_values(count_heard_dict,'descending')
-    # Create dict to hold the percentages of each how heard type
-    percent_heard_dict, total = calculate_percent(count_heard_dict)
-    # Convert to an ordered list of tuples (allow ordered display and saving)
-    percent_heard_list = ad.sort_dict_values(percent_heard_dict,'descending')
+    confirm_session_files(session, 'Student Data', required_files)
+    start_profile(session, 'How Heard Data')
+    # Count each how heard type (students without a How Heard entry as
+    # 'Unknown') and calculate its percentage
+    heard_dist, total = get_category_distribution(session, 'heard',
+                                                  warnings)
+    warnings_to_process = len(warnings) > 1
+    # Convert to an ordered list of tuples (allow ordered display)
+    percent_heard_list = list(zip(heard_dist['Item'],
+                                  heard_dist['Percent']))
     # Get from user the sample source
-    sample = get_sample()
+    sample = session.get('Sample') or get_sample()
     # Display results
-    print('\nPercentage of {} students by How Heard Type:\n'.format(sample))
-    print("{:40} {:7}".format('How Heard', 'Percent'))
-    for x in percent_heard_list:
-        print("{:40} {:7}%".format(x[0], x[1]))
-    # Get a list of tuples with just results over 1%
-    threshold = 1
-    threshold_heard_list = get_threshold_items(percent_heard_list, threshold)
-    print('\nThe How Heard Types above the {}% threshold are as follows:\n'
-          .format(threshold))
-    print("{:40} {:7}".format('How Heard', 'Percent'))
-    for x in threshold_heard_list:
-        print("{:40} {:7}%".format(x[0], x[1]))
-    print('\nTotal number of {} students in sample: {}'.format(sample, total))
-    print('')
-    # Combine Percentage and Count columns
-    combined_lists = combine_lists(percent_heard_list, count_heard_list)
-    print('')
-    print('')
-    # Save % and # data
-    headings = ['How Heard', 'Percent', 'Count']
-    f_name = '{}_How_Heard_Combined_'.format(sample)
-    ft.save_list_csv(combined_lists, headings, f_name)
+    with profile_stage(session, 'render', len(heard_dist)):
+        print('\nPercentage of {} students by How Heard Type:\n'.format(
+              sample))
+        print("{:40} {:7}".format('How Heard', 'Percent'))
+        for x in percent_heard_list:
+            print("{:40} {:7}%".format(x[0], x[1]))
+        # Get a list of tuples with just results over 1%
+        threshold = 1
+        threshold_heard_list = get_threshold_items(
+                get_ranked_items(heard_dist), threshold)
+        print('\nThe How Heard Types above the {}% threshold are as follows:\n'
+              .format(threshold))
+        print("{:40} {:7}".format('How Heard', 'Percent'))
+        for x in threshold_heard_list:
+            print("{:40} {:7}%".format(x[0], x[1]))
+        print('\nTotal number of {} students in sample: {}'.format(
+              sample, total))
+        print('')
+    with profile_stage(session, 'save', len(heard_dist)):
+        # Save Item, Percentage and Count columns
+        f_name = save_result(session, '{}_How_Heard_Combined'.format(sample),
+                             heard_dist.rename(columns={'Item': 'How Heard'}))
+        print('Data saved to {}'.format(f_name))
     ft.process_warning_log(warnings, warnings_to_process)
+    save_profile(session)
+    flush_results(session)
+
+
+def process_length_sketches(session):
+    """Process Length of Study summaries saved by earlier analyses."""
+    print('\nProcessing Length of Study Summaries.')
+    start_profile(session, 'Length of Study Summaries')
+    # Combine the summaries without the data they were made from
+    with profile_stage(session, 'load') as stage:
+        sketches = [load_length_sketch(x) for x in
+                    session['Length Sketches']]
+        stage['Rows Out'] = len(sketches)
+    with profile_stage(session, 'aggregate', len(sketches)) as stage:
+        sketch = merge_length_sketches(sketches)
+        stats = get_length_statistics(sketch)
+        stage['Rows Out'] = len(stats)
+    sample = session.get('Sample') or 'Merged'
+    with profile_stage(session, 'render', len(stats)):
+        print('\nStatistics for {} summaries:\n'.format(len(sketches)))
+        print(stats)
+    # Save data to file
+    with profile_stage(session, 'save', len(stats)):
+        f_name = save_result(session, '{}_Graduates_Statistics'.format(
+                sample), stats.reset_index())
+        print('\nData saved to {}'.format(f_name))
+        time_string = ft.generate_time_string()
+        sketch_name = get_output_name(session,
+                '{}_Graduates_Summary_{}{}'.format(sample, time_string,
+                '.json'))
+        save_length_sketch(sketch, sketch_name)
+        print('Summary saved to {}'.format(sketch_name))
+    save_profile(session)
+    flush_results(session)
 
 
-def process_location_data():
+def process_location_data(session):
     """Process Location Data."""
     warnings = ['\nProcessing Location Data Warnings:\n']
     warnings_to_process = False
     print('\nProcessing Location Data.')
     # Confirm the required files are in place
     required_files = ['Student Data File', 'Student Data Headings File']
-    ad.confirm_files('Student Data', required_files)
-    # Load Student data
-    students_data = ft.get_csv_fname_load('Student Data File')
-    # Load headings file
-    data_headings = ft.load_headings('data_headings.txt')
-    # Place data into a DataFrame
-    cities_df = pd.DataFrame(data = students_data, columns = data_headings)
-    # Remove unnecessary columns
-    sid_col = 'StudentPK'
-    city_col = 'AddressCity'
-    country_col = 'AddressCountry'
-    headings = [sid_col, city_col, country_col]
-    cities_df = cities_df[headings]
-    # Remove duplicate Student ID Numbers
-    cities_df.drop_duplicates(sid_col, 'first', True)
-    # Remove students without an AddressCity
-    # Set empty AddressCity values to NaN and then drop
-    cities_df[city_col] = cities_df[city_col].apply(list_nan)
-    cities_df.dropna(subset=[city_col], inplace=True)
-    # Remove students without New Zealand in AddressCountry
-    # Set non-New Zealand values to NaN and then drop
-    cities_df[country_col] = cities_df[country_col].apply(ad.convert_to_nan, 
-             args=(['New Zealand'], False,))
-    cities_df.dropna(subset=[country_col], inplace=True)
-    # Get a list of unique cities
-    unique_cities = cities_df[city_col].unique()
-    # Create a dictionary to hold count of cities and populate
-    count_cities_dict = ad.create_dict(unique_cities)
-    # Get each city in a list
-    cities = cities_df[city_col].tolist()
-    count_cities_dict = update_dict_counts(count_cities_dict, cities)
-    # Convert to an ordered list of tuples (allow ordered display and saving)
-    count_cities_list = ad.sort_dict_values(count_cities_dict,'descending')
-    # Create dict to hold the percentages of each city
-    percent_cities_dict, total = calculate_percent(count_cities_dict)
-    # Convert to an ordered list of tuples (allow ordered display and saving)
-    percent_cities_list = ad.sort_dict_values(percent_cities_dict,'descending')
+    confirm_session_files(session, 'Student Data', required_files)
+    start_profile(session, 'Location Data')
+    # Count each city and calculate its percentage, removing students without
+    # an AddressCity or not in New Zealand
+    cities_dist, total = get_category_distribution(session, 'location',
+                                                   warnings)
+    warnings_to_process = len(warnings) > 1
+    # Convert to an ordered list of tuples (allow ordered display)
+    percent_cities_list = list(zip(cities_dist['Item'],
+                                   cities_dist['Percent']))
     # Get from user the sample source
-    sample = get_sample()
+    sample = session.get('Sample') or get_sample()
     # Display results
-    print('\nPercentage of {} students by City:\n'.format(sample))
-    print("{:20} {:7}".format('City', 'Percent'))
-    for x in percent_cities_list:
-        print("{:20} {:7}%".format(x[0], x[1]))
-    # Get a list of tuples with just results over 1%
-    threshold = 1
-    threshold_cities_list = get_threshold_items(percent_cities_list, threshold)
-    print('\nThe cities above the {}% threshold are as follows:\n'.format(
-            threshold))
-    print("{:20} {:7}".format('City', 'Percent'))
-    for x in threshold_cities_list:
-        print("{:20} {:7}%".format(x[0], x[1]))
-    print('\nTotal number of {} students in sample: {}'.format(sample, total))
-    print('\nTotal number of cities in {} student sample: {}'.format(
-            sample, len(unique_cities)))
-    print('')
-    # Combine Percentage and Count columns
-    combined_lists = combine_lists(percent_cities_list, count_cities_list)
-    print('')
-    # Save % and # data
-    headings = ['City', 'Percent', 'Count']
-    f_name = '{}_Cities_Combined_'.format(sample)
-    print('') 
-    ft.save_list_csv(combined_lists, headings, f_name)
+    with profile_stage(session, 'render', len(cities_dist)):
+        print('\nPercentage of {} students by City:\n'.format(sample))
+        print("{:20} {:7}".format('City', 'Percent'))
+        for x in percent_cities_list:
+            print("{:20} {:7}%".format(x[0], x[1]))
+        # Get a list of tuples with just results over 1%
+        threshold = 1
+        threshold_cities_list = get_threshold_items(
+                get_ranked_items(cities_dist), threshold)
+        print('\nThe cities above the {}% threshold are as follows:\n'
+              .format(threshold))
+        print("{:20} {:7}".format('City', 'Percent'))
+        for x in threshold_cities_list:
+            print("{:20} {:7}%".format(x[0], x[1]))
+        print('\nTotal number of {} students in sample: {}'.format(
+              sample, total))
+        print('\nTotal number of cities in {} student sample: {}'.format(
+                sample, cities_dist.attrs['Items']))
+        print('')
+    with profile_stage(session, 'save', len(cities_dist)):
+        # Save Item, Percentage and Count columns
+        f_name = save_result(session, '{}_Cities_Combined'.format(sample),
+                             cities_dist.rename(columns={'Item': 'City'}))
+        print('Data saved to {}'.format(f_name))
     ft.process_warning_log(warnings, warnings_to_process)
+    save_profile(session)
+    flush_results(session)
 
 
-def process_study_length():
+def process_study_length(session):
     """Process time taken to graduate on average."""
     warnings = ['\nProcessing Length of Study Data Warnings:\n']
     warnings_to_process = False
     print('\nProcessing Length of Study Data.')
     # Confirm the required files are in place
     required_files = ['Enrolments File', 'Graduates File']
-    ad.confirm_files('Length of Study Data', required_files)
-    # Load enrolment data
-    enrolment_data = ft.get_csv_fname_load('Enrolment Data')
-    # Place data into a DataFrame
-    enrolpk_col = 'EnrolmentPK'
-    sid_col = 'StudentFK'
-    course_col = 'CourseFK'
-    tutor_col = 'TutorFK'
+    confirm_session_files(session, 'Length of Study Data', required_files)
+    start_profile(session, 'Length of Study Data')
     start_col = 'StartDate'
-    expiry_col = 'ExpiryDate'
-    status_col = 'Status'
-    tag_col = 'Tag'
-    en_headings = [enrolpk_col, sid_col, course_col, tutor_col, start_col,
-                expiry_col, status_col, tag_col]
-    enrolment_df = pd.DataFrame(data = enrolment_data, columns = en_headings)
-    en_headings = [enrolpk_col, course_col, start_col, status_col]
-    enrolment_df = enrolment_df[en_headings]
-    # Load graduates data
-    graduate_data = ft.get_csv_fname_load('Graduates Data')
-    # Place data into a DataFrame
-    gradpk_col = 'GraduatePK'
     grad_date_col = 'GraduationDate'
-    cert_col = 'CertificateNumber'
-    type_col = 'Type'
-    length_col = 'LengthOfStudy'
-    grad_headings = [gradpk_col, enrolpk_col, grad_date_col, cert_col]
-    grads_df = pd.DataFrame(data = graduate_data, columns = grad_headings)
-    # Merge the two dataframes and keep required columns
-    updated_grads = pd.merge(enrolment_df, grads_df, on=enrolpk_col,
-                             how='inner')
-    grad_headings = [enrolpk_col, course_col, start_col, grad_date_col]
-    updated_grads = updated_grads[grad_headings]
-    # Add column for course type and populate
-    updated_grads[type_col] = updated_grads[course_col].apply(get_course_type)
-    # Add column for length of study and populate
-    updated_grads[length_col] = updated_grads.apply(lambda x: 
-        da.calculate_days(x[start_col], x[grad_date_col]), axis=1)
-    # Group data by course Type
-    grouped_grads = updated_grads.groupby(type_col)
-    stats = grouped_grads.aggregate([np.mean, np.median, np.max, np.min])
+    # Summarise length of study data by course Type, taking the summary from
+    # the result cache if it has already been calculated
+    parameters = {'Bin Days': LENGTH_BIN_DAYS,
+                  'Course Type Pattern': COURSE_TYPE_PATTERN,
+                  'Headings': [ENROLMENT_HEADINGS, GRADUATE_HEADINGS],
+                  'Column Types': COLUMN_TYPES,
+                  'Incremental': session.get('Incremental', USE_INCREMENTAL)}
+    entry_dir = get_result_entry(session, 'length', ['Enrolments File',
+                                 'Graduates File'], parameters)
+    result = load_cached_result(session, entry_dir)
+    if result is None:
+        sketch, negative = get_length_sketch(session)
+        if entry_dir is not None:
+            os.makedirs(entry_dir, exist_ok=True)
+            save_length_sketch(sketch, os.path.join(entry_dir,
+                                                    'sketch.json'))
+        save_cached_result(session, entry_dir, {'Negative': negative},
+                           {'Enrolments File': [start_col],
+                            'Graduates File': [grad_date_col]})
+    else:
+        sketch = load_length_sketch(os.path.join(entry_dir, 'sketch.json'))
+        negative = result['Negative']
+    # Report any invalid dates and graduations before the start date
+    if add_date_warnings(session, 'Enrolments File', [start_col], warnings):
+        warnings_to_process = True
+    if add_date_warnings(session, 'Graduates File', [grad_date_col],
+                         warnings):
+        warnings_to_process = True
+    if negative:
+        warnings.append('{} graduates have a GraduationDate before their '
+                        'StartDate.\n'.format(negative))
+        warnings_to_process = True
+    with profile_stage(session, 'aggregate', len(sketch['Types'])) as stage:
+        stats = get_length_statistics(sketch)
+        stage['Rows Out'] = len(stats)
     # Get from user the sample source
-    sample = get_sample()
-    print('\nStatistics for {}:\n'.format(sample))
-    print(stats)
+    sample = session.get('Sample') or get_sample()
+    with profile_stage(session, 'render', len(stats)):
+        print('\nStatistics for {}:\n'.format(sample))
+        print(stats)
     # Save data to file
-    f_name = '{}_Graduates_Statistics_{}{}'.format(sample,
-              ft.generate_time_string(), '.xls')
-    stats.to_excel(f_name)
-    print('\nData saved to {}'.format(f_name))
+    with profile_stage(session, 'save', len(stats)):
+        f_name = save_result(session, '{}_Graduates_Statistics'.format(
+                sample), stats.reset_index())
+        print('\nData saved to {}'.format(f_name))
+        time_string = ft.generate_time_string()
+        # Save the summary so that it can be combined with other summaries
+        sketch_name = get_output_name(session,
+                '{}_Graduates_Summary_{}{}'.format(sample, time_string,
+                '.json'))
+        save_length_sketch(sketch, sketch_name)
+        print('Summary saved to {}'.format(sketch_name))
     # print('Groups: {}'.format(grouped_grads.groups.keys()))
     # print(updated_grads)
     ft.process_warning_log(warnings, warnings_to_process)
+    save_profile(session)
+    flush_results(session)
     
 
-def process_study_reason_data():
+def process_study_reason_data(session):
     """Process Study Reason Data."""
     warnings = ['\nProcessing Reason for Study Data Warnings:\n']
     warnings_to_process = False
     print('\nProcessing Reason for Study Data.')
     # Confirm the required files are in place
     required_files = ['Student Data File', 'Student Data Headings File']
-    ad.confirm_files('Student Data', required_files)
-    # Load Student data
-    students_data = ft.get_csv_fname_load('Student Data File')
-    # Load headings file
-    data_headings = ft.load_headings('data_headings.txt')
-    # Place data into a DataFrame
-    study_df = pd.DataFrame(data = students_data, columns = data_headings)
-    # Remove unnecessary columns
-    sid_col = 'StudentPK'
-    reason_col = 'ReasonForStudy'
-    headings = [sid_col, reason_col]
-    study_df = study_df[headings]
-    # Remove duplicate Student ID Numbers
-    study_df.drop_duplicates(sid_col, 'first', True)
-    # Convert students without a study reason entry to 'Unknown'
-    study_df[reason_col] = study_df[reason_col].apply(list_unknown)
-    # Get a list of unique study reason entries
-    unique_reason = study_df[reason_col].unique()
-    # Create a dictionary to hold count of study reason types and populate
-    count_reason_dict = ad.create_dict(unique_reason)
-    # Get each study reason type in a list
-    reason = study_df[reason_col].tolist()
-    count_reason_dict = update_dict_counts(count_reason_dict, reason)
-    # Convert to an ordered list of tuples (allow ordered display and saving)
-    count_reason_list = ad.sort_dict_values(count_reason_dict,'descending')
-    # Create dict to hold the percentages of each study reason type
-    percent_reason_dict, total = calculate_percent(count_reason_dict)
-    # Convert to an ordered list of tuples (allow ordered display and saving)
-    percent_reason_list = ad.sort_dict_values(percent_reason_dict,'descending')
+    confirm_session_files(session, 'Student Data', required_files)
+    start_profile(session, 'Study Reason Data')
+    # Count each study reason type (students without a study reason entry as
+    # 'Unknown') and calculate its percentage
+    reason_dist, total = get_category_distribution(session, 'reason',
+                                                   warnings)
+    warnings_to_process = len(warnings) > 1
+    # Convert to an ordered list of tuples (allow ordered display)
+    percent_reason_list = list(zip(reason_dist['Item'],
+                                   reason_dist['Percent']))
     # Get from user the sample source
-    sample = get_sample()
+    sample = session.get('Sample') or get_sample()
     # Display results
-    print('\nPercentage of {} students by Study Reason Type:\n'.format(sample))
-    print("{:50} {:7}".format('Study Reason', 'Percent'))
-    for x in percent_reason_list:
-        print("{:50} {:7}%".format(x[0], x[1]))
-    # Get a list of tuples with just results over 1%
-    threshold = 1
-    threshold_reason_list = get_threshold_items(percent_reason_list, threshold)
-    print('\nThe Study Reason Types above the {}% threshold are as follows:\n'
-          .format(threshold))
-    print("{:50} {:7}".format('Study Reason', 'Percent'))
-    for x in threshold_reason_list:
-        print("{:50} {:7}%".format(x[0], x[1]))
-    print('\nTotal number of {} students in sample: {}'.format(sample, total))
-    print('')
-    # Combine Percentage and Count columns
-    combined_lists = combine_lists(percent_reason_list, count_reason_list)
-    print('')
-    print('')
-    # Save % and # data
-    headings = ['Study Reason', 'Percent', 'Count']
-    f_name = '{}_Study_Reason_Combined_'.format(sample)
-    ft.save_list_csv(combined_lists, headings, f_name)
+    with profile_stage(session, 'render', len(reason_dist)):
+        print('\nPercentage of {} students by Study Reason Type:\n'.format(
+              sample))
+        print("{:50} {:7}".format('Study Reason', 'Percent'))
+        for x in percent_reason_list:
+            print("{:50} {:7}%".format(x[0], x[1]))
+        # Get a list of tuples with just results over 1%
+        threshold = 1
+        threshold_reason_list = get_threshold_items(
+                get_ranked_items(reason_dist), threshold)
+        print('\nThe Study Reason Types above the {}% threshold '
+              'are as follows:\n'.format(threshold))
+        print("{:50} {:7}".format('Study Reason', 'Percent'))
+        for x in threshold_reason_list:
+            print("{:50} {:7}%".format(x[0], x[1]))
+        print('\nTotal number of {} students in sample: {}'.format(
+              sample, total))
+        print('')
+    with profile_stage(session, 'save', len(reason_dist)):
+        # Save Item, Percentage and Count columns
+        f_name = save_result(session, '{}_Study_Reason_Combined'.format(
+                sample), reason_dist.rename(columns={'Item': 'Study Reason'}))
+        print('Data saved to {}'.format(f_name))
     ft.process_warning_log(warnings, warnings_to_process)
+    save_profile(session)
+    flush_results(session)
+
+
+def profile_stage(session, stage, rows_in=None):
+    """Return a context that records a stage of the analysis being profiled.
+    
+    The context gives a dict that Rows Out can be set in. If the session is
+    not being profiled nothing is recorded.
+    
+    Args:
+        session (dict): Data loaded in the current session, by source.
+        stage (str): Name of the stage, one of PROFILE_STAGES.
+        rows_in (int): Optional number of rows going into the stage.
+        
+    Returns:
+        context (context manager): Context to run the stage in.
+    """
+    profile = session.get('Profile Data')
+    if profile is None:
+        return contextlib.nullcontext({})
+    return record_stage(profile, stage, rows_in)
+
+
+@contextlib.contextmanager
+def record_stage(profile, stage, rows_in=None):
+    """Record the time, rows and peak memory of a stage in a profile.
+    
+    Repeated stages, e.g. for each chunk of a streamed file, are added
+    together. Time spent in a stage run within another stage is only counted
+    against the inner stage.
+    
+    Args:
+        profile (dict): Profile of the analysis, from start_profile.
+        stage (str): Name of the stage.
+        rows_in (int): Optional number of rows going into the stage.
+        
+    Yields:
+        record (dict): Details of this run of the stage, Rows Out can be set.
+    """
+    record = {'Rows Out': None, 'Peak': 0, 'Inner Wall': 0.0,
+              'Inner CPU': 0.0}
+    # Keep the peak so far before measuring the peak of this stage
+    current_peak = tracemalloc.get_traced_memory()[1]
+    profile['Peak'] = max(profile['Peak'], current_peak)
+    for outer in profile['Active']:
+        outer['Peak'] = max(outer['Peak'], current_peak)
+    tracemalloc.reset_peak()
+    profile['Active'].append(record)
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield record
+    finally:
+        elapsed_wall = time.perf_counter() - wall_start
+        elapsed_cpu = time.process_time() - cpu_start
+        profile['Active'].pop()
+        if profile['Active']:
+            profile['Active'][-1]['Inner Wall'] += elapsed_wall
+            profile['Active'][-1]['Inner CPU'] += elapsed_cpu
+        wall = elapsed_wall - record['Inner Wall']
+        cpu = elapsed_cpu - record['Inner CPU']
+        peak = max(record['Peak'], tracemalloc.get_traced_memory()[1])
+        profile['Peak'] = max(profile['Peak'], peak)
+        totals = profile['Stages'].setdefault(stage, {'Calls': 0,
+                'Wall Seconds': 0.0, 'CPU Seconds': 0.0, 'Rows In': None,
+                'Rows Out': None, 'Peak MB': 0.0})
+        totals['Calls'] += 1
+        totals['Wall Seconds'] += wall
+        totals['CPU Seconds'] += cpu
+        for key, rows in (('Rows In', rows_in),
+                          ('Rows Out', record['Rows Out'])):
+            if rows is not None:
+                totals[key] = (totals[key] or 0) + int(rows)
+        totals['Peak MB'] = max(totals['Peak MB'], peak / 1024 / 1024)
+
+
+def rollup_cube(cube, dimensions, filters=None):
+    """Return the counts of a cube rolled up to some of its dimensions.
+    
+    Args:
+        cube (Series): Count of students for each combination of dimension
+        values, as returned by build_cube.
+        dimensions (list): Dimensions to keep.
+        filters (dict): Optional value to filter on, by dimension.
+        
+    Returns:
+        counts (Series): Count of students for each combination of values of
+        dimensions, in dimension value order.
+    """
+    keep = np.ones(len(cube), dtype=bool)
+    for dimension, value in (filters or {}).items():
+        keep &= np.asarray(cube.index.get_level_values(dimension) == value)
+    return cube[keep].groupby(level=list(dimensions), observed=True).sum()
+
+
+def run_batch(job):
+    """Run every analysis in a batch job for every sample without prompts.
+    
+    An analysis that cannot be run, or that fails, is reported and the
+    remaining analyses are still run. If the job has more than one worker the
+    analyses are run in parallel in a pool of worker processes. The data
+    files are parsed once into the cache first, so that each worker
+    memory-maps the parsed data rather than parsing it again, unless the job
+    is streaming. The output of each analysis is printed in job order once
+    all analyses are complete.
+    
+    With the xlsx and parquet output formats the results of every analysis
+    are written together, in job order, once all analyses are complete. If
+    the job uses the result cache, the hits and misses of every analysis are
+    reported at the end of the run.
+    
+    Args:
+        job (dict): Batch job as returned by load_batch_job.
+        
+    Returns:
+        failures (int): Number of analyses that could not be completed.
+    """
+    os.makedirs(job['output_dir'], exist_ok=True)
+    tasks, failures = get_batch_tasks(job)
+    workers = min(job.get('workers', 1), len(tasks))
+    results = []
+    stats = {'Hits': 0, 'Misses': 0}
+    if workers > 1:
+        # Workers share the parsed data through the cache, unless streaming
+        if not job['stream']:
+            for description, session, function in tasks:
+                session['Use Cache'] = True
+        hash_batch_files(tasks)
+        if not job['stream']:
+            cache_batch_files(tasks)
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            task_results = list(executor.map(run_batch_task, tasks))
+        for output, failed, task_result, task_stats in task_results:
+            print(output, end='')
+            failures += failed
+            results.extend(task_result)
+            for key, value in task_stats.items():
+                stats[key] += value
+    else:
+        for description, session, function in tasks:
+            # Every analysis adds its results and result cache lookups to
+            # those of the run
+            session['Results'] = results
+            session['Result Stats'] = stats
+            try:
+                function(session)
+            except Exception as e:
+                print('\n{} failed: {}'.format(description, e))
+                failures += 1
+        for _, session, _ in tasks:
+            close_writer(session)
+    if results:
+        output = {'Output Dir': job['output_dir'],
+                  'Output Format': job['output_format'], 'Results': results}
+        try:
+            flush_results(output)
+        except Exception as e:
+            print('\nResults could not be saved: {}'.format(e))
+            failures += 1
+        finally:
+            close_writer(output)
+    if job['result_cache']:
+        print_result_stats(stats)
+    print('\nBatch complete. {} analyses could not be completed.'.format(
+            failures))
+    return failures
+
+
+def run_batch_task(task):
+    """Run a single batch analysis in a worker process.
+    
+    Args:
+        task (tuple): Description, session and function of the analysis.
+        
+    Returns:
+        output (str): Text printed by the analysis.
+        failed (bool): Whether the analysis failed.
+        results (list): Name and table of each result to be written with
+        the other results of the run.
+        stats (dict): Number of result cache hits and misses.
+    """
+    description, session, function = task
+    output = io.StringIO()
+    failed = False
+    with contextlib.redirect_stdout(output):
+        try:
+            function(session)
+        except Exception as e:
+            print('\n{} failed: {}'.format(description, e))
+            failed = True
+        finally:
+            close_writer(session)
+    return (output.getvalue(), failed, session.get('Results', []),
+            session.get('Result Stats', {}))
+
+
+def run_server(args):
+    """Answer distribution, threshold and length of study queries over HTTP.
+    
+    The data files are loaded once and queries are answered from them until
+    the server is stopped. The files are checked for changes every
+    SERVER_POLL_SECONDS and reloaded in the background, queries being
+    answered from the previous data until the reload is complete.
+    
+    Args:
+        args (Namespace): Parsed command line arguments.
+    """
+    sources = [('Student Data File', 'student_data'),
+               ('Enrolments File', 'enrolments'),
+               ('Graduates File', 'graduates')]
+    server = {'Files': {x: getattr(args, y) for x, y in sources if
+                        getattr(args, y)},
+              'Age Reference': args.age_reference or 'Today',
+              'Use Cache': args.cache,
+              'Top Items': TOP_ITEMS if args.top is None else args.top,
+              'Min Percent': (MIN_PERCENT if args.min_percent is None else
+                              args.min_percent)}
+    print('\nLoading data files.')
+    server['Snapshot'] = load_server_snapshot(server)
+    threading.Thread(target=watch_server_files, args=(server,),
+                     daemon=True).start()
+    port = args.port or SERVER_PORT
+    httpd = simple_server.make_server(SERVER_HOST, port,
+            functools.partial(serve_request, server))
+    print('\nServing queries at http://{}:{}/ (press Ctrl+C to stop).'
+          .format(SERVER_HOST, port))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print('\nServer stopped.')
+    finally:
+        httpd.server_close()
 
 
 def sample_menu():
@@ -894,44 +4060,488 @@ def sample_menu():
     print('8: Other Students')
 
 
-def total_dict_values(source_dict):
-    """Return the total of all values in a dictionary.
+def save_cached_columns(entry_dir, data):
+    """Save the columns of a parsed data file to a cache entry.
     
-    Counts up the values of each key to generate a total. All values must be
-    an int.
+    Each column is saved as .npy arrays. Text is saved as integer codes and
+    a list of categories, and integers (in their compact type) as values and
+    a missing value mask.
     
     Args:
-        source_dict (dict): Dictionary to be tallied.
+        entry_dir (str): Cache entry directory.
+        data (DataFrame): Parsed columns to be saved.
+    """
+    manifest = os.path.join(entry_dir, 'columns.json')
+    try:
+        with open(manifest) as f:
+            kinds = json.load(f)
+    except (OSError, ValueError):
+        kinds = {}
+    for column in data.columns:
+        path = os.path.join(entry_dir, column)
+        values = data[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            kind = 'category'
+            codes = values.cat.codes.to_numpy()
+            categories = values.cat.categories.tolist()
+        elif pd.api.types.is_integer_dtype(values.dtype):
+            kind = 'int'
+            np.save(path + '.values.npy', values.to_numpy(
+                    dtype=values.dtype.numpy_dtype, na_value=0))
+            np.save(path + '.mask.npy', values.isna().to_numpy())
+        elif pd.api.types.is_datetime64_any_dtype(values.dtype):
+            kind = 'date'
+            np.save(path + '.values.npy', values.to_numpy())
+        else:
+            kind = 'text'
+            codes, categories = pd.factorize(values)
+            categories = categories.tolist()
+        if kind in ('category', 'text'):
+            np.save(path + '.codes.npy', codes)
+            with open(path + '.categories.json', 'w') as f:
+                json.dump(categories, f)
+        kinds[column] = kind
+    # Record the invalid dates found when the columns were parsed
+    invalid_name = os.path.join(entry_dir, 'invalid_dates.json')
+    try:
+        with open(invalid_name) as f:
+            invalid_dates = json.load(f)
+    except (OSError, ValueError):
+        invalid_dates = {}
+    invalid_dates.update(data.attrs.get('Invalid Dates', {}))
+    write_json_atomic(invalid_dates, invalid_name)
+    # Manifest is written last so that partly saved columns are never used
+    write_json_atomic(kinds, manifest)
+
+
+def save_cached_result(session, entry_dir, result, date_columns=None):
+    """Save a result to the result cache.
+    
+    The least recently used results, and results that have not been used for
+    RESULT_MAX_DAYS days, are then removed from the cache.
+    
+    Args:
+        session (dict): Data loaded in the current session, by source.
+        entry_dir (str): Result cache entry directory, as returned by
+        get_result_entry, or None if the result cache is not used.
+        result (dict): Result to be saved, which can be saved as json.
+        date_columns (dict): Optional date columns of each source whose
+        invalid dates are to be saved with the result.
+    """
+    if entry_dir is None:
+        return
+    result = dict(result, **{'Invalid Dates': {}})
+    for source, columns in (date_columns or {}).items():
+        invalid_dates = session[source].get('Invalid Dates', {})
+        result['Invalid Dates'][source] = {x: invalid_dates[x] for x in
+                                           columns if x in invalid_dates}
+    os.makedirs(entry_dir, exist_ok=True)
+    write_json_atomic(result, os.path.join(entry_dir, 'result.json'))
+    evict_cache(os.path.dirname(entry_dir), RESULT_LIMIT_MB, entry_dir,
+                RESULT_MAX_DAYS)
+
+
+def save_key_index(entry_dir, column, index):
+    """Save the key index of a column to a cache entry.
+    
+    The index is written to a temporary file of its own first, so that a
+    partly saved index is never used, even by other processes saving the
+    same index.
+    
+    Args:
+        entry_dir (str): Cache entry directory.
+        column (str): Key column.
+        index (dict): Key index, as returned by build_key_index.
+    """
+    f_name = os.path.join(entry_dir, column + '.index.npz')
+    handle, temp_name = tempfile.mkstemp(prefix=column + '.index.',
+                                         suffix='.tmp', dir=entry_dir)
+    with os.fdopen(handle, 'wb') as f:
+        np.savez(f, **index)
+    os.replace(temp_name, f_name)
+
+
+def save_length_sketch(sketch, file_name):
+    """Save a length of study summary to a json file.
+    
+    Args:
+        sketch (dict): Length of study summary.
+        file_name (str): Name of the json file.
+    """
+    saved = {'Bin Days': sketch['Bin Days'], 'Types': {}}
+    for course_type, summary in sketch['Types'].items():
+        saved['Types'][course_type] = dict(summary, Bins=dict(zip(
+                [str(x) for x in summary['Bins'].index],
+                summary['Bins'].tolist())))
+    write_json_atomic(saved, file_name)
+
+
+def save_profile(session):
+    """Save the profile of the analysis that has just run, if profiling.
+    
+    The profile is saved as json, and as csv with a row for each stage.
+    
+    Args:
+        session (dict): Data loaded in the current session, by source.
+    """
+    profile = session.pop('Profile Data', None)
+    if profile is None:
+        return
+    wall = time.perf_counter() - profile['Wall Start']
+    cpu = time.process_time() - profile['CPU Start']
+    peak = max(profile['Peak'], tracemalloc.get_traced_memory()[1])
+    if profile['Started Tracing']:
+        tracemalloc.stop()
+    stages = [dict(profile['Stages'][x], Stage=x) for x in PROFILE_STAGES
+              if x in profile['Stages']]
+    stages.append({'Stage': 'other', 'Calls': 1,
+                   'Wall Seconds': wall - sum(x['Wall Seconds'] for x in
+                                              stages),
+                   'CPU Seconds': cpu - sum(x['CPU Seconds'] for x in stages),
+                   'Rows In': None, 'Rows Out': None, 'Peak MB': None})
+    report = {'Analysis': profile['Analysis'], 'Wall Seconds': wall,
+              'CPU Seconds': cpu, 'Peak MB': peak / 1024 / 1024,
+              'Stages': stages}
+    f_name = get_output_name(session, '{}_Profile_{}'.format(
+            profile['Analysis'].replace(' ', '_'), ft.generate_time_string()))
+    write_json_atomic(report, f_name + '.json')
+    headings = ['Stage', 'Calls', 'Wall Seconds', 'CPU Seconds', 'Rows In',
+                'Rows Out', 'Peak MB']
+    with open(f_name + '.csv', 'w', newline='') as f:
+        writer = csv.DictWriter(f, headings)
+        writer.writeheader()
+        writer.writerows(stages)
+    print('\nProfile saved to {}.json and {}.csv'.format(f_name, f_name))
+
+
+def save_result(session, name, table):
+    """Save a table of results, in the format of the session.
+    
+    The results are written by a background thread. With the csv format
+    the table is saved to its own file, with the time added to name.
+    Otherwise it is kept to be written with the other results of the run by
+    flush_results.
+    
+    Args:
+        session (dict): Data loaded in the current session, by source.
+        name (str): Name of the results, e.g. 'All_Cities_Combined'.
+        table (DataFrame): Results to be saved.
         
     Returns:
-        total (int): Total of all values.
+        saved_to (str): Where the results are saved, for display.
     """
-    total = 0
-    for key, value in source_dict.items():
-        if ad.check_is_int(value):
-            total += value
-            # Skip if not an int
-    return total
+    if session.get('Output Format', OUTPUT_FORMAT) == 'csv':
+        f_name = get_output_name(session, '{}_{}.csv'.format(name,
+                ft.generate_time_string()))
+        submit_write(session, table.to_csv, f_name, index=False)
+        return f_name
+    session.setdefault('Results', []).append((name, table))
+    return '{} in the results file'.format(name)
+
+
+def save_state(state_name, state):
+    """Save the results of an analysis, replacing any saved results.
+    
+    Args:
+        state_name (str): Name of the saved results file.
+        state (dict): Results as returned by load_state.
+    """
+    os.makedirs(os.path.dirname(state_name), exist_ok=True)
+    arrays = {x: y for x, y in state.items() if x not in ('Items', 'Settings')}
+    arrays['Details'] = np.array(json.dumps({'Settings': state['Settings'],
+                                             'Items': state['Items']}))
+    temp_name = state_name + '.tmp'
+    with open(temp_name, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(temp_name, state_name)
 
 
-def update_dict_counts(dictionary, values):
-    """Updates key values in dictionary based on counts of items.
+def select_top_items(counts, total, top=None, min_percent=None):
+    """Return the items with the largest counts and the remaining items.
+    
+    Items with less than min_percent of total (rounded to 2 decimal places,
+    as displayed) are removed, then the top items by count are kept, taking
+    items with the same count in item order. The top items are found by
+    partial selection rather than by sorting every item.
     
     Args:
-        dictionary (dict): Dictionary to update. Values should be ints.
-        values (list): List of values. Values should appear in dictionary as
-        keys. If not, they will be added as a key.
+        counts (Series): Count of each item.
+        total (int): Total of all counts.
+        top (int): Optional maximum number of items to keep.
+        min_percent (float): Optional minimum percentage of an item to keep.
+        
+    Returns:
+        kept (Series): Counts of the items kept, in their original order.
+        other (Series): Counts of the remaining items.
+    """
+    values = counts.to_numpy()
+    keep = np.ones(len(values), dtype=bool)
+    if min_percent is not None and total:
+        keep &= np.round(values / total * 100, 2) >= min_percent
+    kept = np.flatnonzero(keep)
+    if top is not None and len(kept) > top:
+        kept_values = values[kept]
+        # Smallest count to keep, found without sorting every item
+        nth = len(kept) - max(top, 1)
+        cutoff = np.partition(kept_values, nth)[nth]
+        tied = kept[kept_values == cutoff]
+        tied = tied[counts.index[tied].argsort(kind='stable')]
+        kept = np.concatenate([kept[kept_values > cutoff], tied])[:max(top, 0)]
+        keep = np.zeros(len(values), dtype=bool)
+        keep[kept] = True
+    return counts[keep], counts[~keep]
+
+
+def serve_request(server, environ, start_response):
+    """Answer a request to the analysis server, as a WSGI application.
     
+    Args:
+        server (dict): Files, settings and Snapshot of the analysis server.
+        environ (dict): WSGI environment of the request.
+        start_response (function): WSGI function to start the response.
+        
     Returns:
-        updated_dict (dict): dictionary with key values updated.
+        body (list): JSON response body.
     """
-    for item in values:
-        if item in dictionary.keys():
-            dictionary[item] = dictionary[item] + 1
-        else:
-            dictionary[item] = 1
-    return dictionary
+    if environ['REQUEST_METHOD'] != 'GET':
+        status, body = '405 Method Not Allowed', {'error': 'Only GET queries '
+                                                  'are supported'}
+    else:
+        query = {x: y[-1] for x, y in urllib.parse.parse_qs(
+                 environ.get('QUERY_STRING', '')).items()}
+        status, body = get_server_response(server, environ.get('PATH_INFO',
+                                           '/'), query)
+    data = json.dumps(body).encode('utf-8')
+    start_response(status, [('Content-Type', 'application/json'),
+                            ('Content-Length', str(len(data)))])
+    return [data]
+
+
+def start_profile(session, analysis):
+    """Start profiling an analysis, if the session is being profiled.
+    
+    Memory is traced with tracemalloc while the analysis is profiled.
+    
+    Args:
+        session (dict): Data loaded in the current session, by source.
+        analysis (str): Name of the analysis, e.g. 'Age Data'.
+    """
+    if not session.get('Profile', PROFILE):
+        return
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    session['Profile Data'] = {'Analysis': analysis, 'Stages': {},
+                               'Started Tracing': started_tracing,
+                               'Active': [], 'Peak': 0,
+                               'Wall Start': time.perf_counter(),
+                               'CPU Start': time.process_time()}
+
+
+def stream_sample_rows(session, columns, ethnicity_groups,
+                       graduate_enrolments=None):
+    """Yield the rows of every sample of the Student Data File in chunks.
+    
+    As for get_sample_rows, each row is repeated for every sample it belongs
+    to, and only the first row for each Student ID Number in each sample of
+    the whole file is yielded. Student ID Numbers already seen are held in a
+    bitmap for each sample.
+    
+    Args:
+        session (dict): Data loaded in the current session, by source.
+        columns (list): Columns required by the analysis, including
+        StudentPK, EnrolmentPK, Status and Ethnicity.
+        ethnicity_groups (dict): Group of each grouped ethnicity, as returned
+        by get_ethnicity_groups.
+        graduate_enrolments (Series): Optional EnrolmentPK of each graduate.
+        
+    Yields:
+        sample_df (DataFrame): Rows of the next students of every sample.
+    """
+    sid_col = 'StudentPK'
+    seen = {x: {'Bitmap': np.zeros(0, dtype=bool), 'Missing': False} for x
+            in SAMPLES}
+    for chunk in stream_student_data(session, columns, dedupe=False):
+        with profile_stage(session, 'transform', len(chunk)) as stage:
+            flags = get_sample_flags(chunk, ethnicity_groups,
+                                     graduate_enrolments)
+            stage['Rows Out'] = len(flags)
+        with profile_stage(session, 'dedupe', len(chunk)) as stage:
+            sample_df = get_sample_rows(chunk, flags, sid_col)
+            new = np.zeros(len(sample_df), dtype=bool)
+            for sample in SAMPLES:
+                rows = np.flatnonzero((sample_df['Sample'] ==
+                                       sample).to_numpy())
+                new[rows] = filter_new_keys(sample_df[sid_col].iloc[rows],
+                                            seen[sample])
+            sample_df = sample_df[new]
+            stage['Rows Out'] = len(sample_df)
+        yield sample_df
+
+
+def stream_student_data(session, columns, dedupe=True):
+    """Yield the Student Data File in chunks with duplicate students removed.
+    
+    Only the first row for each Student ID Number in the whole file is
+    yielded, as for drop_duplicates on the whole file. Student ID Numbers
+    already seen are held in a bitmap indexed by StudentPK (see
+    filter_new_keys).
+    
+    Args:
+        session (dict): Data loaded in the current session, by source.
+        columns (list): Columns required by the analysis, including
+        StudentPK.
+        dedupe (bool): Whether to remove duplicate students, rather than
+        yield every row.
+        
+    Yields:
+        chunk (DataFrame): Requested columns of the next students.
+    """
+    sid_col = 'StudentPK'
+    source = 'Student Data File'
+    if 'Student Data Headings' not in session:
+        session['Student Data Headings'] = ft.load_headings(
+                'data_headings.txt')
+    if source not in session:
+        session[source] = {'File': get_csv_fname(source), 'Fingerprint': None,
+                           'Data': None}
+    entry = session[source]
+    entry['Invalid Dates'] = {}
+    chunk_rows = get_chunk_rows(entry['File'], session.get('Stream Memory',
+                                STREAM_MEMORY_MB))
+    seen = {'Bitmap': np.zeros(0, dtype=bool), 'Missing': False}
+    chunks = iter_csv_chunks(entry['File'], session['Student Data Headings'],
+                             columns, chunk_rows, entry['Invalid Dates'])
+    while True:
+        with profile_stage(session, 'load') as stage:
+            chunk = next(chunks, None)
+            stage['Rows Out'] = 0 if chunk is None else len(chunk)
+        if chunk is None:
+            break
+        if dedupe:
+            with profile_stage(session, 'dedupe', len(chunk)) as stage:
+                chunk = chunk.drop_duplicates(subset=sid_col, keep='first')
+                chunk = chunk[filter_new_keys(chunk[sid_col], seen)]
+                stage['Rows Out'] = len(chunk)
+        yield chunk
+
+
+def submit_write(session, function, *args, **kwargs):
+    """Run a function that writes results on the background writer thread.
+    
+    Writes are run in the order they are submitted. flush_results waits for
+    them to finish.
+    
+    Args:
+        session (dict): Data loaded in the current session, by source.
+        function (function): Function that writes the results.
+        *args: Arguments for function.
+        **kwargs: Keyword arguments for function.
+    """
+    if session.get('Writer') is None:
+        session['Writer'] = concurrent.futures.ThreadPoolExecutor(1)
+    session.setdefault('Writes', []).append(session['Writer'].submit(
+            function, *args, **kwargs))
+
+
+def watch_server_files(server):
+    """Reload the data of the analysis server whenever its files change.
+    
+    The new data is loaded in full before it replaces the old data in a
+    single step, so every query is answered from either the old or the new
+    data. If the new data cannot be loaded the old data is kept until the
+    files change again.
+    
+    Args:
+        server (dict): Files, settings and Snapshot of the analysis server.
+    """
+    failed = None
+    while True:
+        time.sleep(SERVER_POLL_SECONDS)
+        try:
+            fingerprint = get_server_fingerprint(server)
+        except OSError:
+            # A file is being replaced, check again later
+            continue
+        if fingerprint in (server['Snapshot']['Fingerprint'], failed):
+            continue
+        print('\nData files have changed and will be reloaded.')
+        try:
+            snapshot = load_server_snapshot(server)
+        except Exception as e:
+            print('\nReload failed, still using the data loaded at {}: {}'
+                  .format(server['Snapshot']['Loaded'], e))
+            failed = fingerprint
+            continue
+        server['Snapshot'] = snapshot
+        print('\nData reloaded at {}.'.format(snapshot['Loaded']))
+
+
+def write_json_atomic(data, file_name):
+    """Write data to a json file, replacing any existing file in one step.
+    
+    Args:
+        data (dict): Data to be saved.
+        file_name (str): Name of the json file.
+    """
+    # Each writer has its own temporary file, as other processes may be
+    # writing the same file
+    handle, temp_name = tempfile.mkstemp(prefix=os.path.basename(file_name)
+                                         + '.', suffix='.tmp',
+                                         dir=os.path.dirname(file_name) or '.')
+    with os.fdopen(handle, 'w') as f:
+        json.dump(data, f)
+    os.replace(temp_name, file_name)
+
+
+def write_results(results, f_name, output_format):
+    """Write the results of a run to a single workbook or directory.
+    
+    Each table is written to a sheet (xlsx) or file (parquet) named after
+    its results. Names are shortened to the 31 characters allowed for a
+    sheet and numbered if they are repeated.
+    
+    Args:
+        results (list): Name and table of each result.
+        f_name (str): Name of the workbook or directory.
+        output_format (str): 'xlsx' or 'parquet'.
+    """
+    names = []
+    for name, table in results:
+        name = re.sub(r'[\[\]:*?/\\]', '_', name)[:31]
+        base = name
+        number = 1
+        while name.lower() in (x.lower() for x in names):
+            number += 1
+            name = '{}_{}'.format(base[:30 - len(str(number))], number)
+        names.append(name)
+    if output_format == 'xlsx':
+        # Written to a temporary file so that a partly written workbook is
+        # never left in place of the results
+        temp_name = f_name[:-len('.xlsx')] + '.tmp.xlsx'
+        with pd.ExcelWriter(temp_name, engine='openpyxl') as writer:
+            for name, (_, table) in zip(names, results):
+                table.to_excel(writer, sheet_name=name, index=False)
+        os.replace(temp_name, f_name)
+    else:
+        os.makedirs(f_name, exist_ok=True)
+        for name, (_, table) in zip(names, results):
+            # Parquet column names must be text
+            table = table.rename(columns=str)
+            table.to_parquet(os.path.join(f_name, name + '.parquet'),
+                             index=False)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    if len(sys.argv) > 1:
+        args = parse_batch_args(sys.argv[1:])
+        if args.serve:
+            # Answer queries until stopped
+            run_server(args)
+        else:
+            # Run in batch mode without prompts
+            failures = run_batch(load_batch_job(args))
+            sys.exit(1 if failures else 0)
+    else:
+        main()
\ No newline at end of file
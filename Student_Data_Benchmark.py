@@ -0,0 +1,507 @@
+# Student Data Benchmark
+# Times and memory-profiles the Student Data Analyser analyses against
+# generated Student Database extracts
+
+
+import argparse
+import concurrent.futures
+import contextlib
+import datetime
+import json
+import multiprocessing
+import numpy as np
+import os
+import pandas as pd
+import subprocess
+import sys
+import time
+import tracemalloc
+
+
+# Directories for generated data files and benchmark results
+DATA_DIR = 'bench_data'
+RESULTS_DIR = 'bench_results'
+
+# Default extract sizes to generate and benchmark, in Student Data rows
+DEFAULT_ROWS = [10000, 100000, 1000000, 10000000]
+
+# Rows generated and written at a time, to limit memory use
+GENERATE_CHUNK_ROWS = 1000000
+
+# Change in time or peak memory treated as a regression, in percent
+REGRESSION_PERCENT = 10
+
+# Functions of the analyser timed as separate stages. Stages do not call each
+# other, so their times can be added together.
+STAGE_FUNCTIONS = {'load': ['load_columns'],
+                   'clean': ['clean_age_data', 'clean_category_data',
+                             'get_sample_flags'],
+                   'calculate': ['build_distribution', 'build_length_sketch',
+                                 'calculate_days', 'convert_ages',
+                                 'get_course_types', 'get_length_statistics'],
+                   'save': ['save_result', 'flush_results',
+                            'save_length_sketch']}
+
+# Weighted values for each generated column. Blank values are missing data.
+CITIES = ['Auckland', 'Wellington', 'Christchurch', 'Hamilton', 'Tauranga',
+          'Dunedin', 'Palmerston North', 'Napier', 'Nelson', 'Rotorua',
+          'New Plymouth', 'Whangarei', 'Invercargill', 'Whanganui', 'Gisborne']
+COUNTRIES = {'New Zealand': 0.92, 'Australia': 0.04, 'United Kingdom': 0.01,
+             '': 0.03}
+COURSES = ['CAC-ON-01', 'CAC-PT-01', 'DIP-ON-02', 'DIP-PT-02', 'CER-ON-03',
+           'CER-PT-03', 'ADV-ON-04', 'WKS01']
+EMPLOYMENT = {'Employed full time': 0.4, 'Employed part time': 0.2,
+              'Self employed': 0.08, 'Unemployed': 0.12, 'Student': 0.1,
+              '': 0.1}
+ETHNICITIES = {'NZ European': 0.52, 'Maori': 0.15, 'Samoan': 0.04,
+               'Tongan': 0.02, 'Cook Island Maori': 0.015, 'Fijian': 0.01,
+               'Niuean': 0.005, 'Chinese': 0.05, 'Indian': 0.05,
+               'Other European': 0.06, 'Other': 0.05, '': 0.03}
+HOW_HEARD = {'Google': 0.3, 'Facebook': 0.2, 'Friend or family': 0.2,
+             'Employer': 0.1, 'Newspaper': 0.05, 'Radio': 0.03, '': 0.12}
+ISLAND_NATIONS = ['Samoan', 'Tongan', 'Cook Island Maori', 'Fijian', 'Niuean',
+                  'Tokelauan', 'Tuvaluan']
+REASONS = {'Career change': 0.3, 'Personal interest': 0.25,
+           'Improve job prospects': 0.25, 'Required for work': 0.1, '': 0.1}
+STATUSES = {'Active': 0.3, 'Expired': 0.35, 'Graduated': 0.2,
+            'Withdrawn': 0.1, 'Deferred': 0.05}
+STUDENT_HEADINGS = ['StudentPK', 'NameGiven', 'NameSurname', 'Gender',
+                    'DateOfBirth', 'AddressCity', 'AddressCountry',
+                    'Ethnicity', 'EnrolmentPK', 'CourseFK', 'StartDate',
+                    'ExpiryDate', 'Status', 'Employment', 'ReasonForStudy',
+                    'HowHeard']
+
+
+def choose(rng, values, size):
+    """Return values chosen at random with the given weights.
+    
+    Args:
+        rng (Generator): Random number generator.
+        values (dict or list): Values with their weights, or values that are
+        weighted by a Zipf distribution in list order.
+        size (int): Number of values to return.
+        
+    Returns:
+        chosen (array): Chosen values.
+    """
+    if isinstance(values, dict):
+        weights = np.array(list(values.values()))
+        values = list(values)
+    else:
+        weights = 1 / np.arange(1, len(values) + 1)
+    return np.asarray(values, dtype=object)[rng.choice(len(values), size,
+                                                       p=weights /
+                                                       weights.sum())]
+
+
+def compare_results(base_name, new_name, threshold=REGRESSION_PERCENT):
+    """Print the change in each result between two benchmark runs.
+    
+    Args:
+        base_name (str): Name of the results file to compare against.
+        new_name (str): Name of the new results file.
+        threshold (float): Percentage increase treated as a regression.
+        
+    Returns:
+        regressions (int): Number of results that got slower or used more
+        memory by more than threshold percent.
+    """
+    with open(base_name) as f:
+        base = {(x['Rows'], x['Analysis']): x for x in json.load(f)['Results']}
+    with open(new_name) as f:
+        new = json.load(f)['Results']
+    regressions = 0
+    print('{:>9} {:12} {:>9} {:>9} {:>8} {:>9} {:>9} {:>8}'.format('Rows',
+          'Analysis', 'Base s', 'New s', 'Change', 'Base MB', 'New MB',
+          'Change'))
+    for result in new:
+        key = (result['Rows'], result['Analysis'])
+        if key not in base:
+            continue
+        old = base[key]
+        changes = []
+        for measure in ('Seconds', 'Peak MB'):
+            # Peak MB is None if memory was not profiled
+            if old[measure] and result[measure] is not None:
+                changes.append((result[measure] / old[measure] - 1) * 100)
+            else:
+                changes.append(0.0)
+        flag = ' <-- regression' if max(changes) > threshold else ''
+        regressions += bool(flag)
+        print('{:>9} {:12} {:9.3f} {:9.3f} {:+7.1f}% {:>9} {:>9} {:+7.1f}%'
+              '{}'.format(result['Rows'], result['Analysis'],
+              old['Seconds'], result['Seconds'], changes[0],
+              format_mb(old['Peak MB']), format_mb(result['Peak MB']),
+              changes[1], flag))
+    return regressions
+
+
+def format_dates(rng, start, days, size, blank=0.0):
+    """Return random dates as DD/MM/YYYY text.
+    
+    Args:
+        rng (Generator): Random number generator.
+        start (str): Earliest date, e.g. '2010-01-01'.
+        days (array): Number of days after start of each date, or the range
+        of days to choose from if an int.
+        size (int): Number of dates to return.
+        blank (float): Fraction of dates to leave blank.
+        
+    Returns:
+        dates (array): Date text for each date.
+    """
+    if np.isscalar(days):
+        days = rng.integers(0, days, size)
+    days = np.asarray(days, dtype=np.int64)
+    # Format each distinct day once only
+    lookup = pd.date_range(start, periods=days.max() + 1).strftime('%d/%m/%Y')
+    dates = np.asarray(lookup, dtype=object)[days]
+    dates[rng.random(size) < blank] = ''
+    return dates
+
+
+def format_mb(value):
+    """Return a memory size for display.
+    
+    Args:
+        value (float): Size in megabytes, or None if not measured.
+        
+    Returns:
+        text (str): Size to one decimal place, or '-' if not measured.
+    """
+    return '-' if value is None else '{:.1f}'.format(value)
+
+
+def generate_data(rows, data_dir, seed=0):
+    """Write a set of generated Student Database extracts.
+    
+    The Student Data File has duplicate StudentPKs (students with more than
+    one enrolment), skewed city and ethnicity distributions and blank fields.
+    The Enrolments and Graduates Files cover the same enrolments.
+    
+    Args:
+        rows (int): Number of enrolments in the Student Data File.
+        data_dir (str): Directory to write the files to.
+        seed (int): Random number generator seed.
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    with open(os.path.join(data_dir, 'data_headings.txt'), 'w') as f:
+        f.write(','.join(STUDENT_HEADINGS))
+    with open(os.path.join(data_dir, 'pacific_island_nations.txt'), 'w') as f:
+        f.write(','.join(ISLAND_NATIONS))
+    files = {x: os.path.join(data_dir, y) for x, y in [
+            ('Student', 'All_student_data.csv'),
+            ('Enrolments', 'enrolments_All.csv'),
+            ('Graduates', 'graduates.csv')]}
+    for name in files.values():
+        if os.path.exists(name):
+            os.remove(name)
+    students = max(int(rows * 0.8), 1)
+    graduate_pk = 1
+    for first in range(0, rows, GENERATE_CHUNK_ROWS):
+        size = min(GENERATE_CHUNK_ROWS, rows - first)
+        student, enrolments, graduates = generate_rows(rng, first, size,
+                                                       students, graduate_pk)
+        graduate_pk += len(graduates)
+        # Only the Student Data File has a headings row
+        student.to_csv(files['Student'], mode='a', index=False,
+                       header=first == 0)
+        enrolments.to_csv(files['Enrolments'], mode='a', index=False,
+                          header=False)
+        graduates.to_csv(files['Graduates'], mode='a', index=False,
+                         header=False)
+    print('Generated {} rows in {}'.format(rows, data_dir))
+
+
+def generate_rows(rng, first, size, students, first_graduate):
+    """Return generated rows for each extract.
+    
+    Args:
+        rng (Generator): Random number generator.
+        first (int): Number of enrolments already generated.
+        size (int): Number of enrolments to generate.
+        students (int): Number of distinct students to draw StudentPKs from.
+        first_graduate (int): GraduatePK of the first graduate.
+        
+    Returns:
+        student (DataFrame): Student Data File rows.
+        enrolments (DataFrame): Enrolments File rows.
+        graduates (DataFrame): Graduates File rows.
+    """
+    student_pks = rng.integers(1, students + 1, size).astype(object)
+    student_pks[rng.random(size) < 0.001] = ''
+    enrolment_pks = np.arange(first + 1, first + size + 1)
+    # Birth years centred on 1990, start dates from 2010
+    birth_days = np.clip(rng.normal(40 * 365, 3650, size), 0,
+                         55 * 365).astype(np.int64)
+    start_days = rng.integers(0, 9 * 365, size)
+    expiry_days = start_days + rng.integers(365, 3 * 365, size)
+    start_dates = format_dates(rng, '2010-01-01', start_days, size)
+    expiry_dates = format_dates(rng, '2010-01-01', expiry_days, size)
+    courses = choose(rng, COURSES, size)
+    statuses = choose(rng, STATUSES, size)
+    cities = choose(rng, CITIES + ['Town {}'.format(x) for x in range(200)],
+                    size)
+    cities[rng.random(size) < 0.03] = ''
+    student = pd.DataFrame({
+            'StudentPK': student_pks,
+            'NameGiven': choose(rng, ['Aroha', 'James', 'Mele', 'Wei',
+                                      'Sarah', 'Tama'], size),
+            'NameSurname': choose(rng, ['Smith', 'Ngata', 'Tupou', 'Li',
+                                        'Brown', 'Patel'], size),
+            'Gender': choose(rng, {'F': 0.55, 'M': 0.43, '': 0.02}, size),
+            'DateOfBirth': format_dates(rng, '1950-01-01', birth_days, size,
+                                        blank=0.02),
+            'AddressCity': cities,
+            'AddressCountry': choose(rng, COUNTRIES, size),
+            'Ethnicity': choose(rng, ETHNICITIES, size),
+            'EnrolmentPK': enrolment_pks,
+            'CourseFK': courses,
+            'StartDate': start_dates,
+            'ExpiryDate': expiry_dates,
+            'Status': statuses,
+            'Employment': choose(rng, EMPLOYMENT, size),
+            'ReasonForStudy': choose(rng, REASONS, size),
+            'HowHeard': choose(rng, HOW_HEARD, size)})
+    enrolments = pd.DataFrame({'EnrolmentPK': enrolment_pks,
+                               'StudentFK': student_pks,
+                               'CourseFK': courses,
+                               'TutorFK': rng.integers(1, 50, size),
+                               'StartDate': start_dates,
+                               'ExpiryDate': expiry_dates,
+                               'Status': statuses,
+                               'Tag': ''})
+    # Graduate the enrolments with a Graduated status
+    graduated = np.flatnonzero(statuses == 'Graduated')
+    grad_days = start_days[graduated] + rng.integers(180, 4 * 365,
+                                                     len(graduated))
+    graduates = pd.DataFrame({
+            'GraduatePK': np.arange(first_graduate,
+                                    first_graduate + len(graduated)),
+            'EnrolmentPK': enrolment_pks[graduated],
+            'GraduationDate': format_dates(rng, '2010-01-01', grad_days,
+                                           len(graduated)),
+            'CertificateNumber': ['C{}'.format(x) for x in
+                                  enrolment_pks[graduated]]})
+    return student, enrolments, graduates
+
+
+def get_analyses():
+    """Return the analyser function run for each benchmark analysis.
+    
+    Returns:
+        analyses (dict): Analysis name and the name of its function.
+    """
+    import Student_Data_Analyser as sda
+    return {x['name']: x['function'] for x in sda.ANALYSES}
+
+
+def get_git_commit():
+    """Return the current git commit of the analyser, if known.
+    
+    Returns:
+        commit (str): Commit hash, or '' if not in a git repository.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(
+                              __file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def main():
+    """Generate data, run benchmarks or compare results."""
+    parser = argparse.ArgumentParser(description='Benchmark the Student Data '
+            'Analyser against generated data.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    generate = commands.add_parser('generate', help='Generate data files')
+    generate.add_argument('--rows', type=int, nargs='+', default=DEFAULT_ROWS)
+    generate.add_argument('--seed', type=int, default=0)
+    run = commands.add_parser('run', help='Run the benchmarks')
+    run.add_argument('--rows', type=int, nargs='+', default=DEFAULT_ROWS)
+    run.add_argument('--analyses', nargs='+', help='Analyses to run '
+                     '(default: all)')
+    run.add_argument('--repeat', type=int, default=1, help='Timed runs of '
+                     'each analysis, the fastest is kept')
+    run.add_argument('--no-memory', action='store_true',
+                     help='Skip the memory profiling run')
+    compare = commands.add_parser('compare', help='Compare two results '
+                                  'files (default: the latest two)')
+    compare.add_argument('files', nargs='*')
+    compare.add_argument('--threshold', type=float,
+                         default=REGRESSION_PERCENT)
+    args = parser.parse_args()
+    if args.command == 'generate':
+        for rows in args.rows:
+            generate_data(rows, os.path.join(DATA_DIR, str(rows)), args.seed)
+    elif args.command == 'run':
+        results = run_benchmarks(args.rows, args.analyses or
+                                 list(get_analyses()), args.repeat,
+                                 not args.no_memory)
+        print('\nResults saved to {}'.format(results))
+    else:
+        files = args.files or sorted(os.path.join(RESULTS_DIR, x) for x in
+                                     os.listdir(RESULTS_DIR))[-2:]
+        if len(files) != 2:
+            parser.error('two results files are required')
+        regressions = compare_results(files[0], files[1], args.threshold)
+        print('\n{} regressions over {}%'.format(regressions,
+              args.threshold))
+        sys.exit(1 if regressions else 0)
+
+
+def run_analysis(data_dir, function_name, repeat=1, memory=True):
+    """Return the time and memory used by one analysis of a data set.
+    
+    Each stage function of the analyser is wrapped to record the time spent
+    in it, and with memory profiling the peak memory allocated while it runs.
+    Run in a separate process so that analyses do not share loaded data.
+    
+    Args:
+        data_dir (str): Directory holding the data files.
+        function_name (str): Name of the analyser function to run.
+        repeat (int): Number of timed runs, the fastest is kept.
+        memory (bool): Whether to make a memory profiling run.
+        
+    Returns:
+        result (dict): Seconds, Peak MB and Stages of the analysis.
+    """
+    os.chdir(data_dir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import Student_Data_Analyser as sda
+    stages = {}
+    peaks = []
+    for stage, names in STAGE_FUNCTIONS.items():
+        for name in names:
+            # Dotted names are in modules used by sda, e.g. ft
+            owner = sda
+            for part in name.split('.')[:-1]:
+                owner = getattr(owner, part)
+            name = name.split('.')[-1]
+            setattr(owner, name, wrap_stage(getattr(owner, name), stage,
+                                            stages, peaks))
+    function = sda.get_analysis_function(function_name)
+    output_dir = 'bench_output'
+    best = None
+    for run in range(repeat + memory):
+        tracing = memory and run == repeat
+        stages.clear()
+        del peaks[:]
+        session = {'Batch': True, 'Sample': 'All', 'Output Dir': output_dir,
+                   'Age Reference': 'Today',
+                   'Cube Dimensions': ['ethnicity', 'age', 'location'],
+                   'Student Data File': {'File': 'All_student_data.csv',
+                                         'Fingerprint': None, 'Data': None},
+                   'Enrolments File': {'File': 'enrolments_All.csv',
+                                       'Fingerprint': None, 'Data': None},
+                   'Graduates File': {'File': 'graduates.csv',
+                                      'Fingerprint': None, 'Data': None}}
+        os.makedirs(output_dir, exist_ok=True)
+        if tracing:
+            tracemalloc.start()
+        start = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull):
+            function(session)
+        seconds = time.perf_counter() - start
+        if tracing:
+            peak = max(peaks + [tracemalloc.get_traced_memory()[1]])
+            tracemalloc.stop()
+            best['Peak MB'] = peak / 1024 / 1024
+            for stage, values in stages.items():
+                best['Stages'].setdefault(stage, {})['Peak MB'] = \
+                        values['Peak MB']
+        elif best is None or seconds < best['Seconds']:
+            best = {'Seconds': seconds, 'Peak MB': None,
+                    'Stages': {x: {'Seconds': y['Seconds']} for x, y in
+                               stages.items()}}
+    best['Stages']['other'] = {'Seconds': best['Seconds'] - sum(
+            x['Seconds'] for x in best['Stages'].values())}
+    return best
+
+
+def run_benchmarks(rows_list, analyses, repeat=1, memory=True):
+    """Run each analysis against each generated data set and save results.
+    
+    Args:
+        rows_list (list): Sizes of the data sets to use, in rows.
+        analyses (list): Names of the analyses to run.
+        repeat (int): Number of timed runs of each analysis.
+        memory (bool): Whether to profile memory use.
+        
+    Returns:
+        results_name (str): Name of the saved results file.
+    """
+    functions = get_analyses()
+    results = []
+    # Use a new process for each analysis so that memory use is separate
+    context = multiprocessing.get_context('spawn')
+    for rows in rows_list:
+        data_dir = os.path.abspath(os.path.join(DATA_DIR, str(rows)))
+        if not os.path.isdir(data_dir):
+            print('No data for {} rows, run generate first.'.format(rows))
+            continue
+        for analysis in analyses:
+            try:
+                with concurrent.futures.ProcessPoolExecutor(
+                        1, mp_context=context) as executor:
+                    result = executor.submit(run_analysis, data_dir,
+                                             functions[analysis], repeat,
+                                             memory).result()
+            except Exception as e:
+                print('{:>9} {:12} failed: {}'.format(rows, analysis, e))
+                continue
+            result.update(Rows=rows, Analysis=analysis)
+            results.append(result)
+            print('{:>9} {:12} {:9.3f}s {:>9} MB'.format(rows, analysis,
+                  result['Seconds'], format_mb(result['Peak MB'])))
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    now = datetime.datetime.now()
+    results_name = os.path.join(RESULTS_DIR, '{}.json'.format(
+            now.strftime('%Y%m%d%H%M%S')))
+    with open(results_name, 'w') as f:
+        json.dump({'Time': now.isoformat(), 'Commit': get_git_commit(),
+                   'Python': sys.version.split()[0],
+                   'Pandas': pd.__version__, 'Results': results}, f, indent=1)
+    return results_name
+
+
+def wrap_stage(function, stage, stages, peaks):
+    """Return function wrapped to record the time and memory it uses.
+    
+    The traced memory peak is reset at the start of each call so that the
+    peak of the call can be found. The peak before the reset is added to
+    peaks so that the overall peak is not lost.
+    
+    Args:
+        function (function): Analyser function to be wrapped.
+        stage (str): Name of the stage the function belongs to.
+        stages (dict): Seconds and Peak MB of each stage, to be added to.
+        peaks (list): Traced memory peaks before each reset, to be added to.
+        
+    Returns:
+        wrapped (function): Function that records each call in stages.
+    """
+    def wrapped(*args, **kwargs):
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            values = stages.setdefault(stage, {'Seconds': 0.0,
+                                               'Peak MB': 0.0})
+            values['Seconds'] += time.perf_counter() - start
+            if tracing:
+                values['Peak MB'] = max(values['Peak MB'],
+                        tracemalloc.get_traced_memory()[1] / 1024 / 1024)
+    return wrapped
+
+
+if __name__ == '__main__':
+    main()